@@ -0,0 +1,490 @@
+import argparse
+import fcntl
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+# Hermetic launch-latency benchmark. The client is copied into a scratch directory with a generated
+# harmony.json and app config, a stand-in `virsh` executable is put first on PATH, USB devices are read from a
+# fake sysfs tree and a fake guest listener is served on 127.0.0.x:5000. Each run drives HarmonyClient.run in a fresh process up to the point
+# where Looking Glass would be launched, and reports launch latency, subprocess spawns and HTTP round trips.
+# With -daemon the runs go through one harmonyd instead, as app.py launches do.
+#
+#   python benchmark.py -runs 10 -start-delay 2 -virsh-latency 30
+#
+# This file is also the stand-in executable (`benchmark.py -fake virsh ...`) and the per-run child process.
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+
+BENCH_APP = 'bench'
+BENCH_VM = 'bench-vm'
+CLIENT_PORT = 5001
+GUEST_PORT = 5000
+
+def bench_ip(index):
+    return f'127.0.0.{index + 2}'
+
+def bench_mac(index):
+    return f'52:54:00:be:00:{index:02x}'
+
+# Shared fake hypervisor state, kept in a JSON file guarded by a file lock because every fake virsh is its own process
+class HarmonyBenchState():
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.state_file = os.path.join(state_dir, 'state.json')
+        self.lock_file = os.path.join(state_dir, 'state.lock')
+        self.calls_file = os.path.join(state_dir, 'calls.log')
+
+    def update(self, mutate=None):
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            now = time.time()
+            for domain in state['domains'].values():
+                if domain['state'] == 'starting' and now >= domain['ready_at']:
+                    domain['state'] = 'running'
+                if domain['state'] == 'stopping' and now >= domain['ready_at']:
+                    domain['state'] = 'shut off'
+            if mutate:
+                mutate(state)
+            with open(self.state_file, 'w') as f:
+                json.dump(state, f)
+            return state
+
+    def record_call(self, command, argv):
+        with open(self.calls_file, 'a') as f:
+            f.write(json.dumps([command] + argv) + '\n')
+
+    def read_calls(self):
+        calls = {}
+        if os.path.exists(self.calls_file):
+            with open(self.calls_file, 'r') as f:
+                for line in f:
+                    call = json.loads(line)
+                    key = ' '.join(call[:2])
+                    calls[key] = calls.get(key, 0) + 1
+        return calls
+
+    def reset_calls(self):
+        open(self.calls_file, 'w').close()
+
+def fake_virsh(state, argv):
+    config = state.update()['config']
+    time.sleep(config['virsh_latency'])
+    args = [arg for arg in argv if not arg.startswith('--')]
+    command = args[0] if args else ''
+
+    def domain_index(name, current):
+        return list(current['domains']).index(name)
+
+    if command == 'list':
+        current = state.update()
+        print(' Id   Name   State')
+        print('---------------------')
+        for index, (name, domain) in enumerate(current['domains'].items()):
+            if domain['state'] in ('running', 'paused'):
+                print(f' {index + 1}    {name}   {domain["state"]}')
+    elif command == 'start':
+        def start(current):
+            domain = current['domains'][args[1]]
+            if domain['state'] in ('shut off', 'stopping'):
+                domain['state'] = 'starting'
+                domain['ready_at'] = time.time() + current['config']['start_delay']
+        state.update(start)
+        print(f'Domain {args[1]} started')
+    elif command == 'domuuid':
+        print(uuid.uuid5(uuid.NAMESPACE_DNS, args[1]))
+    elif command == 'domiflist':
+        current = state.update()
+        print(' Interface   Type      Source    Model    MAC')
+        print('--------------------------------------------------------')
+        print(f' vnet0       network   default   virtio   {bench_mac(domain_index(args[1], current))}')
+    elif command == 'domifaddr':
+        current = state.update()
+        index = domain_index(args[1], current)
+        print(' Name       MAC address          Protocol     Address')
+        print('-------------------------------------------------------------------------------')
+        if current['domains'][args[1]]['state'] == 'running' and '--source' not in argv:
+            print(f' vnet0      {bench_mac(index)}    ipv4         {bench_ip(index)}/24')
+    elif command == 'dumpxml':
+        current = state.update()
+        index = domain_index(args[1], current)
+        print(f"<domain type='kvm'><name>{args[1]}</name><uuid>{uuid.uuid5(uuid.NAMESPACE_DNS, args[1])}</uuid><devices>")
+        print(f"<interface type='network'><mac address='{bench_mac(index)}'/></interface>")
+        print('</devices></domain>')
+    elif command in ('suspend', 'resume', 'managedsave'):
+        def change(current):
+            domain = current['domains'][args[1]]
+            domain['state'] = {'suspend': 'paused', 'resume': 'running', 'managedsave': 'shut off'}[command]
+        state.update(change)
+        print(f'Domain {args[1]} {command} succeeded')
+    elif command in ('define', 'attach-device', 'detach-device'):
+        if '/dev/stdin' in argv:
+            sys.stdin.read()
+        print(f'{command} succeeded')
+    else:
+        print(f'error: unknown command {command}', file=sys.stderr)
+        return 1
+    return 0
+
+def run_fake(command, argv):
+    state = HarmonyBenchState(os.environ['HARMONY_BENCH_STATE'])
+    state.record_call(command, argv)
+    return fake_virsh(state, argv)
+
+# Stand-in /sys/bus/usb/devices with one device per configured name, plus a root hub and an interface entry that
+# the index has to skip. The names come from a matching usb.ids, like lsusb would print them.
+def write_fake_usb(usb_dir, usb_ids_file, usb_devices):
+    entries = {'usb1': ('1d6b', '0002', 1, 'Linux Foundation', '2.0 root hub', '')}
+    for index, name in enumerate(usb_devices):
+        entries[f'1-{index + 1}'] = ('28de', f'{0x2100 + index:04x}', index + 2, '', '', f'BENCH{index:04d}')
+    for entry, (vendor_id, product_id, devnum, manufacturer, product, serial) in entries.items():
+        device_dir = os.path.join(usb_dir, entry)
+        os.makedirs(os.path.join(usb_dir, f'{entry}:1.0'), exist_ok=True)
+        os.makedirs(device_dir, exist_ok=True)
+        attributes = {'idVendor': vendor_id, 'idProduct': product_id, 'busnum': '1', 'devnum': str(devnum),
+                      'manufacturer': manufacturer, 'product': product, 'serial': serial}
+        for attribute, value in attributes.items():
+            if value:
+                with open(os.path.join(device_dir, attribute), 'w') as f:
+                    f.write(value + '\n')
+
+    with open(usb_ids_file, 'w') as f:
+        f.write('# Harmony benchmark usb.ids\n1d6b  Linux Foundation\n\t0002  2.0 root hub\n28de  Harmony\n')
+        for index, name in enumerate(usb_devices):
+            f.write(f"\t{0x2100 + index:04x}  {name.removeprefix('Harmony ')}\n")
+        f.write('\nC 00  (Defined at Interface level)\n')
+
+# Fake guest listener serving /execute, /jobs, /stop, /cancel and /disconnected for every benchmark domain
+class HarmonyBenchGuest():
+    def __init__(self, state, ready_delay, hibernate_delay):
+        self.state = state
+        self.ready_delay = ready_delay
+        self.hibernate_delay = hibernate_delay
+        self.round_trips = {}
+        self.lock = threading.Lock()
+        self.servers = []
+        self.launches = {}
+        self.jobs = {}
+
+    def count(self, endpoint):
+        with self.lock:
+            self.round_trips[endpoint] = self.round_trips.get(endpoint, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.round_trips = {}
+
+    def send_ready(self):
+        import requests
+        time.sleep(self.ready_delay)
+        try:
+            requests.get(f'http://127.0.0.1:{CLIENT_PORT}/ready', timeout=5)
+        except requests.exceptions.ConnectionError:
+            pass # The client exits as soon as it is ready, often before answering
+        except requests.exceptions.RequestException as e:
+            print(f'[HarmonyBenchGuest] [Error] Failed sending the ready signal: {e}')
+
+    def publish_ready(self, launch):
+        time.sleep(self.ready_delay)
+        self.get_launch(launch).set()
+
+    def get_launch(self, launch):
+        with self.lock:
+            return self.launches.setdefault(launch, threading.Event())
+
+    def hibernate(self, vm_name):
+        def stop(current):
+            current['domains'][vm_name]['state'] = 'stopping'
+            current['domains'][vm_name]['ready_at'] = time.time() + self.hibernate_delay
+        self.state.update(stop)
+
+    def create_app(self, vm_name):
+        from flask import Flask, Response, request
+        guest = Flask(f'bench-guest-{vm_name}')
+
+        @guest.route('/execute', methods=['POST'])
+        def execute():
+            self.count('/execute')
+            command = request.form.get('command', '')
+            launch = request.form.get('launch')
+            key = request.form.get('key') or launch
+            with self.lock:
+                job = self.jobs.get(key) if key else None
+                if job is None:
+                    job = {'id': uuid.uuid4().hex, 'status': 'running', 'version': 1, 'exit_code': None, 'output': ''}
+                    self.jobs[key or job['id']] = job
+                    duplicate = False
+                else:
+                    duplicate = True
+            if duplicate:
+                self.count('duplicate /execute')
+            elif 'hibernate.py' in command:
+                self.hibernate(vm_name)
+            elif launch:
+                threading.Thread(target=self.publish_ready, args=(launch,), daemon=True).start()
+            else:
+                threading.Thread(target=self.send_ready, daemon=True).start()
+            return json.dumps({'job': job['id'], 'status': job['status'], 'version': job['version'], 'duplicate': duplicate})
+
+        @guest.route('/jobs/<job_id>', methods=['GET'])
+        def get_job(job_id):
+            self.count('/jobs')
+            with self.lock:
+                jobs = [job for job in self.jobs.values() if job['id'] == job_id]
+            if not jobs:
+                return 'Unknown job.', 404
+            # Jobs here never change, a long poll is held for the whole wait like the guest does
+            if jobs[0]['version'] <= int(request.args.get('version', 0)):
+                time.sleep(min(float(request.args.get('wait', 0)), 60))
+            return json.dumps(jobs[0]), 200
+
+        @guest.route('/events', methods=['GET'])
+        def events():
+            self.count('/events')
+            ready = self.get_launch(request.args.get('launch'))
+            def stream():
+                ready.wait(60)
+                yield f"id: 1\nevent: milestone\ndata: {json.dumps({'id': 1, 'name': 'ready', 'args': {}})}\n\n"
+            return Response(stream(), mimetype='text/event-stream')
+
+        for endpoint in ('/stop', '/cancel', '/disconnected'):
+            def handler(endpoint=endpoint):
+                self.count(endpoint)
+                return endpoint.strip('/').capitalize()
+            guest.add_url_rule(endpoint, endpoint, handler, methods=['POST'])
+        return guest
+
+    def start(self, vm_names):
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        for index, vm_name in enumerate(vm_names):
+            server = make_server(bench_ip(index), GUEST_PORT, self.create_app(vm_name), threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+
+def print_result(result):
+    # One write on its own line, the log writer thread echoes to the same stdout
+    sys.stdout.write('\nHARMONY_BENCH_RESULT ' + json.dumps(result) + '\n')
+    sys.stdout.flush()
+
+def run_child():
+    # Runs inside the scratch client directory, stops at the point where Looking Glass would be launched
+    import_start = time.monotonic()
+    import launch
+    from registry import get_harmony_registry, load_harmony_config
+    import_time = time.monotonic() - import_start
+
+    launch_start = time.monotonic()
+    def start_lg(self, listener):
+        result = {
+            'import': import_time,
+            'launch': time.monotonic() - launch_start,
+            'http': self.common.http.get_stats(),
+        }
+        print_result(result)
+        os._exit(0)
+    launch.HarmonyClient.start_lg = start_lg
+    launch.HarmonyClient(get_harmony_registry().get(BENCH_APP), load_harmony_config()).run()
+    os._exit(1)
+
+def run_daemon_child():
+    # Launches through the harmonyd started by the parent, like the thin app.py client does
+    import_start = time.monotonic()
+    from ipc import HarmonyDaemonClient
+    import_time = time.monotonic() - import_start
+
+    launch_start = time.monotonic()
+    client = HarmonyDaemonClient()
+    client.connect(autostart=False)
+    result = client.launch(BENCH_APP)
+    if result.get('event') != 'ready':
+        print(f"Launch failed: {result.get('message')}", flush=True)
+        os._exit(1)
+    print_result({'import': import_time, 'launch': time.monotonic() - launch_start, 'http': {}})
+    client.lg_exited(0)
+    os._exit(0)
+
+def start_daemon(client_dir, env, timeout=30):
+    socket_path = os.path.join(env['XDG_RUNTIME_DIR'], 'harmony', 'harmonyd.sock')
+    process = subprocess.Popen([sys.executable, os.path.join(client_dir, 'harmonyd.py')], cwd=client_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(socket_path):
+        if process.poll() is not None or time.monotonic() >= deadline:
+            process.kill()
+            raise RuntimeError('harmonyd did not start')
+        time.sleep(0.05)
+    return process
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+def write_fixture(work_dir, options):
+    client_dir = os.path.join(work_dir, 'client')
+    bin_dir = os.path.join(work_dir, 'bin')
+    state_dir = os.path.join(work_dir, 'state')
+    os.makedirs(os.path.join(client_dir, 'apps'))
+    os.makedirs(bin_dir)
+    os.makedirs(state_dir)
+
+    for file in os.listdir(current_path):
+        if file.endswith('.py'):
+            shutil.copy(os.path.join(current_path, file), client_dir)
+
+    other_vms = [f'bench-other-{index}' for index in range(options.hibernate)]
+    with open(os.path.join(client_dir, 'harmony.json'), 'w') as f:
+        json.dump({
+            'domains': [BENCH_VM] + other_vms,
+            'looking-glass-gdk-backend': 'x11',
+            'looking-glass-path': shutil.which('true') or '/bin/true',
+            'looking-glass-args': [],
+            'spice-port': 5905,
+            'port': CLIENT_PORT,
+        }, f, indent=4)
+    usb_devices = [f'Harmony Bench Device {index}' for index in range(options.usb_devices)]
+    with open(os.path.join(client_dir, 'apps', f'{BENCH_APP}.json'), 'w') as f:
+        json.dump({
+            'vm': BENCH_VM,
+            'name': 'Harmony Benchmark',
+            'splash': 'bench.jpg',
+            'mainexe': 'bench.exe',
+            'exes': ['bench.exe'],
+            'killexes': [''],
+            'usb_devices': usb_devices,
+            'client_command': '',
+            'client_undo_command': '',
+            'command': 'bench.exe',
+        }, f, indent=4)
+
+    write_fake_usb(os.path.join(work_dir, 'usb'), os.path.join(work_dir, 'usb.ids'), usb_devices)
+
+    for command in ('virsh',):
+        fake_path = os.path.join(bin_dir, command)
+        with open(fake_path, 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(client_dir, "benchmark.py")}" -fake {command} "$@"\n')
+        os.chmod(fake_path, 0o755)
+
+    with open(os.path.join(state_dir, 'state.json'), 'w') as f:
+        json.dump({'domains': {}, 'config': {
+            'virsh_latency': options.virsh_latency / 1000,
+            'start_delay': options.start_delay,
+            'usb_devices': usb_devices,
+        }}, f)
+    return client_dir, bin_dir, state_dir, [BENCH_VM] + other_vms, other_vms
+
+def run_benchmark(options):
+    work_dir = tempfile.mkdtemp(prefix='harmony-bench-')
+    client_dir, bin_dir, state_dir, vm_names, other_vms = write_fixture(work_dir, options)
+    state = HarmonyBenchState(state_dir)
+    guest = HarmonyBenchGuest(state, options.ready_delay, options.hibernate_delay)
+    guest.start(vm_names)
+
+    env = dict(os.environ)
+    env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    env['HARMONY_BENCH_STATE'] = state_dir
+    env['HARMONY_DOMAIN_BACKEND'] = 'virsh'
+    env['HARMONY_USB_SYSFS'] = os.path.join(work_dir, 'usb')
+    env['HARMONY_USB_IDS'] = os.path.join(work_dir, 'usb.ids')
+    env['XDG_RUNTIME_DIR'] = os.path.join(work_dir, 'run')
+
+    results = []
+    daemon = start_daemon(client_dir, env) if options.daemon else None
+    child = ['-child', '-daemon'] if options.daemon else ['-child']
+    try:
+        for run in range(options.runs):
+            def reset(current):
+                current['domains'] = {name: {'state': 'running' if name in other_vms else 'shut off', 'ready_at': 0} for name in vm_names}
+            state.update(reset)
+            state.reset_calls()
+            guest.reset()
+            if options.cold and os.path.exists(os.path.join(client_dir, 'ip_cache.json')):
+                os.remove(os.path.join(client_dir, 'ip_cache.json'))
+
+            start = time.monotonic()
+            process = subprocess.run([sys.executable, os.path.join(client_dir, 'benchmark.py'), *child], cwd=client_dir, env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=options.timeout)
+            wall = time.monotonic() - start
+            lines = [line for line in process.stdout.splitlines() if line.startswith('HARMONY_BENCH_RESULT ')]
+            if not lines:
+                print(f'Run {run + 1} failed with exit code {process.returncode}:\n{process.stdout[-2000:]}\n{process.stderr[-2000:]}')
+                continue
+            result = json.loads(lines[-1].split(' ', 1)[1])
+            result['wall'] = wall
+            result['spawns'] = state.read_calls()
+            result['round_trips'] = dict(guest.round_trips)
+            results.append(result)
+            print(f"Run {run + 1}: launch {result['launch']:.3f}s, wall {wall:.3f}s, spawns {sum(result['spawns'].values())}, round trips {sum(result['round_trips'].values())}")
+    finally:
+        if daemon:
+            daemon.terminate()
+            daemon.wait()
+        guest.stop()
+        if not options.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        else:
+            print(f'Kept benchmark directory: {work_dir}')
+    return results
+
+def summarise(results):
+    if not results:
+        return {}
+    launches = [result['launch'] for result in results]
+    summary = {
+        'runs': len(results),
+        'launch_p50': percentile(launches, 0.5),
+        'launch_p95': percentile(launches, 0.95),
+        'import_p50': percentile([result['import'] for result in results], 0.5),
+        'wall_p50': percentile([result['wall'] for result in results], 0.5),
+        'spawns': {},
+        'round_trips': {},
+        'http': {},
+    }
+    for key in ('spawns', 'round_trips', 'http'):
+        names = set().union(*(result[key] for result in results))
+        summary[key] = {name: sum(result[key].get(name, 0) for result in results) / len(results) for name in sorted(names)}
+    return summary
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '-fake':
+        sys.exit(run_fake(sys.argv[2], sys.argv[3:]))
+    if len(sys.argv) > 1 and sys.argv[1] == '-child':
+        if '-daemon' in sys.argv:
+            run_daemon_child()
+        run_child()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-runs', type=int, default=5)
+    parser.add_argument('-virsh-latency', type=float, default=20, help='Extra latency of every virsh call in milliseconds')
+    parser.add_argument('-start-delay', type=float, default=1, help='Seconds between virsh start and the domain running')
+    parser.add_argument('-ready-delay', type=float, default=0.5, help='Seconds between /execute and the guest calling /ready')
+    parser.add_argument('-hibernate', type=int, default=0, help='Number of other running domains to hibernate first')
+    parser.add_argument('-hibernate-delay', type=float, default=1, help='Seconds a domain takes to hibernate')
+    parser.add_argument('-usb-devices', type=int, default=2)
+    parser.add_argument('-cold', action='store_true', help='Drop the guest IP cache before every run')
+    parser.add_argument('-timeout', type=float, default=120)
+    parser.add_argument('-daemon', action='store_true', help='Launch through a warm harmonyd instead of a fresh process per run')
+    parser.add_argument('-keep', action='store_true', help='Keep the scratch directory for inspection')
+    parser.add_argument('-json', type=str, help='Write the summary to this file')
+    options = parser.parse_args()
+
+    summary = summarise(run_benchmark(options))
+    print(json.dumps(summary, indent=4))
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(summary, f, indent=4)
+    sys.exit(0 if summary else 1)
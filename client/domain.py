@@ -0,0 +1,397 @@
+import asyncio
+import os
+import re
+import subprocess
+import threading
+import time
+
+from domain_xml import HarmonyDomainDescription
+from logger import Logger
+
+try:
+    import libvirt
+except ImportError:
+    libvirt = None
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+STATE_RUNNING = 'running'
+STATE_PAUSED = 'paused'
+STATE_STOPPED = 'stopped'
+
+# Domain state service backed by one persistent libvirt connection. The connection URI follows libvirt's own
+# resolution (LIBVIRT_DEFAULT_URI, then the user's default), so `test:///default` can be used for testing.
+# When libvirt-python is missing, or HARMONY_DOMAIN_BACKEND=virsh is set, it falls back to polling `virsh`.
+class HarmonyClientDomain():
+    def __init__(self, uri=None, backend=None):
+        self.uri = uri
+        self.backend = backend or os.environ.get('HARMONY_DOMAIN_BACKEND') or ('libvirt' if libvirt else 'virsh')
+        if self.backend == 'libvirt' and not libvirt:
+            logger.log_to_file('[HarmonyClientDomain] [Warning] libvirt-python is not installed, falling back to virsh.')
+            self.backend = 'virsh'
+
+        self.conn = None
+        self.states = {}
+        self.listeners = []
+        # Parsed descriptions by domain, reused until the domain's generation moves on
+        self.generations = {}
+        self.descriptions = {}
+        self.condition = threading.Condition()
+        self.poll_interval = 0.5
+
+        if self.backend == 'libvirt':
+            try:
+                self.connect()
+            except libvirt.libvirtError as e:
+                # libvirtd is unreachable, virsh reports the same errors per call instead of failing the whole launch
+                logger.log_to_file(f'[HarmonyClientDomain] [Error] Failed to connect to libvirt, falling back to virsh: {e}')
+                self.conn = None
+                self.backend = 'virsh'
+
+    def connect(self):
+        start_libvirt_event_loop()
+        self.conn = libvirt.open(self.uri)
+        try:
+            self.conn.setKeepAlive(5, 3)
+        except libvirt.libvirtError:
+            pass # Only remote connections have keepalives, the test driver has none
+        self.conn.registerCloseCallback(self.on_close, None)
+        self.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.on_lifecycle_event, None)
+        self.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED, self.on_device_event, None)
+        self.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED, self.on_device_event, None)
+        with self.condition:
+            self.states = {dom.name(): libvirt_state(dom.state()[0]) for dom in self.conn.listAllDomains()}
+            self.condition.notify_all()
+        logger.log_to_file(f'[HarmonyClientDomain] [Info] Connected to libvirt at {self.conn.getURI()}, tracking {len(self.states)} domains.')
+
+    def on_close(self, conn, reason, opaque):
+        logger.log_to_file(f'[HarmonyClientDomain] [Warning] libvirt connection closed (reason {reason}), reconnecting...')
+        self.conn = None
+        threading.Thread(target=self.reconnect, daemon=True).start()
+
+    def reconnect(self):
+        while self.conn is None:
+            try:
+                self.connect()
+            except libvirt.libvirtError as e:
+                logger.log_to_file(f'[HarmonyClientDomain] [Error] Failed to reconnect to libvirt: {e}')
+                time.sleep(1)
+
+    def on_lifecycle_event(self, conn, dom, event, detail, opaque):
+        name = dom.name()
+        self.bump_generation(name)
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            state = None
+        elif event in (libvirt.VIR_DOMAIN_EVENT_STARTED, libvirt.VIR_DOMAIN_EVENT_RESUMED):
+            state = STATE_RUNNING
+        elif event in (libvirt.VIR_DOMAIN_EVENT_SUSPENDED, libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED):
+            state = STATE_PAUSED
+        elif event in (libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_CRASHED):
+            state = STATE_STOPPED
+        elif event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
+            state = self.states.get(name, STATE_STOPPED)
+        else:
+            # SHUTDOWN only announces that the guest is going down, STOPPED follows once it is off
+            return
+        self.set_state(name, state)
+
+    def on_device_event(self, conn, dom, dev_alias, opaque):
+        self.bump_generation(dom.name())
+
+    def set_state(self, name, state):
+        with self.condition:
+            previous = self.states.get(name)
+            if state is None:
+                self.states.pop(name, None)
+            else:
+                self.states[name] = state
+            self.condition.notify_all()
+        if previous != state:
+            self.bump_generation(name)
+            logger.log_to_file(f'[HarmonyClientDomain] [Info] Domain {name} changed state: {previous} -> {state}')
+            for listener in list(self.listeners):
+                try:
+                    listener(name, state)
+                except Exception as e:
+                    logger.log_to_file(f'[HarmonyClientDomain] [Error] Domain state listener failed: {e}')
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def poll_states(self):
+        # One call lists both running and paused domains, as " Id   Name   State" rows under a header
+        output = subprocess.check_output(['virsh', 'list', '--state-running', '--state-paused']).decode('utf-8').splitlines()
+        active = {}
+        for line in output[2:]:
+            columns = line.split()
+            if len(columns) >= 3:
+                active[columns[1]] = STATE_PAUSED if columns[2] == 'paused' else STATE_RUNNING
+        for name in set(self.states) | set(active):
+            self.set_state(name, active.get(name, STATE_STOPPED))
+        return [name for name, state in active.items() if state == STATE_RUNNING]
+
+    def get_state(self, vm_name):
+        if self.backend == 'virsh':
+            self.poll_states()
+        with self.condition:
+            return self.states.get(vm_name)
+
+    def get_running_vms(self):
+        if self.backend == 'virsh':
+            return self.poll_states()
+        with self.condition:
+            return [name for name, state in self.states.items() if state == STATE_RUNNING]
+
+    def is_vm_running(self, vm_name):
+        return self.get_state(vm_name) == STATE_RUNNING
+
+    def wait_for_state(self, vm_name, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        if self.backend == 'virsh':
+            while not predicate(self.get_state(vm_name)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                time.sleep(min(self.poll_interval, remaining))
+            return True
+        with self.condition:
+            return self.condition.wait_for(lambda: predicate(self.states.get(vm_name)), timeout=max(0, deadline - time.monotonic()))
+
+    def wait_until_running(self, vm_name, timeout=500):
+        return self.wait_for_state(vm_name, lambda state: state == STATE_RUNNING, timeout)
+
+    def wait_until_stopped(self, vm_name, timeout=500):
+        return self.wait_for_state(vm_name, is_stopped, timeout)
+
+    async def wait_for_state_async(self, vm_name, predicate, timeout):
+        if self.backend == 'virsh':
+            return await asyncio.to_thread(self.wait_for_state, vm_name, predicate, timeout)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def on_state(name, state):
+            if name == vm_name and predicate(state):
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        self.add_listener(on_state)
+        try:
+            if predicate(self.get_state(vm_name)):
+                return True
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.remove_listener(on_state)
+
+    async def wait_until_running_async(self, vm_name, timeout=500):
+        return await self.wait_for_state_async(vm_name, lambda state: state == STATE_RUNNING, timeout)
+
+    async def wait_until_stopped_async(self, vm_name, timeout=500):
+        return await self.wait_for_state_async(vm_name, is_stopped, timeout)
+
+    def lookup(self, vm_name):
+        return self.conn.lookupByName(vm_name)
+
+    # Returns None on success and the error message otherwise
+    def start(self, vm_name):
+        if self.backend == 'virsh':
+            process = subprocess.run(['virsh', 'start', vm_name])
+            return f'virsh start exited with {process.returncode}' if process.returncode != 0 else None
+        try:
+            self.lookup(vm_name).create()
+        except libvirt.libvirtError as e:
+            logger.log_to_file(f'[HarmonyClientDomain] [Error] Failed to start domain {vm_name}: {e}')
+            return str(e)
+        return None
+
+    # Pauses the vCPUs, the domain keeps its memory and resumes instantly
+    def suspend(self, vm_name):
+        return self.run_domain_command('suspend', vm_name, lambda dom: dom.suspend())
+
+    def resume(self, vm_name):
+        return self.run_domain_command('resume', vm_name, lambda dom: dom.resume())
+
+    # Saves the memory to disk and stops the domain, the next start restores it running
+    def managed_save(self, vm_name):
+        return self.run_domain_command('managedsave', vm_name, lambda dom: dom.managedSave(libvirt.VIR_DOMAIN_SAVE_RUNNING), ['--running'])
+
+    # Discards the saved memory, the next start boots the domain cold
+    def managed_save_remove(self, vm_name):
+        return self.run_domain_command('managedsave-remove', vm_name, lambda dom: dom.managedSaveRemove(0))
+
+    def has_managed_save(self, vm_name):
+        if self.backend == 'virsh':
+            try:
+                output = subprocess.check_output(['virsh', 'dominfo', vm_name], text=True, stderr=subprocess.DEVNULL)
+            except subprocess.CalledProcessError:
+                return False
+            return re.search(r'^Managed save:\s+yes', output, re.MULTILINE) is not None
+        try:
+            return bool(self.lookup(vm_name).hasManagedSaveImage(0))
+        except libvirt.libvirtError:
+            return False
+
+    # Returns None on success and the error message otherwise
+    def run_domain_command(self, command, vm_name, action, virsh_args=None):
+        try:
+            if self.backend == 'virsh':
+                process = subprocess.run(['virsh', command, vm_name] + (virsh_args or []), text=True, capture_output=True)
+                if process.returncode != 0:
+                    return process.stderr.strip() or f'virsh {command} exited with {process.returncode}'
+                return None
+            try:
+                action(self.lookup(vm_name))
+            except libvirt.libvirtError as e:
+                return str(e)
+            return None
+        finally:
+            self.bump_generation(vm_name)
+
+    def get_uuid(self, vm_name):
+        if self.backend == 'virsh':
+            return subprocess.check_output(['virsh', 'domuuid', vm_name], text=True).strip()
+        return self.lookup(vm_name).UUIDString()
+
+    def get_xml(self, vm_name):
+        if self.backend == 'virsh':
+            return subprocess.check_output(['virsh', 'dumpxml', vm_name], text=True)
+        return self.lookup(vm_name).XMLDesc()
+
+    # Every change to a domain's definition or state moves its generation on. libvirt reports them as events, the
+    # virsh backend only sees its own changes and the state changes it polls.
+    def bump_generation(self, vm_name):
+        with self.condition:
+            self.generations[vm_name] = self.generations.get(vm_name, 0) + 1
+
+    def get_description(self, vm_name):
+        with self.condition:
+            generation = self.generations.get(vm_name, 0)
+            cached = self.descriptions.get(vm_name)
+        if cached and cached[0] == generation:
+            return cached[1]
+        description = HarmonyDomainDescription(self.get_xml(vm_name))
+        with self.condition:
+            self.descriptions[vm_name] = (generation, description)
+        return description
+
+    def define_description(self, vm_name, description):
+        xml = description.to_xml()
+        try:
+            if self.backend == 'virsh':
+                process = subprocess.run(['virsh', 'define', '/dev/stdin'], input=xml, text=True, capture_output=True)
+                if process.returncode != 0:
+                    return process.stderr.strip() or f'virsh define exited with {process.returncode}'
+                return None
+            try:
+                self.conn.defineXML(xml)
+            except libvirt.libvirtError as e:
+                return str(e)
+            return None
+        finally:
+            self.bump_generation(vm_name)
+
+    def attach_device(self, vm_name, xml):
+        return self.update_device('attach-device', vm_name, xml)
+
+    def detach_device(self, vm_name, xml):
+        return self.update_device('detach-device', vm_name, xml)
+
+    # Changes both the persistent definition and, while the domain runs, the live one like `virsh --persistent`.
+    # Returns None on success and the error message otherwise, so that batches can report every device.
+    def update_device(self, command, vm_name, xml):
+        try:
+            if self.backend == 'virsh':
+                process = subprocess.run(['virsh', command, vm_name, '/dev/stdin', '--persistent'], input=xml, text=True, capture_output=True)
+                if process.returncode != 0:
+                    return process.stderr.strip() or f'virsh {command} exited with {process.returncode}'
+                return None
+            try:
+                dom = self.lookup(vm_name)
+                flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+                if dom.isActive():
+                    flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+                if command == 'attach-device':
+                    dom.attachDeviceFlags(xml, flags)
+                else:
+                    dom.detachDeviceFlags(xml, flags)
+            except libvirt.libvirtError as e:
+                return str(e)
+            return None
+        finally:
+            self.bump_generation(vm_name)
+
+    def get_macs(self, vm_name):
+        if self.backend == 'virsh':
+            output = subprocess.check_output(['virsh', 'domiflist', vm_name], text=True)
+            return re.findall(r'([0-9a-f]{2}(?::[0-9a-f]{2}){5})', output.lower())
+        return list(self.get_description(vm_name).macs)
+
+    def get_agent_addresses(self, vm_name):
+        return self.get_interface_addresses(vm_name, 'agent')
+
+    # The DHCP leases libvirt's own networks handed out, what a plain `virsh domifaddr` reports
+    def get_lease_addresses(self, vm_name):
+        return self.get_interface_addresses(vm_name, 'lease')
+
+    # (mac, IPv4 address) pairs of the domain's interfaces from the given source, empty when it has none yet
+    def get_interface_addresses(self, vm_name, source):
+        if self.backend == 'virsh':
+            # The lease source is domifaddr's default
+            source_args = ['--source', source] if source != 'lease' else []
+            output = subprocess.run(['virsh', 'domifaddr', vm_name] + source_args, text=True, capture_output=True).stdout
+            return re.findall(r'([0-9a-f]{2}(?::[0-9a-f]{2}){5})\s+ipv4\s+(\d{1,3}(?:\.\d{1,3}){3})', output.lower())
+        sources = {'agent': libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT, 'lease': libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE}
+        try:
+            interfaces = self.lookup(vm_name).interfaceAddresses(sources[source])
+        except libvirt.libvirtError:
+            return []
+        addresses = []
+        for interface in interfaces.values():
+            for address in interface.get('addrs') or []:
+                if address['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4 and interface.get('hwaddr'):
+                    addresses.append((interface['hwaddr'].lower(), address['addr']))
+        return addresses
+
+# A paused domain still holds its memory and devices, only a shut off (or undefined) one has let go of them
+def is_stopped(state):
+    return state in (STATE_STOPPED, None)
+
+def libvirt_state(state):
+    if state in (libvirt.VIR_DOMAIN_SHUTOFF, libvirt.VIR_DOMAIN_CRASHED):
+        return STATE_STOPPED
+    if state in (libvirt.VIR_DOMAIN_PAUSED, libvirt.VIR_DOMAIN_PMSUSPENDED):
+        return STATE_PAUSED
+    # Blocked and shutting down domains are still active
+    return STATE_RUNNING
+
+event_loop_thread = None
+event_loop_lock = threading.Lock()
+
+def run_libvirt_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+def start_libvirt_event_loop():
+    global event_loop_thread
+    with event_loop_lock:
+        if event_loop_thread is None:
+            libvirt.virEventRegisterDefaultImpl()
+            event_loop_thread = threading.Thread(target=run_libvirt_event_loop, name='libvirt-events', daemon=True)
+            event_loop_thread.start()
+
+harmony_domain = None
+harmony_domain_lock = threading.Lock()
+
+# Process-wide domain service shared by every HarmonyClientCommon
+def get_harmony_domain():
+    global harmony_domain
+    with harmony_domain_lock:
+        if harmony_domain is None:
+            harmony_domain = HarmonyClientDomain()
+        return harmony_domain
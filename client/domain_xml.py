@@ -0,0 +1,93 @@
+import copy
+
+from xml.etree import ElementTree
+
+MEMORY_UNITS = {
+    'b': 1, 'bytes': 1,
+    'kb': 1000, 'k': 1024, 'kib': 1024,
+    'mb': 1000 ** 2, 'm': 1024 ** 2, 'mib': 1024 ** 2,
+    'gb': 1000 ** 3, 'g': 1024 ** 3, 'gib': 1024 ** 3,
+    'tb': 1000 ** 4, 't': 1024 ** 4, 'tib': 1024 ** 4,
+}
+
+def parse_memory_kib(element):
+    if element is None or not (element.text or '').strip():
+        return None
+    unit = MEMORY_UNITS.get((element.get('unit') or 'KiB').lower(), 1024)
+    return int(element.text.strip()) * unit // 1024
+
+def parse_usb_id(element):
+    value = element.get('id', '') if element is not None else ''
+    return value.lower().removeprefix('0x').zfill(4) if value else ''
+
+def is_usb_hostdev(element):
+    return element.get('mode', 'subsystem') == 'subsystem' and element.get('type') == 'usb'
+
+def is_pci_hostdev(element):
+    return element.get('mode', 'subsystem') == 'subsystem' and element.get('type') == 'pci'
+
+# A domain's XML description parsed once into the parts Harmony reads: USB and PCI host devices, memory backing,
+# vCPU pinning and the network MACs. Quoting and attribute order don't matter as they did for the old regexes.
+# Descriptions may be cached and shared, so edits are made on a copy from edit() and then defined.
+class HarmonyDomainDescription():
+    def __init__(self, xml):
+        self.root = ElementTree.fromstring(xml) if isinstance(xml, str) else xml
+        self.parse()
+
+    def parse(self):
+        root = self.root
+        self.name = root.findtext('name')
+        self.uuid = root.findtext('uuid')
+        self.memory_kib = parse_memory_kib(root.find('memory'))
+        self.current_memory_kib = parse_memory_kib(root.find('currentMemory'))
+
+        backing = root.find('memoryBacking')
+        self.memory_backing = {
+            'hugepages': backing is not None and backing.find('hugepages') is not None,
+            'source': backing.find('source').get('type') if backing is not None and backing.find('source') is not None else None,
+            'access': backing.find('access').get('mode') if backing is not None and backing.find('access') is not None else None,
+            'locked': backing is not None and backing.find('locked') is not None,
+            'nosharepages': backing is not None and backing.find('nosharepages') is not None,
+        }
+
+        vcpu = root.find('vcpu')
+        self.vcpus = int(vcpu.text.strip()) if vcpu is not None and (vcpu.text or '').strip() else None
+        self.vcpu_pins = {int(pin.get('vcpu')): pin.get('cpuset') for pin in root.findall('./cputune/vcpupin') if pin.get('vcpu', '').isdigit()}
+        emulator_pin = root.find('./cputune/emulatorpin')
+        self.emulator_pin = emulator_pin.get('cpuset') if emulator_pin is not None else None
+
+        self.usb_hostdevs = []
+        self.pci_hostdevs = []
+        for hostdev in root.findall('./devices/hostdev'):
+            if is_usb_hostdev(hostdev):
+                address = hostdev.find('./source/address')
+                self.usb_hostdevs.append({
+                    'vendor_id': parse_usb_id(hostdev.find('./source/vendor')),
+                    'product_id': parse_usb_id(hostdev.find('./source/product')),
+                    'bus': address.get('bus') if address is not None else None,
+                    'device': address.get('device') if address is not None else None,
+                })
+            elif is_pci_hostdev(hostdev):
+                address = hostdev.find('./source/address')
+                if address is not None:
+                    values = [int(address.get(name, '0'), 0) for name in ('domain', 'bus', 'slot', 'function')]
+                    self.pci_hostdevs.append({'address': '{:04x}:{:02x}:{:02x}.{:x}'.format(*values), 'managed': hostdev.get('managed') == 'yes'})
+
+        self.macs = [mac.get('address').lower() for mac in root.findall('./devices/interface/mac') if mac.get('address')]
+
+    def edit(self):
+        return HarmonyDomainDescription(copy.deepcopy(self.root))
+
+    def remove_usb_hostdevs(self):
+        devices = self.root.find('devices')
+        removed = 0
+        if devices is not None:
+            for hostdev in devices.findall('hostdev'):
+                if is_usb_hostdev(hostdev):
+                    devices.remove(hostdev)
+                    removed += 1
+        self.parse()
+        return removed
+
+    def to_xml(self):
+        return ElementTree.tostring(self.root, encoding='unicode')
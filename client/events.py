@@ -0,0 +1,196 @@
+import json
+import os
+import requests
+import threading
+
+from logger import Logger
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+# Splash labels for the milestones the guest publishes while an app starts
+MILESTONE_PROGRESS = {
+    'received': 'STARTING APP...',
+    'process found': 'WAITING FOR WINDOW...',
+    'window found': 'WAITING...',
+    'eac detected': 'WAITING FOR EASY ANTI-CHEAT...',
+    'foregrounded': 'LAUNCHING...',
+}
+
+# Statuses of a guest job that will not change again
+JOB_FINISHED = ('exited', 'failed')
+
+# Follows the server-sent event stream of one launch on the guest listener. Dropped connections are resumed with
+# Last-Event-ID, so every milestone is delivered exactly once even if the guest or the network hiccups.
+class HarmonyGuestEvents():
+    def __init__(self, http, url, launch_id, on_event, heartbeat_timeout=30, max_backoff=5):
+        self.http = http
+        self.url = url
+        self.launch_id = launch_id
+        self.on_event = on_event
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_backoff = max_backoff
+        self.last_id = 0
+        self.stop_event = threading.Event()
+        self.response = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'guest-events-{self.launch_id[:8]}')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        response = self.response
+        if response is not None:
+            response.close()
+
+    def run(self):
+        # Its own connection, a stream held open for the whole launch must not take one from the shared pool
+        session = self.http.new_stream_session(self.url)
+        try:
+            self.follow(session)
+        finally:
+            session.close()
+
+    def follow(self, session):
+        backoff = 0.25
+        while not self.stop_event.is_set():
+            headers = {'Accept': 'text/event-stream'}
+            if self.last_id:
+                headers['Last-Event-ID'] = str(self.last_id)
+            try:
+                self.http.count('requests')
+                with session.get(self.url, params={'launch': self.launch_id}, headers=headers, stream=True, timeout=(5, self.heartbeat_timeout)) as response:
+                    self.response = response
+                    response.raise_for_status()
+                    backoff = 0.25
+                    if self.read_stream(response):
+                        return
+            except (requests.exceptions.RequestException, ValueError) as e:
+                if self.stop_event.is_set():
+                    return
+                logger.log_to_file(f'[HarmonyGuestEvents] [Error] Event stream for launch {self.launch_id} interrupted, resuming after event {self.last_id}: {e}')
+            except (AttributeError, OSError):
+                # stop() closed the response under the reader, its file object is gone
+                if self.stop_event.is_set():
+                    return
+                raise
+            finally:
+                self.response = None
+            self.stop_event.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    # Returns True once a terminal milestone has been delivered
+    def read_stream(self, response):
+        data = []
+        event_id = None
+        for line in response.iter_lines(decode_unicode=True):
+            if self.stop_event.is_set():
+                return True
+            if line:
+                field, _, value = line.partition(':')
+                value = value[1:] if value.startswith(' ') else value
+                if field == 'id':
+                    event_id = value
+                elif field == 'data':
+                    data.append(value)
+                continue
+            if not data:
+                event_id = None
+                continue
+            event = json.loads('\n'.join(data))
+            if event_id:
+                self.last_id = int(event_id)
+            # Both buffers belong to one event, the next one carries its own id or none
+            data = []
+            event_id = None
+            if self.on_event(event):
+                return True
+        return False
+
+# Follows the guest job running app.py with long polls on /jobs/<id>, so a command that fails or exits before the
+# app is ready ends the wait right away instead of at the ready timeout. on_change gets every new version of the
+# job and returns True to stop following.
+class HarmonyGuestJob():
+    def __init__(self, http, base_url, job_id, on_change, wait=10, max_backoff=5):
+        self.http = http
+        self.url = f'{base_url}/jobs/{job_id}'
+        self.job_id = job_id
+        self.on_change = on_change
+        self.wait = wait
+        self.max_backoff = max_backoff
+        self.version = 0
+        self.job = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'guest-job-{self.job_id[:8]}')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # A poll in flight ends on its own within wait seconds, its answer is then ignored
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        session = self.http.new_stream_session(self.url)
+        try:
+            self.follow(session)
+        finally:
+            session.close()
+
+    def follow(self, session):
+        backoff = 0.25
+        while not self.stop_event.is_set():
+            try:
+                self.http.count('requests')
+                response = session.get(self.url, params={'version': self.version, 'wait': self.wait}, timeout=(5, self.wait + 5))
+                if response.status_code == 404:
+                    return # Pruned, or a guest without jobs
+                response.raise_for_status()
+                job = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                if self.stop_event.is_set():
+                    return
+                logger.log_to_file(f'[HarmonyGuestJob] [Error] Long poll of guest job {self.job_id} failed: {e}')
+                self.stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            if self.stop_event.is_set():
+                return
+            if job['version'] > self.version:
+                self.version = job['version']
+                self.job = job
+                backoff = 0.25
+                if self.on_change(job) or job['status'] in JOB_FINISHED:
+                    return
+            else:
+                # Unchanged after the whole wait, or a guest that answers at once, either way there is no hurry
+                self.stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+# Id of the job the guest created for an /execute, None for older guests that answer with plain text
+def get_guest_job_id(response):
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    return body.get('job') if isinstance(body, dict) else None
+
+# Status, exit code and output of a guest job. With wait, the guest holds the request until the job has changed
+# past version or finished.
+def get_guest_job(http, base_url, job_id, version=0, wait=0):
+    try:
+        response = http.get(f'{base_url}/jobs/{job_id}', params={'version': version, 'wait': wait}, retries=1, timeout=wait + 5, deadline=wait + 10)
+    except requests.exceptions.RequestException as e:
+        logger.log_to_file(f'[HarmonyGuestEvents] [Error] Failed to get guest job {job_id}: {e}')
+        return None
+    if response.status_code != 200:
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        return None
@@ -0,0 +1,261 @@
+import os
+import socketserver
+import sys
+import threading
+
+from common import HarmonyClientCommon, get_harmony_resolver
+from instance import HarmonyInstanceLock
+from ipc import get_socket_path, read_message, send_message
+from launch import HarmonyClient
+from listener import HarmonyClientListener, start_harmony_listener
+from logger import Logger
+from power import get_harmony_power
+from registry import get_harmony_registry, load_harmony_config
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+# Stands in for the splash window while a launch is prepared, progress is sent to the thin client instead
+class HarmonyDaemonProgress():
+    def __init__(self, session):
+        self.session = session
+
+    def update_label(self, message):
+        self.session.send({'event': 'progress', 'message': message})
+
+# A single launch requested by `app.py`. The connection stays open for the whole launch: the daemon streams
+# progress and the Looking Glass command, the thin client sends cancel and reports when Looking Glass exits.
+class HarmonyDaemonSession():
+    def __init__(self, app, rfile, wfile):
+        self.app = app
+        self.rfile = rfile
+        self.wfile = wfile
+        self.client = None
+        self.send_lock = threading.Lock()
+        self.disconnected = False
+        self.cancelled = False
+        self.ready = False
+        self.finished = False
+        self.returncode = None
+        self.lg_exited = threading.Event()
+
+    def send(self, message):
+        with self.send_lock:
+            if self.disconnected:
+                return False
+            try:
+                send_message(self.wfile, message)
+                return True
+            except OSError:
+                self.disconnected = True
+                return False
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        logger.log_to_file(f'[HarmonyDaemonSession] [Info] Cancelling the launch of {self.app}...')
+        if self.client:
+            try:
+                self.client.cancel()
+            except SystemExit:
+                logger.log_to_file(f'[HarmonyDaemonSession] [Error] Failed to cancel the launch of {self.app}.')
+
+    def read_commands(self):
+        while True:
+            try:
+                message = read_message(self.rfile)
+            except (OSError, ValueError):
+                message = None
+            if message is None:
+                # The thin client went away, either while the launch was prepared or while Looking Glass ran
+                self.disconnected = True
+                if not self.ready and not self.finished:
+                    self.cancel()
+                self.lg_exited.set()
+                return
+            command = message.get('command')
+            if command == 'cancel':
+                self.cancel()
+            elif command == 'lg_exited':
+                self.returncode = message.get('returncode')
+                self.lg_exited.set()
+
+class HarmonyDaemon():
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or get_socket_path()
+        self.config_file = os.path.join(current_path, 'harmony.json')
+        self.config_stamp = None
+        self.harmony_config = None
+        self.launch_lock = threading.Lock()
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.listener = HarmonyClientListener(__name__)
+        self.listener.terminate_handler = self.on_terminate
+        self.server = None
+
+    def load_config(self):
+        stat = os.stat(self.config_file)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp != self.config_stamp:
+            self.harmony_config = load_harmony_config(self.config_file)
+            self.config_stamp = stamp
+            logger.log_to_file(f'[HarmonyDaemon] [Info] Loaded {self.config_file}')
+        return self.harmony_config
+
+    # Everything a launch would otherwise set up from scratch is created once here and kept warm
+    def warm_up(self):
+        harmony_config = self.load_config()
+        common = HarmonyClientCommon()
+        get_harmony_resolver()
+        get_harmony_registry()
+        # Idle domains are only tracked while a process outlives the launches, which is the daemon
+        get_harmony_power(harmony_config).start()
+        logger.log_to_file(f'[HarmonyDaemon] [Info] Connected to the hypervisor, {len(common.get_running_vms())} domains running.')
+
+        listener_thread = threading.Thread(target=start_harmony_listener, args=(self.listener, harmony_config.get('port', 5000)))
+        listener_thread.daemon = True
+        listener_thread.start()
+
+    def on_terminate(self, ip_address):
+        # The listener already killed Looking Glass, the thin clients report the exit themselves
+        logger.log_to_file(f'[HarmonyDaemon] [Info] Host {ip_address} sent terminate.')
+
+    def get_status(self):
+        with self.sessions_lock:
+            sessions = sorted(self.sessions)
+        return {'pid': os.getpid(), 'sessions': sessions, 'power': get_harmony_power().get_status()}
+
+    def launch(self, app, rfile, wfile):
+        session = HarmonyDaemonSession(app, rfile, wfile)
+        registry = get_harmony_registry()
+        registry.refresh()
+        app_config = registry.get(app)
+        if not app_config:
+            logger.log_to_file(f'[HarmonyDaemon] [Error] Configuration file for {app} not found.')
+            session.send({'event': 'error', 'message': f'Configuration file for {app} not found.'})
+            return
+
+        session.client = HarmonyClient(app_config, self.load_config(), self.listener)
+        with self.sessions_lock:
+            current = self.sessions.get(app)
+            if current is not None and not current.finished:
+                # A second launch of the same app is coalesced into the one already in progress
+                state = 'running' if current.ready else 'being launched'
+                logger.log_to_file(f'[HarmonyDaemon] [Info] {app} is already {state}.')
+                session.send({'event': 'error', 'message': f'{app} is already {state}.'})
+                return
+            # The newest launch wins, like the user clicking another app while the previous one is starting
+            superseded = [other for other in self.sessions.values() if not other.ready and not other.finished]
+            self.sessions[app] = session
+        for other in superseded:
+            logger.log_to_file(f'[HarmonyDaemon] [Info] Launch of {session.app} supersedes {other.app}.')
+            threading.Thread(target=other.cancel, daemon=True).start()
+
+        power = get_harmony_power()
+        power.mark_busy(app_config.vm)
+        reader_thread = threading.Thread(target=session.read_commands)
+        reader_thread.daemon = True
+        reader_thread.start()
+        try:
+            self.run_session(session, app_config)
+        finally:
+            session.finished = True
+            with self.sessions_lock:
+                if self.sessions.get(app) is session:
+                    del self.sessions[app]
+                in_use = any(other.client.app_vm == app_config.vm for other in self.sessions.values())
+            if not in_use and session.client.common.is_vm_running(app_config.vm):
+                power.mark_idle(app_config.vm)
+
+    def run_session(self, session, app_config):
+        client = session.client
+
+        # Launches are prepared one at a time, they hibernate each other's domains and share the splash progress
+        ready = False
+        with self.launch_lock:
+            if session.cancelled:
+                session.send({'event': 'error', 'message': 'Launch cancelled.'})
+                return
+            logger.log_to_file(f'[HarmonyDaemon] [Info] Launching {session.app}...')
+            Logger.window = HarmonyDaemonProgress(session)
+            try:
+                # Waits for the guest as long as app.py does, a slow anti-cheat or game start is not a failure
+                ready = client.prepare()
+            except (Exception, SystemExit) as e:
+                logger.log_to_file(f'[HarmonyDaemon] [Error] Launch of {session.app} failed: {e!r}')
+            finally:
+                Logger.window = None
+
+        if not ready:
+            message = 'Launch cancelled.' if session.cancelled else 'Launch failed.'
+            session.send({'event': 'error', 'message': message})
+            return
+
+        session.ready = True
+        # The launch lock is released, another launch may have replaced the global timeline by now
+        timeline = client.timeline
+        lg_start = timeline.now()
+        session.send({'event': 'ready', 'lg_command': client.lg_command or client.prepare_lg_command(), 'env': client.get_lg_environment()})
+        timeline.save()
+
+        usb_monitor_thread = client.start_usb_monitor()
+        session.lg_exited.wait()
+        timeline.add_span('looking glass', lg_start, timeline.now(), 'lg', args={'returncode': session.returncode})
+        timeline.save()
+
+        client.stop_usb_monitor(usb_monitor_thread)
+        try:
+            client.finish_lg(session.returncode)
+        except SystemExit:
+            logger.log_to_file(f'[HarmonyDaemon] [Error] Failed to clean up after {session.app}.')
+        session.send({'event': 'done'})
+
+    def serve(self):
+        socket_dir = os.path.dirname(self.socket_path)
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self.server = HarmonyDaemonServer(self.socket_path, HarmonyDaemonHandler)
+        self.server.harmony_daemon = self
+        os.chmod(self.socket_path, 0o600)
+        logger.log_to_file(f'[HarmonyDaemon] [Info] Listening on {self.socket_path}')
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+class HarmonyDaemonServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+class HarmonyDaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            message = read_message(self.rfile)
+        except ValueError:
+            return
+        if not message:
+            return
+
+        harmony_daemon = self.server.harmony_daemon
+        command = message.get('command')
+        if command == 'launch':
+            harmony_daemon.launch(message.get('app'), self.rfile, self.wfile)
+        elif command == 'status':
+            send_message(self.wfile, {'event': 'status', **harmony_daemon.get_status()})
+        else:
+            send_message(self.wfile, {'event': 'error', 'message': f'Unknown command: {command}'})
+
+if __name__ == '__main__':
+    # Held for the life of the process, a stale socket file left by a crashed daemon is then safe to replace
+    instance_lock = HarmonyInstanceLock('harmonyd')
+    if not instance_lock.acquire():
+        logger.log_to_file(f'[HarmonyDaemon] [Info] harmonyd is already running.')
+        sys.exit(0)
+
+    harmony_daemon = HarmonyDaemon()
+    harmony_daemon.warm_up()
+    harmony_daemon.serve()
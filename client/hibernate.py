@@ -6,52 +6,116 @@ import requests
 import subprocess
 import sys
 import time
+import uuid
 
 from common import HarmonyClientCommon
+from concurrent.futures import ThreadPoolExecutor, wait
 from logger import Logger
+from timeline import get_harmony_timeline
 
 current_path = os.path.dirname(os.path.realpath(__file__))
 logger = Logger(os.path.join(current_path, 'hibernate.log'))
 
+# The hibernate command never reached the guest
+class HarmonyHibernateError(Exception):
+    pass
+
 class HarmonyClientHibernate():
     def __init__(self):
         self.common = HarmonyClientCommon()
 
-    def hibernate_vm(self, vm_name):
+    # Returns None once the guest has queued the command, and the reason otherwise
+    def send_hibernate(self, vm_name, timeout=500):
         logger.log_to_file(f'[HarmonyClientHibernate] [Info] Sending the hibernate command to the target VM {vm_name}.')
-        ip_address = self.common.get_vm_ip(vm_name)
+        ip_address = self.common.get_vm_ip(vm_name, timeout)
         if not ip_address:
             logger.log_to_file(f'[HarmonyClientHibernate] [Error] No IP address found for the target VM {vm_name}.')
-            sys.exit(1)
+            return 'no IP address found'
         url = 'http://' + ip_address + ':5000/execute'
         try:
             #response = requests.post(url, data={'command': 'python hibernate.py'}, timeout=10)
-            response = self.common.requests_retry_session().post(url, data={'command': 'python.exe ../hibernate.py'}, timeout=10)
+            # One key per hibernate request, so the retries of a slow response don't queue a second hibernate
+            response = self.common.http.post(url, data={'command': 'python.exe ../hibernate.py', 'key': f'hibernate-{uuid.uuid4().hex}'}, retries=10, timeout=10, deadline=120)
             logger.log_to_file(f'[HarmonyClientHibernate] [Info] Hibernate VM {vm_name} response from server: {response.text}')
         except requests.exceptions.Timeout:
             logger.log_to_file(f'[HarmonyClientHibernate] [Error] Request timed out trying to hibernate VM {vm_name}')
-            sys.exit(1)
+            return 'the request timed out'
         except requests.exceptions.RequestException as e:
             logger.log_to_file(f'[HarmonyClientHibernate] [Error] Exception trying to hibernate VM {vm_name} ', e)
+            return f'the request failed: {e}'
+        if response.status_code >= 400:
+            # A full job queue answers 503 after the retries, nothing was queued then
+            return f'the guest answered {response.status_code}'
+        return None
+
+    def hibernate_vm(self, vm_name):
+        error = self.send_hibernate(vm_name)
+        if error:
+            logger.log_to_file(f'[HarmonyClientHibernate] [Error] Failed to hibernate VM {vm_name}: {error}')
             sys.exit(1)
 
     def wait_for_vm_hibernate(self, vm_name, timeout=500):
-        elapsed = 0
-        interval = 1
-        while self.common.is_vm_running(vm_name):
-            if elapsed >= timeout:
-                logger.log_to_file(f"[HarmonyClientHibernate] [Error] Timeout: VM {vm_name} did not hibernate in time.")
-                sys.exit(1)
-            logger.log_to_file(f"[HarmonyClientHibernate] [Info] Waiting for VM {vm_name} to hibernate...")
-            time.sleep(interval)
-            elapsed += interval
+        logger.log_to_file(f"[HarmonyClientHibernate] [Info] Waiting for VM {vm_name} to hibernate...")
+        if not self.common.domain.wait_until_stopped(vm_name, timeout):
+            logger.log_to_file(f"[HarmonyClientHibernate] [Error] Timeout: VM {vm_name} did not hibernate in time.")
+            sys.exit(1)
         logger.log_to_file(f"[HarmonyClientHibernate] [Info] VM {vm_name} has successfully hibernated.")
 
+    # Returns the seconds until the domain stopped, or None when it did not stop before the deadline. A command the
+    # guest never got raises HarmonyHibernateError instead, there is nothing to wait for then.
+    def hibernate_and_wait(self, vm_name, start, deadline):
+        timeline = get_harmony_timeline()
+        with timeline.span(f'hibernate {vm_name}', 'hibernate', track=vm_name):
+            with timeline.span('signal', 'hibernate', track=vm_name):
+                error = self.send_hibernate(vm_name, max(0, deadline - time.monotonic()))
+            if error:
+                raise HarmonyHibernateError(error)
+            if not self.common.domain.wait_until_stopped(vm_name, max(0, deadline - time.monotonic())):
+                return None
+        return time.monotonic() - start
+
+    def hibernate_vms(self, vm_names, timeout=500):
+        # Signal every domain at once and wait for all of them against one shared deadline
+        vm_names = list(vm_names)
+        if not vm_names:
+            return {}
+        start = time.monotonic()
+        deadline = start + timeout
+        logger.log_to_file(f"[HarmonyClientHibernate] [Info] Hibernating {', '.join(vm_names)}...")
+        executor = ThreadPoolExecutor(max_workers=len(vm_names), thread_name_prefix='hibernate')
+        futures = {executor.submit(self.hibernate_and_wait, vm_name, start, deadline): vm_name for vm_name in vm_names}
+        wait(futures, timeout=timeout)
+        executor.shutdown(wait=False)
+
+        completion_times = {}
+        stragglers = []
+        failures = {}
+        for future, vm_name in futures.items():
+            if not future.done():
+                stragglers.append(vm_name)
+                continue
+            try:
+                elapsed = future.result()
+            except HarmonyHibernateError as e:
+                failures[vm_name] = str(e)
+                continue
+            if elapsed is None:
+                stragglers.append(vm_name)
+            else:
+                completion_times[vm_name] = elapsed
+                logger.log_to_file(f"[HarmonyClientHibernate] [Info] VM {vm_name} hibernated after {elapsed:.2f} seconds.")
+        for vm_name, error in failures.items():
+            logger.log_to_file(f"[HarmonyClientHibernate] [Error] Failed to send the hibernate command to VM {vm_name}: {error}")
+        if stragglers:
+            logger.log_to_file(f"[HarmonyClientHibernate] [Error] Timeout: VMs {', '.join(stragglers)} did not hibernate within {timeout} seconds.")
+        if failures or stragglers:
+            sys.exit(1)
+        logger.log_to_file(f"[HarmonyClientHibernate] [Info] All VMs hibernated in {time.monotonic() - start:.2f} seconds.")
+        return completion_times
+
     def run(self):
         running_vms = self.common.get_running_vms()
-        for vm in running_vms:
-            self.hibernate_vm(vm)
-            self.wait_for_vm_hibernate(vm)
+        self.hibernate_vms(running_vms)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -0,0 +1,113 @@
+import os
+import requests
+import threading
+import time
+
+from logger import Logger
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+# Shared HTTP client with one keep-alive session per guest endpoint. Retries are not delegated to urllib3,
+# every operation gets one explicit retry count and deadline so that retries never stack.
+# host/http_pool.py is a copy for the guest: the host folder is installed on the Windows guest on its own and
+# cannot import from client/, so the two are kept in step by hand.
+class HarmonyClientHttp():
+    def __init__(self, pool_maxsize=4, backoff_factor=0.3, status_forcelist=(500, 502, 504)):
+        self.pool_maxsize = pool_maxsize
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'retries': 0, 'failures': 0}
+
+    def get_session(self, url):
+        parts = urlsplit(url)
+        endpoint = f'{parts.scheme}://{parts.netloc}'
+        with self.lock:
+            session = self.sessions.get(endpoint)
+            if session is None:
+                session = requests.Session()
+                # Not blocking on a full pool: a request beyond pool_maxsize opens a connection that is dropped
+                # afterwards instead of waiting, unbounded by its own timeout, for one to be returned
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, pool_block=False, max_retries=0)
+                session.mount(endpoint, adapter)
+                self.sessions[endpoint] = session
+            return session
+
+    # Event streams and long polls hold their connection for minutes, they get a session of their own rather than
+    # a connection of the shared pool. The caller closes it.
+    def new_stream_session(self, url):
+        parts = urlsplit(url)
+        session = requests.Session()
+        session.mount(f'{parts.scheme}://{parts.netloc}', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+        return session
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def request(self, method, url, retries=2, timeout=10, deadline=30, accept=None, **kwargs):
+        session = self.get_session(url)
+        deadline_time = time.monotonic() + deadline
+        attempt = 0
+        while True:
+            remaining = deadline_time - time.monotonic()
+            if remaining <= 0:
+                self.count('failures')
+                raise requests.exceptions.Timeout(f'Deadline of {deadline} seconds exceeded for {method} {url}')
+
+            response = None
+            error = None
+            self.count('requests')
+            try:
+                response = session.request(method, url, timeout=min(timeout, remaining), **kwargs)
+                if response.status_code not in self.status_forcelist and (accept is None or accept(response)):
+                    return response
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+
+            if attempt >= retries:
+                self.count('failures')
+                if response is not None:
+                    return response
+                raise error
+
+            attempt += 1
+            self.count('retries')
+            logger.log_to_file(f'[HarmonyClientHttp] [Info] Retrying {method} {url} ({attempt}/{retries}): {error or response.status_code}')
+            time.sleep(max(0, min(self.backoff_factor * (2 ** (attempt - 1)), deadline_time - time.monotonic())))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_stats(self):
+        connections = 0
+        pooled_requests = 0
+        with self.lock:
+            stats = dict(self.counters)
+            for session in self.sessions.values():
+                for adapter in session.adapters.values():
+                    pools = adapter.poolmanager.pools
+                    for key in pools.keys():
+                        pool = pools[key]
+                        connections += pool.num_connections
+                        pooled_requests += pool.num_requests
+        stats['connections'] = connections
+        stats['reused'] = max(0, pooled_requests - connections)
+        return stats
+
+harmony_http = None
+harmony_http_lock = threading.Lock()
+
+def get_harmony_http():
+    global harmony_http
+    with harmony_http_lock:
+        if harmony_http is None:
+            harmony_http = HarmonyClientHttp()
+        return harmony_http
@@ -0,0 +1,138 @@
+import json
+import os
+import sys
+import threading
+import time
+
+# Measures how long every module takes to import. Installed as the first meta path finder, it wraps the loader
+# of each module found by the other finders and times create_module and exec_module. Self time excludes nested
+# imports, cumulative time includes them.
+class HarmonyImportProfiler():
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.modules = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+        return self
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = HarmonyProfiledLoader(spec.loader, self)
+                return spec
+        return None
+
+    def enter(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append([time.perf_counter(), 0.0])
+
+    def leave(self, name):
+        start, nested = self.local.stack.pop()
+        elapsed = time.perf_counter() - start
+        if self.local.stack:
+            self.local.stack[-1][1] += elapsed
+        with self.lock:
+            entry = self.modules.setdefault(name, {'self': 0.0, 'cumulative': 0.0, 'thread': threading.current_thread().name})
+            entry['self'] += elapsed - nested
+            entry['cumulative'] += elapsed
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def get_top_modules(self, count=15):
+        with self.lock:
+            modules = sorted(self.modules.items(), key=lambda item: item[1]['self'], reverse=True)
+        return [{'module': name, 'self_ms': round(entry['self'] * 1000, 2), 'cumulative_ms': round(entry['cumulative'] * 1000, 2), 'thread': entry['thread']} for name, entry in modules[:count]]
+
+    def get_total(self, thread=None):
+        with self.lock:
+            return sum(entry['self'] for entry in self.modules.values() if thread is None or entry['thread'] == thread)
+
+    def report(self, milestone, logger, history_file=None, budget_ms=None, extra=None):
+        elapsed_ms = get_process_age() * 1000
+        record = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'milestone': milestone,
+            'elapsed_ms': round(elapsed_ms, 2),
+            'imports_ms': round(self.get_total() * 1000, 2),
+            'budget_ms': budget_ms,
+            'top': self.get_top_modules(),
+        }
+        if extra:
+            record.update(extra)
+        logger.log_to_file(f"[HarmonyImportProfiler] [Info] {milestone} after {record['elapsed_ms']:.0f} ms, {record['imports_ms']:.0f} ms spent importing {len(self.modules)} modules.")
+        for module in record['top']:
+            logger.log_to_file(f"[HarmonyImportProfiler] [Info]   {module['self_ms']:8.2f} ms self {module['cumulative_ms']:8.2f} ms cumulative  {module['module']} ({module['thread']})")
+        if budget_ms is not None and elapsed_ms > budget_ms:
+            logger.log_to_file(f"[HarmonyImportProfiler] [Warning] {milestone} took {elapsed_ms:.0f} ms, over the budget of {budget_ms} ms.")
+        if history_file:
+            try:
+                with open(history_file, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except OSError as e:
+                logger.log_to_file(f"[HarmonyImportProfiler] [Error] Failed to write the startup history: {e}")
+        return record
+
+class HarmonyProfiledLoader():
+    def __init__(self, loader, profiler):
+        self.loader = loader
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        # Extension modules do most of their work here
+        if not hasattr(self.loader, 'create_module'):
+            return None
+        self.profiler.enter()
+        try:
+            return self.loader.create_module(spec)
+        finally:
+            self.profiler.leave(spec.name)
+
+    def exec_module(self, module):
+        self.profiler.enter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profiler.leave(module.__name__)
+
+# Time since the process was started, including interpreter start-up, when /proc is available
+def get_process_age():
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - import_profiler.start
+
+import_profiler = HarmonyImportProfiler()
+
+def print_history(history_file, count=20):
+    with open(history_file, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    for record in records[-count:]:
+        budget = record.get('budget_ms')
+        status = 'over budget' if budget is not None and record['elapsed_ms'] > budget else 'ok'
+        print(f"{record['time']}  {record.get('app', '-'):<20} {record['milestone']:<20} {record['elapsed_ms']:8.0f} ms  imports {record['imports_ms']:8.0f} ms  {status}")
+
+if __name__ == '__main__':
+    current_path = os.path.dirname(os.path.realpath(__file__))
+    print_history(sys.argv[1] if len(sys.argv) > 1 else os.path.join(current_path, 'startup.jsonl'))
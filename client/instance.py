@@ -0,0 +1,36 @@
+import os
+import socket
+
+from logger import Logger
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+# Process-lifetime lock on an abstract Unix socket name. The kernel releases the name when the process exits,
+# however it exits, so there is no stale pidfile to clean up.
+class HarmonyInstanceLock():
+    def __init__(self, name):
+        self.name = name
+        self.address = f'\0harmony-{os.getuid()}-{name}'
+        self.sock = None
+
+    def acquire(self):
+        if self.sock is not None:
+            return True
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.address)
+        except OSError:
+            sock.close()
+            logger.log_to_file(f'[HarmonyInstanceLock] [Info] {self.name} is already held by another process.')
+            return False
+        self.sock = sock
+        return True
+
+    def release(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def is_held(self):
+        return self.sock is not None
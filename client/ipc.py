@@ -0,0 +1,111 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from logger import Logger
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+# Messages are JSON objects, one per line, in both directions over the daemon's Unix socket
+def get_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or f'/tmp/harmony-{os.getuid()}'
+    return os.path.join(runtime_dir, 'harmony', 'harmonyd.sock')
+
+def send_message(stream, message):
+    stream.write((json.dumps(message) + '\n').encode())
+    stream.flush()
+
+def read_message(stream):
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+# Thin client side of harmonyd, it only needs the standard library so that app.py stays cheap to start
+class HarmonyDaemonClient():
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or get_socket_path()
+        self.sock = None
+        self.stream = None
+        self.send_lock = threading.Lock()
+
+    def connect(self, autostart=True, timeout=10):
+        try:
+            self.open()
+            return
+        except OSError:
+            if not autostart:
+                raise
+        logger.log_to_file(f'[HarmonyDaemonClient] [Info] Starting harmonyd...')
+        subprocess.Popen([sys.executable, os.path.join(current_path, 'harmonyd.py')], cwd=current_path, start_new_session=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.open()
+                return
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+
+    def open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.stream = sock.makefile('rwb')
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+        if self.sock:
+            self.sock.close()
+        self.stream = None
+        self.sock = None
+
+    def send(self, message):
+        with self.send_lock:
+            send_message(self.stream, message)
+
+    def read(self):
+        return read_message(self.stream)
+
+    def request(self, message):
+        self.connect(autostart=False)
+        try:
+            self.send(message)
+            return self.read()
+        finally:
+            self.close()
+
+    def launch(self, app, on_progress=None):
+        # Streams progress until the daemon reports that Looking Glass can be started, or that the launch failed
+        self.send({'command': 'launch', 'app': app})
+        while True:
+            message = self.read()
+            if message is None:
+                return {'event': 'error', 'message': 'harmonyd closed the connection'}
+            if message.get('event') == 'progress':
+                if on_progress:
+                    on_progress(message['message'])
+                continue
+            return message
+
+    def lg_exited(self, returncode):
+        self.send({'command': 'lg_exited', 'returncode': returncode})
+        return self.read()
+
+    # Called from the splash's cancel button while launch() is still waiting, the daemon answers the launch with an error
+    def cancel_start_app(self):
+        try:
+            self.send({'command': 'cancel'})
+        except (OSError, ValueError) as e:
+            logger.log_to_file(f'[HarmonyDaemonClient] [Error] Failed to cancel the launch: {e}')
@@ -0,0 +1,440 @@
+import asyncio
+import _thread
+import os
+import re
+import requests
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from common import HarmonyClientCommon
+from domain import STATE_PAUSED, STATE_RUNNING
+from events import JOB_FINISHED, MILESTONE_PROGRESS, HarmonyGuestEvents, HarmonyGuestJob, get_guest_job, get_guest_job_id
+from hibernate import HarmonyClientHibernate
+from listener import HarmonyClientListener, start_harmony_listener
+from logger import Logger
+from orchestrator import HarmonyLaunchCancelled, HarmonyLaunchOrchestrator, HarmonyLaunchStep
+from power import get_harmony_power
+from registry import get_harmony_registry
+from timeline import HarmonyTimeline, get_harmony_timeline, set_harmony_timeline
+from usb import HarmonyClientUsb
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+# Harmony application
+class HarmonyClient():
+    def __init__(self, app_config, harmony_config, listener=None):
+        self.window = None
+        self.listener = listener
+        self.ready_event = None
+        self.ready_ip = None
+        self.cancelled = False
+        self.failed = False
+        self.launch_id = uuid.uuid4().hex
+        self.guest_events = None
+        self.timeline = None
+        self.guest_job = None
+        self.guest_job_follower = None
+        self.guest_url = None
+
+        self.app = app_config.app
+        self.app_name = app_config.name
+        self.harmony_config = harmony_config
+        self.registry = get_harmony_registry()
+
+        self.app_vm = app_config.vm
+        self.mainexe = app_config.mainexe
+        self.alwaysontop = app_config.alwaysontop
+
+        self.exes = ' '.join([f'"{exe}"' for exe in app_config.exes])
+        self.killexes = ' '.join([f'"{killexe}"' for killexe in app_config.killexes])
+
+        self.usb_devices = app_config.usb_devices
+
+        self.client_command = app_config.client_command
+        self.client_undo_command = app_config.client_undo_command
+        self.command = app_config.command
+        
+        self.wait_for_easy_anti_cheat = app_config.wait_for_easy_anti_cheat
+        self.create_black_window = app_config.create_black_window
+        self.monitor_process = app_config.monitor_process
+        self.delay = app_config.delay
+        self.terminate_on_disconnect = app_config.terminate_on_disconnect
+        self.terminate_on_disconnect_timeout = app_config.terminate_on_disconnect_timeout
+
+        self.common = HarmonyClientCommon()
+        self.hibernate = HarmonyClientHibernate()
+        self.power = get_harmony_power(harmony_config)
+        self.usb = HarmonyClientUsb(self.app_vm, self.usb_devices, self.harmony_config.get('usb-debounce-ms', 250) / 1000, app_config.app)
+        self.lg_command = None
+
+    def wait_for_vm_start(self, vm_name, timeout=500):
+        logger.log_to_file(f'[HarmonyClient] [Info] Waiting for VM {vm_name} to start...')
+        if not self.common.domain.wait_until_running(vm_name, timeout):
+            logger.log_to_file(f'[HarmonyClient] [Error] Timeout: VM {vm_name} did not start in time.')
+            sys.exit(1)
+        logger.log_to_file(f'[HarmonyClient] [Info] VM {vm_name} is now running.')
+
+    def start_vm(self, vm_name, timeout=500):
+        elapsed = 0
+        interval = 1
+        while elapsed < timeout:
+            if self.common.is_vm_running(vm_name):
+                logger.log_to_file(f'[HarmonyClient] [Info] Started VM {vm_name}.')
+                return
+            self.common.domain.start(vm_name)
+            if self.common.domain.wait_until_running(vm_name, interval):
+                logger.log_to_file(f'[HarmonyClient] [Info] Started VM {vm_name}.')
+                return
+            elapsed += interval
+
+    async def start_vm_async(self, timeout=500):
+        logger.log_to_file(f'[HarmonyClient] [Info] Starting VM {self.app_vm}...')
+        deadline = time.monotonic() + timeout
+        # A domain the power policy suspended or saved comes back from there, usually well under a second
+        await asyncio.to_thread(self.power.resume, self.app_vm, 'launch', timeout)
+        while not self.common.is_vm_running(self.app_vm):
+            if time.monotonic() >= deadline:
+                logger.log_to_file(f'[HarmonyClient] [Error] Timeout: VM {self.app_vm} did not start in time.')
+                sys.exit(1)
+            await asyncio.to_thread(self.power.start_domain, self.app_vm)
+            await self.common.domain.wait_until_running_async(self.app_vm, 1)
+        logger.log_to_file(f'[HarmonyClient] [Info] Started VM {self.app_vm}.')
+
+    def hibernate_other_vms(self):
+        running_vms = self.common.get_running_vms()
+        if self.app_vm not in running_vms:
+            # Only hibernate the VMs listed in gpu-vms.json
+            vms = [vm for vm in running_vms if vm in self.harmony_config.get('domains', []) and vm != self.app_vm]
+            # Suspended domains still hold the GPU, they are resumed so that they can hibernate with the others
+            for vm in self.harmony_config.get('domains', []):
+                if vm != self.app_vm and vm not in vms and self.common.domain.get_state(vm) == STATE_PAUSED:
+                    if self.power.resume(vm, 'hibernate') is not None:
+                        vms.append(vm)
+            if vms:
+                logger.log_progress(f"HIBERNATING...")
+                self.hibernate.hibernate_vms(vms)
+
+    def remove_usb_devices(self):
+        if self.common.domain.get_state(self.app_vm) not in (STATE_RUNNING, STATE_PAUSED):
+            logger.log_progress(f"REMOVING USB DEVICES...")
+            logger.log_to_file(f'[HarmonyClient] [Info] Removing hostdev entries from {self.app_vm} VM...')
+            self.usb.remove_hostdev_usb_entries()
+
+    def send_cancel(self):
+        ip_address = self.common.get_vm_ip(self.app_vm)
+        if not ip_address:
+            logger.log_to_file(f'[HarmonyClient] [Error] No IP address found for the target VM {self.app_vm}.')
+            sys.exit(1)
+        url = 'http://' + ip_address + ':5000/cancel'
+        exes = self.exes
+        logger.log_to_file(f'[HarmonyClient] [Info] Sending command to cancel start app {self.app_name}: {exes}')
+        try:
+            response = self.common.http.post(url, data={'exes': exes}, retries=2, timeout=10, deadline=30)
+            logger.log_to_file(f'[HarmonyClient] [Info] Cancel start app {self.app_name} response from server: ', response.text)
+        except requests.exceptions.Timeout:
+            logger.log_to_file(f'[HarmonyClient] [Error] Request timed out trying to cancel start app {self.app_name}')
+
+    def cancel_start_app(self):
+        self.send_cancel()
+        process = subprocess.Popen(['kill', str(os.getpid())])
+        sys.exit(1)
+
+    # Cancels a launch without exiting, used by harmonyd where the process outlives the launch
+    def cancel(self):
+        self.cancelled = True
+        if self.ready_event:
+            self.ready_event.set()
+        self.send_cancel()
+    
+    def announce_terminate_on_disconnect(self):
+        ip_address = self.common.get_vm_ip(self.app_vm)
+        if not ip_address:
+            logger.log_to_file(f'[HarmonyClient] [Error] No IP address found for the target VM {self.app_vm}.')
+            sys.exit(1)
+        url = 'http://' + ip_address + ':5000/disconnected'
+        exes = self.exes
+        logger.log_to_file(f'[HarmonyClient] [Info] Announcing termination on disconnect to server...')
+        try:
+            response = self.common.http.post(url, data={'exes': exes, 'timeout': self.terminate_on_disconnect_timeout}, retries=2, timeout=10, deadline=30)
+            logger.log_to_file(f'[HarmonyClient] [Info] Announce termination on disconnect response from server: ', response.text)
+        except requests.exceptions.Timeout:
+            logger.log_to_file(f'[HarmonyClient] [Error] Request timed out trying to announce termination on disconnect')
+            sys.exit(1)
+
+    def stop_app(self):
+        ip_address = self.common.get_vm_ip(self.app_vm)
+        if not ip_address:
+            logger.log_to_file(f'[HarmonyClient] [Error] No IP address found for the target VM {self.app_vm}.')
+            sys.exit(1)
+        url = 'http://' + ip_address + ':5000/stop'
+        self.registry.refresh()
+        exes = ' '.join([f'"{exe}"' for exe in self.registry.get_vm_exes(self.app_vm)])
+        logger.log_to_file(f'[HarmonyClient] [Info] Sending command to stop app {self.app_name}: {exes}')
+        try:
+            response = self.common.http.post(url, data={'exes': exes}, retries=2, timeout=10, deadline=30)
+            logger.log_to_file(f'[HarmonyClient] [Info] Stop app {self.app_name} response from server: ', response.text)
+            process = subprocess.Popen(['kill', str(os.getpid())])
+            sys.exit(1)
+        except requests.exceptions.Timeout:
+            logger.log_to_file(f'[HarmonyClient] [Error] Request timed out trying to stop app {self.app_name}')
+            process = subprocess.Popen(['kill', str(os.getpid())])
+            sys.exit(1)
+
+    def start_app(self):
+        if self.cancelled:
+            logger.log_to_file(f'[HarmonyClient] [Info] Launch of {self.app_name} was cancelled, not starting the app.')
+            return
+        ip_address = self.common.get_vm_ip(self.app_vm)
+        if not ip_address:
+            logger.log_to_file(f'[HarmonyClient] [Error] No IP address found for the target VM {self.app_vm}.')
+            sys.exit(1)
+        url = 'http://' + ip_address + ':5000/execute'
+
+        # Registered before /execute is sent, the guest can call /ready as soon as the app is up
+        if self.listener:
+            self.ready_ip = ip_address
+            self.ready_event = self.listener.expect(ip_address)
+            if self.cancelled:
+                self.ready_event.set()
+
+        # Add all exes of the other apps on the same `vm` to the `killexes` list
+        other_exes = self.registry.get_vm_exes(self.app_vm, exclude=self.app)
+        if other_exes:
+            self.killexes += ' ' + ' '.join([f'"{exe}"' for exe in other_exes])
+
+        app_command = f'pythonw.exe ../app.py -app "{self.command}" -mainexe "{self.mainexe}" -alwaysontop {self.alwaysontop} -exes {self.exes} -killexes {self.killexes} -waitforeac "{self.wait_for_easy_anti_cheat}" -createblackwindow "{self.create_black_window}" -monitorprocess "{self.monitor_process}" -delay {self.delay} -launch {self.launch_id}'
+        logger.log_to_file(f'[HarmonyClient] [Info] Sending command to start app {self.app_name}: {app_command}')
+        try:
+            # The launch id is the idempotency key, a retry after a slow response or a full job queue gets the job
+            # that already runs instead of running the command again
+            response = self.common.http.post(url, data={'command': app_command, 'launch': self.launch_id, 'key': self.launch_id}, retries=10, timeout=10, deadline=120, accept=lambda response: response.status_code != 503)
+            self.guest_job = get_guest_job_id(response)
+            self.guest_url = 'http://' + ip_address + ':5000'
+            logger.log_to_file(f'[HarmonyClient] [Info] Start app {self.app_name} response from server: ', response.text)
+            if self.cancelled:
+                # cancel() ran while /execute was in flight, its /cancel may have reached the guest first
+                logger.log_to_file(f'[HarmonyClient] [Info] Launch of {self.app_name} was cancelled while starting the app, cancelling again.')
+                self.send_cancel()
+                return
+
+            # The guest pushes its milestones for this launch, ending with ready or failed
+            self.guest_events = HarmonyGuestEvents(self.common.http, 'http://' + ip_address + ':5000/events', self.launch_id, self.on_guest_event)
+            self.guest_events.start()
+
+            # app.py exits with an error code when it cannot start the app, the job status reports it before the
+            # ready timeout would
+            if self.guest_job:
+                self.guest_job_follower = HarmonyGuestJob(self.common.http, self.guest_url, self.guest_job, self.on_guest_job)
+                self.guest_job_follower.start()
+            logger.log_to_file(f'[HarmonyClient] [Info] HTTP client stats: {self.common.http.get_stats()}')
+        except requests.exceptions.Timeout:
+            logger.log_to_file(f'[HarmonyClient] [Error] Request timed out trying to start app {self.app_name}')
+            sys.exit(1)
+        except requests.exceptions.RequestException as e:
+            logger.log_to_file(f'[HarmonyClient] [Error] Exception trying to start app {self.app_name} ', e)
+            sys.exit    
+
+    def on_guest_event(self, event):
+        name = event.get('name')
+        logger.log_to_file(f'[HarmonyClient] [Info] Guest milestone {name} for {self.app_name}: {event.get("args")}')
+        (self.timeline or get_harmony_timeline()).instant(name, 'guest', track='guest', args=event.get('args'))
+        if name in MILESTONE_PROGRESS:
+            logger.log_progress(MILESTONE_PROGRESS[name])
+        if name == 'failed':
+            self.failed = True
+        if name in ('ready', 'failed'):
+            if self.ready_event:
+                self.ready_event.set()
+            return True
+        return False
+
+    def on_guest_job(self, job):
+        if job['status'] not in JOB_FINISHED:
+            return False
+        # app.py exits cleanly right after the ready milestone, which may still be on its way
+        if job['status'] == 'failed' or job['exit_code'] != 0:
+            logger.log_to_file(f"[HarmonyClient] [Error] Guest job {job['id']} for {self.app_name} is {job['status']}, exit code {job['exit_code']}: {job.get('error') or job['output'][-2000:]}")
+            self.failed = True
+            if self.ready_event:
+                self.ready_event.set()
+        return True
+
+    def run_client_command(self):
+        # Run client command if specified
+        if self.client_command:
+            logger.log_to_file(f'[HarmonyClient] [Info] Running client command: {self.client_command}')
+            subprocess.run(self.client_command, shell=True)
+
+    def prepare_lg_command(self):
+        lg_path = self.harmony_config.get('looking-glass-path')
+        if not lg_path:
+            logger.log_to_file(f"[HarmonyClient] [Error] Looking Glass path not found.")
+            sys.exit(1)
+        lg_path = os.path.expanduser(lg_path)
+        logger.log_to_file(f"[HarmonyClient] [Info] Looking Glass path: {lg_path}")
+
+        lg_command = [lg_path]
+        lg_command.append(f'spice:port={int(self.harmony_config.get('spice-port'))}')
+        lg_args = self.harmony_config.get('looking-glass-args', [])
+        for lg_arg in lg_args:
+            lg_command.append(lg_arg)
+        lg_command.append(f'win:title={self.app_name}')
+        app_id = f"com.harmony.{self.app}"
+        app_id = re.sub(r'\d+', lambda x: f'_{x.group()}', app_id)
+        lg_command.append(f'win:appId={app_id}')
+        self.lg_command = lg_command
+        return lg_command
+
+    def get_lg_environment(self):
+        lg_gdk_backend = self.harmony_config.get('looking-glass-gdk-backend')
+        logger.log_to_file(f"[HarmonyClient] [Info] Setting the Looking Glass backend to: {lg_gdk_backend}")
+        return {'GDK_BACKEND': lg_gdk_backend} if lg_gdk_backend else {}
+
+    def start_usb_monitor(self):
+        usb_monitor_thread = threading.Thread(target=self.usb.monitor_usb_changes)
+        usb_monitor_thread.daemon = True
+        usb_monitor_thread.start()
+        return usb_monitor_thread
+
+    def stop_usb_monitor(self, usb_monitor_thread):
+        self.usb.stop_monitor()
+        usb_monitor_thread.join()
+
+    def finish_lg(self, returncode):
+        # Run client undo command if specified
+        if self.client_undo_command:
+            logger.log_to_file(f'[HarmonyClient] [Info] Running client undo command: {self.client_undo_command}')
+            subprocess.run(self.client_undo_command, shell=True)
+
+        logger.log_to_file(f"[HarmonyClient] [Info] Looking Glass terminated with exit code {returncode}")
+
+        if self.terminate_on_disconnect:
+            self.announce_terminate_on_disconnect()
+
+    def start_lg(self, listener):
+        os.environ.update(self.get_lg_environment())
+
+        lg_command = self.lg_command or self.prepare_lg_command()
+        logger.log_to_file(f"[HarmonyClient] [Info] Launching Looking Glass with the command: {lg_command}")
+        try:
+            usb_monitor_thread = self.start_usb_monitor()
+
+            # Launch Looking Glass using Popen and monitor the process
+            timeline = self.timeline or get_harmony_timeline()
+            lg_start = timeline.now()
+            with timeline.span('spawn looking glass', 'lg'):
+                process = subprocess.Popen(lg_command)
+            timeline.save()
+
+            listener_thread = threading.Thread(target=start_harmony_listener, args=(listener,self.harmony_config.get('port', 5000)))
+            listener_thread.start()
+        
+            # Wait for the process to terminate
+            process.wait()
+            timeline.add_span('looking glass', lg_start, timeline.now(), 'lg', args={'returncode': process.returncode})
+            timeline.save()
+
+            self.stop_usb_monitor(usb_monitor_thread)
+            self.finish_lg(process.returncode)
+
+            process = subprocess.Popen(['kill', str(os.getpid())])
+            _thread.interrupt_main()
+        except Exception as e:
+            logger.log_to_file(f"[HarmonyClient] [Error] Error launching Looking Glass: {e}")
+            sys.exit(1)
+
+    def wait_for_ready(self, timeout=None):
+        event = self.ready_event or self.listener.shutdown_event
+        ready = event.wait(timeout)
+        if self.ready_ip:
+            self.listener.forget(self.ready_ip)
+        if self.guest_events:
+            self.guest_events.stop()
+        if self.guest_job_follower:
+            self.guest_job_follower.stop()
+        if self.failed:
+            logger.log_to_file(f'[HarmonyClient] [Error] The guest failed to start {self.app_name}.')
+        if (self.failed or not ready) and self.guest_job:
+            job = get_guest_job(self.common.http, self.guest_url, self.guest_job)
+            if job:
+                logger.log_to_file(f"[HarmonyClient] [Info] Guest job {job['id']} is {job['status']}, exit code {job['exit_code']}: {job['output'][-2000:]}")
+        return ready and not self.cancelled and not self.failed
+
+    # Runs every launch step up to the point where Looking Glass can be started, returns whether the host is ready
+    def prepare(self, timeout=None):
+        # Kept on the client as well, the daemon finishes this launch's trace after another one replaced the global
+        timeline = self.timeline = set_harmony_timeline(HarmonyTimeline(self.app, max_traces=self.harmony_config.get('max-traces', 50)))
+        outcome = 'error'
+        error = None
+        try:
+            outcome = self.run_steps(timeline, timeout)
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            # Written however the launch ended, failed and cancelled launches are the ones worth a look. A ready
+            # launch writes it again once Looking Glass is running.
+            timeline.set_outcome(outcome, error)
+            timeline.save()
+        return outcome == 'ready'
+
+    # Returns how the launch ended: ready, cancelled, failed or timed out
+    def run_steps(self, timeline, timeout=None):
+        launch_start = timeline.now()
+
+        # Steps without a dependency between them run concurrently
+        orchestrator = HarmonyLaunchOrchestrator([
+            HarmonyLaunchStep('hibernate', self.hibernate_other_vms, timeout=600),
+            HarmonyLaunchStep('remove_usb', self.remove_usb_devices, timeout=60),
+            HarmonyLaunchStep('client_command', self.run_client_command, timeout=120),
+            HarmonyLaunchStep('prepare_lg', self.prepare_lg_command, timeout=10),
+            HarmonyLaunchStep('start_vm', self.start_vm_async, depends=['hibernate', 'remove_usb'], timeout=500, progress="STARTING VM..."),
+            HarmonyLaunchStep('add_usb', self.usb.handle_usb_addition, depends=['start_vm'], timeout=120, progress="ADDING USB DEVICES..."),
+            HarmonyLaunchStep('start_app', self.start_app, depends=['start_vm', 'add_usb', 'client_command'], timeout=180, progress="STARTING APP..."),
+        ], cancelled=lambda: self.cancelled)
+        with timeline.span('launch steps'):
+            try:
+                orchestrator.run()
+            except HarmonyLaunchCancelled:
+                pass
+        # start_app may also have returned early, there is nothing to wait for then
+        if self.cancelled:
+            logger.log_to_file(f'[HarmonyClient] [Info] Launch of {self.app_name} cancelled.')
+            return 'cancelled'
+
+        logger.log_progress(f"WAITING...")
+        logger.log_to_file(f'[HarmonyClient] [Info] Waiting for the host to be ready...')
+
+        with timeline.span('wait for host ready'):
+            ready = self.wait_for_ready(timeout)
+        if not ready:
+            return 'cancelled' if self.cancelled else 'failed' if self.failed else 'timed out'
+        timeline.add_span('time to ready', launch_start, timeline.now(), 'summary', track='summary')
+        logger.log_progress(f"LAUNCHING...")
+        return 'ready'
+
+    def run(self):
+        self.listener = HarmonyClientListener(__name__)
+        listener_thread = threading.Thread(target=start_harmony_listener, args=(self.listener,self.harmony_config.get('port', 5000)))
+        listener_thread.start()
+
+        if not self.prepare():
+            logger.log_to_file(f'[HarmonyClient] [Error] Launch of {self.app_name} failed.')
+            if self.window:
+                self.window.destroy()
+            sys.exit(1)
+        logger.log_to_file("[HarmonyClient] [Info] Shutting down Flask listener...")
+
+        # Close the splash screen
+        if self.window:
+            logger.log_to_file(f"[HarmonyClient] [Info] Destroying splash screen window...")
+            self.window.lg_ready = True
+            self.window.destroy()
+
+        logger.log_to_file(f'[HarmonyClient] [Info] Launching Looking Glass...')
+        self.start_lg(self.listener)
+        sys.exit(1)
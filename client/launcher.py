@@ -11,11 +11,9 @@ import threading
 import time
 
 from collections import Counter
-from common import HarmonyClientCommon
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, Gdk, GLib, GdkPixbuf
 from logger import Logger
-from PIL import Image
 
 current_path = os.path.dirname(os.path.realpath(__file__))
 logger = Logger(os.path.join(current_path, 'app.log'), False)
@@ -111,6 +109,8 @@ class HarmonyLauncherWindow(Gtk.ApplicationWindow):
             color = tuple(int(self.app_colour[i:i+2], 16) for i in (0, 2, 4))
             return color
 
+        # Only needed when the app has no colour configured
+        from PIL import Image
         img = Image.open(image_path)
         if img.mode != 'RGB':
             img = img.convert('RGB')
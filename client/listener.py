@@ -14,27 +14,55 @@ class HarmonyClientListener(Flask):
         super().__init__(*args, **kwargs)
 
         self.shutdown_event = threading.Event()
+        self.waiters = {}
+        self.waiters_lock = threading.Lock()
+        self.terminate_handler = None
 
         @self.route('/ready', methods=['GET'])
         def host_ready():
             logger.log_to_file(f"[HarmonyClientListener] [Info] Host is ready.")
-            self.shutdown_event.set()
+            self.get_waiter(request.remote_addr).set()
             return 'Host is ready.'
 
         @self.route('/terminate', methods=['GET'])
         def host_terminate():
-            logger.log_to_file(f"[HarmonyClientListener] [Info] Host sent terminate.")  
-            
+            logger.log_to_file(f"[HarmonyClientListener] [Info] Host sent terminate.")
+
             result = subprocess.run(['pkill', '-f', 'looking-glass-client'])
             if result.returncode == 0:
                 logger.log_to_file(f"[HarmonyClientListener] [Info] Successfully terminated Looking Glass process.")
             else:
                 logger.log_to_file(f"[HarmonyClientListener] [Error] Failed to terminate Looking Glass process.")
-    
+
+            # A long running listener outlives the launch, so it must not kill its own process
+            if self.terminate_handler:
+                self.terminate_handler(request.remote_addr)
+                return 'Host sent terminate.'
+
             current_pid = os.getpid()
             subprocess.run(['kill', str(current_pid)])
             return 'Host sent terminate.'
 
+    # Returns the event that is set when the guest at ip_address calls /ready
+    def expect(self, ip_address):
+        with self.waiters_lock:
+            event = threading.Event()
+            self.waiters[ip_address] = event
+            return event
+
+    def forget(self, ip_address):
+        with self.waiters_lock:
+            self.waiters.pop(ip_address, None)
+
+    def get_waiter(self, ip_address):
+        with self.waiters_lock:
+            if ip_address in self.waiters:
+                return self.waiters[ip_address]
+            # The guest may reach us from another address, e.g. through NAT, which is unambiguous with one launch
+            if len(self.waiters) == 1:
+                return next(iter(self.waiters.values()))
+            return self.shutdown_event
+
 def start_harmony_listener(listener, port):
     harmony_port = int(port)
-    listener.run(host='0.0.0.0', port=harmony_port)
\ No newline at end of file
+    listener.run(host='0.0.0.0', port=harmony_port)
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import threading
+import time
+
+from logger import Logger
+from timeline import get_harmony_timeline
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+# Raised by the first step that would start after the launch was cancelled
+class HarmonyLaunchCancelled(Exception):
+    pass
+
+# A single launch phase. The action is either a coroutine function or a blocking callable, which is run in a
+# worker thread. A step starts as soon as every step it depends on has finished.
+class HarmonyLaunchStep():
+    def __init__(self, name, action, depends=(), timeout=None, progress=None):
+        self.name = name
+        self.action = action
+        self.depends = list(depends)
+        self.timeout = timeout
+        self.progress = progress
+
+# Runs launch steps as a dependency graph on an asyncio loop. Independent steps overlap, each step has its own
+# timeout, and the first failure cancels every step that has not finished yet. Blocking actions that are already
+# running in their thread cannot be interrupted, their results are discarded instead and the failure is reported
+# without waiting for them. With a cancelled callable, no step starts once it returns True.
+class HarmonyLaunchOrchestrator():
+    def __init__(self, steps, cancelled=None):
+        self.cancelled = cancelled
+        self.steps = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f'Duplicate launch step: {step.name}')
+            self.steps[step.name] = step
+        self.order = self.sort_steps()
+        self.timings = {}
+
+    def sort_steps(self):
+        order = []
+        visiting = set()
+        visited = set()
+
+        def visit(name, path):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f'Launch step cycle: {" -> ".join(path + [name])}')
+            if name not in self.steps:
+                raise ValueError(f'Unknown launch step: {name}')
+            visiting.add(name)
+            for dependency in self.steps[name].depends:
+                visit(dependency, path + [name])
+            visiting.discard(name)
+            visited.add(name)
+            order.append(self.steps[name])
+
+        for name in self.steps:
+            visit(name, [])
+        return order
+
+    # A daemon thread per blocking action instead of asyncio.to_thread: asyncio.run joins the default executor on
+    # exit, so a timed out or failed launch would wait for the slowest action (hibernate may take minutes) to
+    # return before reporting. An abandoned thread finishes in the background and its result is dropped.
+    def run_in_thread(self, step):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(result, error):
+            if future.done():
+                return # Cancelled or timed out meanwhile
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def target():
+            result = error = None
+            try:
+                result = step.action()
+            except BaseException as e:
+                error = e
+            try:
+                loop.call_soon_threadsafe(resolve, result, error)
+            except RuntimeError:
+                pass # The loop is closed, nobody waits for this step anymore
+
+        threading.Thread(target=target, name=f'step-{step.name}', daemon=True).start()
+        return future
+
+    async def run_step(self, step, tasks, launch_start):
+        if step.depends:
+            await asyncio.gather(*(tasks[dependency] for dependency in step.depends))
+        if self.cancelled and self.cancelled():
+            logger.log_to_file(f'[HarmonyLaunchOrchestrator] [Info] Launch cancelled, skipping step {step.name}.')
+            raise HarmonyLaunchCancelled(step.name)
+        if step.progress:
+            logger.log_progress(step.progress)
+        logger.log_to_file(f'[HarmonyLaunchOrchestrator] [Info] Starting step {step.name}...')
+
+        start = time.monotonic()
+        if asyncio.iscoroutinefunction(step.action):
+            awaitable = step.action()
+        else:
+            awaitable = self.run_in_thread(step)
+        try:
+            with get_harmony_timeline().span(step.name, 'step', track=step.name):
+                result = await asyncio.wait_for(awaitable, step.timeout)
+        except asyncio.TimeoutError:
+            logger.log_to_file(f'[HarmonyLaunchOrchestrator] [Error] Step {step.name} timed out after {step.timeout} seconds.')
+            raise
+        end = time.monotonic()
+
+        self.timings[step.name] = (start - launch_start, end - launch_start)
+        logger.log_to_file(f'[HarmonyLaunchOrchestrator] [Info] Finished step {step.name} in {end - start:.3f} seconds.')
+        return result
+
+    async def run_async(self):
+        launch_start = time.monotonic()
+        tasks = {}
+        for step in self.order:
+            tasks[step.name] = asyncio.create_task(self.run_step(step, tasks, launch_start), name=step.name)
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        logger.log_to_file(f'[HarmonyLaunchOrchestrator] [Info] Launch steps finished in {time.monotonic() - launch_start:.3f} seconds.')
+        return {name: task.result() for name, task in tasks.items()}
+
+    def run(self):
+        return asyncio.run(self.run_async())
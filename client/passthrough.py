@@ -0,0 +1,68 @@
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from domain import get_harmony_domain
+from logger import Logger
+from timeline import get_harmony_timeline
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+def get_hostdev_xml(device):
+    return f"""
+<hostdev mode='subsystem' type='usb' managed='yes'>
+  <source>
+    <vendor id='0x{device["vendor_id"]}'/>
+    <product id='0x{device["product_id"]}'/>
+    <address bus='{int(device["bus"])}' device='{int(device["device"])}'/>
+  </source>
+</hostdev>
+"""
+
+def describe_device(device):
+    return f"{device['vendor_id']}:{device['product_id']} (Bus {device['bus']}, Device {device['device']})"
+
+# USB passthrough on the shared domain service, so libvirt's persistent connection is used when it is available.
+# A batch detaches and then attaches its devices, the devices of each phase concurrently since they are
+# independent of each other, and reports the outcome of every device.
+class HarmonyClientPassthrough():
+    def __init__(self, vm_name, domain=None, max_workers=4):
+        self.vm_name = vm_name
+        self.domain = domain or get_harmony_domain()
+        self.max_workers = max_workers
+
+    def apply(self, attach=(), detach=()):
+        attach = list(attach)
+        detach = list(detach)
+        results = []
+        if not attach and not detach:
+            return results
+
+        start = time.perf_counter()
+        with get_harmony_timeline().span('usb passthrough', 'usb', args={'attach': len(attach), 'detach': len(detach)}):
+            for command, devices in (('detach-device', detach), ('attach-device', attach)):
+                if not devices:
+                    continue
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(devices)), thread_name_prefix='passthrough') as executor:
+                    results.extend(executor.map(lambda device: self.run(command, device), devices))
+
+        failed = [result for result in results if not result['ok']]
+        logger.log_to_file(f'[HarmonyClientPassthrough] [Info] Applied {len(results) - len(failed)}/{len(results)} USB device changes to {self.vm_name} in {(time.perf_counter() - start) * 1000:.1f} ms.')
+        return results
+
+    def run(self, command, device):
+        start = time.perf_counter()
+        error = self.domain.update_device(command, self.vm_name, get_hostdev_xml(device))
+        result = {'command': command, 'device': device, 'ok': error is None, 'error': error, 'ms': (time.perf_counter() - start) * 1000}
+        if error:
+            logger.log_to_file(f'[HarmonyClientPassthrough] [Error] {command} {self.vm_name} failed for USB device {describe_device(device)}: {error}')
+        else:
+            logger.log_to_file(f"[HarmonyClientPassthrough] [Info] {command} {self.vm_name} succeeded for USB device {describe_device(device)} in {result['ms']:.1f} ms.")
+        return result
+
+    def attach(self, devices):
+        return self.apply(attach=devices)
+
+    def detach(self, devices):
+        return self.apply(detach=devices)
@@ -0,0 +1,247 @@
+import json
+import os
+import sys
+import threading
+import time
+
+from common import HarmonyClientCommon
+from domain import STATE_PAUSED, STATE_RUNNING, STATE_STOPPED
+from hibernate import HarmonyClientHibernate
+from logger import Logger
+from passthrough import HarmonyClientPassthrough
+from timeline import get_harmony_timeline
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+# Cheapest to resume first: paused vCPUs, memory saved by libvirt, then Windows' own hibernation
+POWER_TIERS = ('suspend', 'managedsave', 'hibernate')
+DEFAULT_POWER_POLICY = {'suspend-after': 60, 'managedsave-after': 600, 'hibernate-after': 1800}
+
+# Moves domains that Harmony left idle through the power tiers as their idle time passes the thresholds of the
+# `power-policy` in harmony.json (seconds, null disables a tier). A launch resumes its domain from whatever tier it
+# reached, and how long that took is appended to power.jsonl so the thresholds can be tuned.
+class HarmonyClientPower():
+    def __init__(self, harmony_config=None, history_file=None):
+        harmony_config = harmony_config or {}
+        policy = dict(DEFAULT_POWER_POLICY, **(harmony_config.get('power-policy') or {}))
+        self.thresholds = [(tier, policy.get(f'{tier}-after')) for tier in POWER_TIERS if policy.get(f'{tier}-after') is not None]
+        self.domains = harmony_config.get('domains', [])
+        self.history_file = history_file or os.path.join(current_path, 'power.jsonl')
+        self.common = HarmonyClientCommon()
+        self.hibernate = HarmonyClientHibernate()
+        self.lock = threading.Lock()
+        # Transitions and resumes of a domain never overlap
+        self.action_locks = {}
+        self.idle_since = {}
+        # Last tier attempted per domain, and the domains with a managed save image
+        self.tiers = {}
+        self.saved = set()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.tick = 1
+
+    def start(self):
+        if self.thread is None and self.thresholds:
+            self.thread = threading.Thread(target=self.run, name='power-policy', daemon=True)
+            self.thread.start()
+            logger.log_to_file(f"[HarmonyClientPower] [Info] Power policy: {', '.join(f'{tier} after {threshold}s' for tier, threshold in self.thresholds)}.")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_action_lock(self, vm_name):
+        with self.lock:
+            return self.action_locks.setdefault(vm_name, threading.Lock())
+
+    def mark_idle(self, vm_name):
+        if vm_name not in self.domains:
+            return
+        with self.lock:
+            self.idle_since[vm_name] = time.monotonic()
+        logger.log_to_file(f'[HarmonyClientPower] [Info] Domain {vm_name} is idle.')
+
+    def mark_busy(self, vm_name):
+        with self.lock:
+            self.idle_since.pop(vm_name, None)
+
+    def run(self):
+        while not self.stop_event.wait(self.tick):
+            with self.lock:
+                idle = list(self.idle_since.items())
+            for vm_name, since in idle:
+                tier = self.get_next_tier(vm_name, time.monotonic() - since)
+                if tier:
+                    self.enter_tier(vm_name, tier)
+
+    def get_next_tier(self, vm_name, idle_time):
+        with self.lock:
+            current = self.tiers.get(vm_name)
+        current_index = POWER_TIERS.index(current) if current else -1
+        next_tier = None
+        for tier, threshold in self.thresholds:
+            if POWER_TIERS.index(tier) > current_index and idle_time >= threshold:
+                next_tier = tier
+        return next_tier
+
+    def enter_tier(self, vm_name, tier):
+        with self.get_action_lock(vm_name):
+            with self.lock:
+                if vm_name not in self.idle_since:
+                    return # A launch claimed the domain in the meantime
+            domain = self.common.domain
+            state = domain.get_state(vm_name)
+            if state == STATE_STOPPED and vm_name not in self.saved:
+                # Shut down or hibernated by the guest itself, there is nothing left to save
+                logger.log_to_file(f'[HarmonyClientPower] [Info] Domain {vm_name} stopped on its own.')
+                with self.lock:
+                    self.idle_since.pop(vm_name, None)
+                    self.tiers[vm_name] = 'hibernate'
+                return
+
+            logger.log_to_file(f'[HarmonyClientPower] [Info] Moving idle domain {vm_name} from {self.tiers.get(vm_name) or state} to {tier}...')
+            start = time.monotonic()
+            error = None
+            if tier == 'suspend':
+                error = domain.suspend(vm_name)
+            elif tier == 'managedsave':
+                error = self.detach_usb_devices(vm_name) or domain.managed_save(vm_name)
+            else:
+                error = self.hibernate_guest(vm_name, state)
+
+            if error:
+                # The tier is skipped, the next one is tried once its threshold has passed
+                logger.log_to_file(f'[HarmonyClientPower] [Error] Failed to {tier} {vm_name}: {error}')
+            else:
+                logger.log_to_file(f'[HarmonyClientPower] [Info] Domain {vm_name} entered {tier} in {time.monotonic() - start:.2f} seconds.')
+            with self.lock:
+                self.tiers[vm_name] = tier
+                if tier == 'managedsave' and not error:
+                    self.saved.add(vm_name)
+                elif tier == 'hibernate':
+                    self.saved.discard(vm_name)
+                if tier == self.thresholds[-1][0]:
+                    self.idle_since.pop(vm_name, None)
+
+    # The saved image keeps the live definition, a USB hostdev in it that was replugged or renumbered meanwhile
+    # makes the restore fail. They are detached before saving, the launch attaches the wanted ones again.
+    def detach_usb_devices(self, vm_name):
+        description = self.common.domain.get_description(vm_name)
+        devices = [dict(hostdev) for hostdev in description.usb_hostdevs if hostdev['bus'] and hostdev['device']]
+        if not devices:
+            return None
+        failed = [result for result in HarmonyClientPassthrough(vm_name, self.common.domain).detach(devices) if not result['ok']]
+        if failed:
+            return f"failed to detach {len(failed)} USB devices: {failed[0]['error']}"
+        return None
+
+    # Starts a domain, restoring its managed save if it has one. A restore that fails, a device of the saved
+    # definition went away for instance, discards the image and boots cold rather than failing every retry.
+    def start_domain(self, vm_name):
+        domain = self.common.domain
+        error = domain.start(vm_name)
+        if error and domain.has_managed_save(vm_name):
+            logger.log_to_file(f'[HarmonyClientPower] [Error] Failed to restore {vm_name} from its managed save, booting it cold: {error}')
+            error = domain.managed_save_remove(vm_name) or domain.start(vm_name)
+        return error
+
+    def hibernate_guest(self, vm_name, state):
+        # Windows can only hibernate itself while it runs, a paused or saved domain is brought back first
+        domain = self.common.domain
+        if state == STATE_PAUSED:
+            error = domain.resume(vm_name)
+            if error:
+                return error
+        elif state != STATE_RUNNING:
+            error = self.start_domain(vm_name)
+            if error:
+                return error
+            if not domain.wait_until_running(vm_name, 120):
+                return 'the domain did not start'
+        try:
+            self.hibernate.hibernate_vm(vm_name)
+        except SystemExit:
+            return 'the guest did not accept the hibernate command'
+        if not domain.wait_until_stopped(vm_name, 500):
+            return 'the guest did not hibernate in time'
+        return None
+
+    # Brings a domain back from the tier it was left in and waits until it runs. Domains that were not put in a
+    # tier by this policy are left to the normal start.
+    def resume(self, vm_name, reason='launch', timeout=500):
+        self.mark_busy(vm_name)
+        with self.get_action_lock(vm_name):
+            with self.lock:
+                attempted = self.tiers.pop(vm_name, None)
+                saved = vm_name in self.saved
+                self.saved.discard(vm_name)
+            domain = self.common.domain
+            state = domain.get_state(vm_name)
+            if state == STATE_PAUSED:
+                tier = 'suspend'
+            elif state == STATE_STOPPED and saved:
+                tier = 'managedsave'
+            elif state == STATE_STOPPED and attempted == 'hibernate':
+                tier = 'hibernate'
+            else:
+                return None
+
+            logger.log_to_file(f'[HarmonyClientPower] [Info] Resuming {vm_name} from {tier}...')
+            timeline = get_harmony_timeline()
+            start = time.monotonic()
+            with timeline.span(f'resume from {tier}', 'power', args={'vm': vm_name}):
+                if state == STATE_PAUSED:
+                    error = domain.resume(vm_name)
+                else:
+                    # A managed save is restored by a normal start, a hibernated guest resumes from its own image
+                    error = self.start_domain(vm_name)
+                ok = not error and domain.wait_until_running(vm_name, timeout)
+            elapsed = time.monotonic() - start
+            if ok:
+                logger.log_to_file(f'[HarmonyClientPower] [Info] Resumed {vm_name} from {tier} in {elapsed:.3f} seconds.')
+            else:
+                logger.log_to_file(f"[HarmonyClientPower] [Error] Failed to resume {vm_name} from {tier}: {error or 'timed out'}")
+            self.record({'time': time.time(), 'vm': vm_name, 'tier': tier, 'reason': reason, 'seconds': round(elapsed, 3), 'ok': bool(ok)})
+            return elapsed if ok else None
+
+    def record(self, entry):
+        try:
+            with open(self.history_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        except OSError as e:
+            logger.log_to_file(f'[HarmonyClientPower] [Error] Failed to record the resume time: {e}')
+
+    def get_status(self):
+        now = time.monotonic()
+        with self.lock:
+            status = {}
+            for vm_name in set(self.idle_since) | set(self.tiers):
+                since = self.idle_since.get(vm_name)
+                status[vm_name] = {'tier': self.tiers.get(vm_name), 'idle': round(now - since, 1) if since is not None else None}
+            return status
+
+harmony_power = None
+harmony_power_lock = threading.Lock()
+
+def get_harmony_power(harmony_config=None):
+    global harmony_power
+    with harmony_power_lock:
+        if harmony_power is None:
+            harmony_power = HarmonyClientPower(harmony_config)
+        return harmony_power
+
+def print_history(history_file):
+    # Resume times per tier, the reason the tiers exist
+    times = {}
+    with open(history_file, 'r') as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get('ok'):
+                times.setdefault(entry['tier'], []).append(entry['seconds'])
+    for tier in POWER_TIERS:
+        values = sorted(times.get(tier, []))
+        if values:
+            print(f'{tier}: {len(values)} resumes, p50 {values[len(values) // 2]:.3f}s, max {values[-1]:.3f}s')
+
+if __name__ == '__main__':
+    print_history(sys.argv[1] if len(sys.argv) > 1 else os.path.join(current_path, 'power.jsonl'))
@@ -0,0 +1,161 @@
+import json
+import os
+import threading
+
+from logger import Logger
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+CACHE_VERSION = 1
+
+# A parsed apps/<app>.json configuration
+class HarmonyAppConfig():
+    def __init__(self, app, config):
+        self.app = app
+        self.raw = config
+        self.vm = config.get('vm')
+        self.name = config.get('name')
+        self.splash = config.get('splash')
+        self.colour = config.get('colour')
+        self.mainexe = config.get('mainexe')
+        self.alwaysontop = config.get('alwaysontop', False)
+        self.exes = config.get('exes', [])
+        self.killexes = config.get('killexes', [])
+        self.usb_devices = config.get('usb_devices', [])
+        self.client_command = config.get('client_command')
+        self.client_undo_command = config.get('client_undo_command')
+        self.command = config.get('command')
+        self.wait_for_easy_anti_cheat = config.get('wait-for-easy-anti-cheat', True)
+        self.create_black_window = config.get('create-black-window', True)
+        self.monitor_process = config.get('monitor-process', True)
+        self.delay = config.get('delay', 0)
+        self.terminate_on_disconnect = config.get('terminate-on-disconnect', False)
+        self.terminate_on_disconnect_timeout = config.get('terminate-on-disconnect-timeout', 60)
+
+    @staticmethod
+    def validate(config):
+        if not isinstance(config, dict):
+            return 'the configuration is not an object'
+        if not isinstance(config.get('vm'), str) or not config.get('vm'):
+            return '"vm" must be a non-empty string'
+        for key in ('exes', 'killexes', 'usb_devices'):
+            if not isinstance(config.get(key, []), list):
+                return f'"{key}" must be a list'
+        return None
+
+# Registry of every app configuration. Configs are parsed once into HarmonyAppConfig records, persisted in a
+# cache keyed by file mtime and size, and only files whose stamp changed are parsed again on refresh.
+class HarmonyAppRegistry():
+    def __init__(self, apps_path, cache_file=None):
+        self.apps_path = apps_path
+        self.cache_file = cache_file or os.path.join(current_path, 'apps_cache.json')
+        self.lock = threading.RLock()
+        self.apps = {}
+        self.stamps = {}
+        self.vm_exes = {}
+        self.load_cache()
+        self.refresh()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION or cache.get('apps_path') != self.apps_path:
+            return
+        for app, entry in cache.get('apps', {}).items():
+            try:
+                stamp = (int(entry['mtime_ns']), int(entry['size']))
+                config = entry['config']
+            except (KeyError, TypeError, ValueError):
+                continue
+            if HarmonyAppConfig.validate(config) is None:
+                self.apps[app] = HarmonyAppConfig(app, config)
+                self.stamps[app] = stamp
+
+    def save_cache(self):
+        with self.lock:
+            cache = {
+                'version': CACHE_VERSION,
+                'apps_path': self.apps_path,
+                'apps': {app: {'mtime_ns': self.stamps[app][0], 'size': self.stamps[app][1], 'config': config.raw} for app, config in self.apps.items()},
+            }
+        try:
+            temp_file = f'{self.cache_file}.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(cache, f)
+            os.replace(temp_file, self.cache_file)
+        except OSError as e:
+            logger.log_to_file(f'[HarmonyAppRegistry] [Error] Failed to save the app cache: {e}')
+
+    def refresh(self):
+        stamps = {}
+        with os.scandir(self.apps_path) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and entry.is_file():
+                    stat = entry.stat()
+                    stamps[entry.name[:-len('.json')]] = (stat.st_mtime_ns, stat.st_size)
+
+        changed = False
+        with self.lock:
+            for app in list(self.stamps):
+                if app not in stamps:
+                    self.apps.pop(app, None)
+                    del self.stamps[app]
+                    changed = True
+            for app, stamp in stamps.items():
+                if self.stamps.get(app) == stamp:
+                    continue
+                changed = True
+                self.stamps[app] = stamp
+                self.apps.pop(app, None)
+                try:
+                    with open(os.path.join(self.apps_path, f'{app}.json'), 'r') as f:
+                        config = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.log_to_file(f'[HarmonyAppRegistry] [Error] Failed to load configuration for {app}: {e}')
+                    continue
+                error = HarmonyAppConfig.validate(config)
+                if error:
+                    logger.log_to_file(f'[HarmonyAppRegistry] [Error] Invalid configuration for {app}: {error}')
+                    continue
+                self.apps[app] = HarmonyAppConfig(app, config)
+            if changed or not self.vm_exes:
+                self.build_index()
+        if changed:
+            logger.log_to_file(f'[HarmonyAppRegistry] [Info] Loaded {len(self.apps)} app configurations.')
+            self.save_cache()
+
+    def build_index(self):
+        vm_exes = {}
+        for app, config in sorted(self.apps.items()):
+            vm_exes.setdefault(config.vm, []).append((app, config.exes))
+        self.vm_exes = vm_exes
+
+    def get(self, app):
+        with self.lock:
+            return self.apps.get(app)
+
+    def get_vm_exes(self, vm, exclude=None):
+        with self.lock:
+            return [exe for app, exes in self.vm_exes.get(vm, []) if app != exclude for exe in exes]
+
+harmony_registry = None
+harmony_registry_lock = threading.Lock()
+
+def get_harmony_registry():
+    global harmony_registry
+    with harmony_registry_lock:
+        if harmony_registry is None:
+            harmony_registry = HarmonyAppRegistry(os.path.join(current_path, 'apps'))
+        return harmony_registry
+
+def load_harmony_config(config_file=None):
+    config_file = config_file or os.path.join(current_path, 'harmony.json')
+    try:
+        with open(config_file, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,158 @@
+import glob
+import json
+import os
+import socket
+import threading
+import time
+
+from domain import STATE_RUNNING
+from logger import Logger
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+LEASE_FILES = '/var/lib/libvirt/dnsmasq/*.status'
+NEIGHBOUR_TABLE = '/proc/net/arp'
+
+# Resolves guest IP addresses without spawning processes. Entries are cached by domain UUID and MAC in
+# ip_cache.json across launches, a cached entry is trusted once a TCP probe to the guest listener succeeds,
+# otherwise the DHCP leases, the kernel neighbour table, the guest agent and libvirt's lease API are consulted in
+# that order.
+class HarmonyClientIpResolver():
+    def __init__(self, domain, cache_file=None, probe_port=5000, probe_timeout=0.25):
+        self.domain = domain
+        self.cache_file = cache_file or os.path.join(current_path, 'ip_cache.json')
+        self.probe_port = probe_port
+        self.probe_timeout = probe_timeout
+        self.lock = threading.Lock()
+        self.verified = {}
+        self.cache = self.load_cache()
+
+        self.domain.add_listener(self.on_domain_state)
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self):
+        try:
+            temp_file = f'{self.cache_file}.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(self.cache, f, indent=4)
+            os.replace(temp_file, self.cache_file)
+        except OSError as e:
+            logger.log_to_file(f'[HarmonyClientIpResolver] [Error] Failed to save the IP cache: {e}')
+
+    def on_domain_state(self, vm_name, state):
+        # Any transition may come with a new lease, so the next lookup probes the cached address again
+        with self.lock:
+            self.verified.pop(vm_name, None)
+        if state == STATE_RUNNING:
+            threading.Thread(target=self.refresh, args=(vm_name,), daemon=True).start()
+
+    def get_cached_entry(self, vm_name):
+        with self.lock:
+            for uuid, entry in self.cache.items():
+                if entry.get('name') == vm_name:
+                    return uuid, entry
+        return None, None
+
+    def probe(self, ip_address):
+        try:
+            with socket.create_connection((ip_address, self.probe_port), timeout=self.probe_timeout):
+                return True
+        except OSError:
+            return False
+
+    def read_leases(self):
+        leases = {}
+        for lease_file in glob.glob(LEASE_FILES):
+            try:
+                with open(lease_file, 'r') as f:
+                    content = f.read()
+                for lease in json.loads(content) if content.strip() else []:
+                    if lease.get('expiry-time', 0) >= time.time() and lease.get('mac-address'):
+                        leases[lease['mac-address'].lower()] = lease.get('ip-address')
+            except (OSError, ValueError) as e:
+                logger.log_to_file(f'[HarmonyClientIpResolver] [Warning] Failed to read lease file {lease_file}: {e}')
+        return leases
+
+    def read_neighbours(self):
+        neighbours = {}
+        try:
+            with open(NEIGHBOUR_TABLE, 'r') as f:
+                next(f, None)
+                for line in f:
+                    fields = line.split()
+                    # Flags 0x0 marks an incomplete entry
+                    if len(fields) >= 4 and fields[2] != '0x0' and fields[3] != '00:00:00:00:00:00':
+                        neighbours[fields[3].lower()] = fields[0]
+        except OSError:
+            pass
+        return neighbours
+
+    def lookup_sources(self, vm_name, macs):
+        leases = self.read_leases()
+        for mac in macs:
+            if leases.get(mac):
+                return mac, leases[mac], 'lease'
+
+        neighbours = self.read_neighbours()
+        for mac in macs:
+            if neighbours.get(mac):
+                return mac, neighbours[mac], 'neighbour'
+
+        for mac, ip_address in self.domain.get_agent_addresses(vm_name):
+            if mac in macs or not macs:
+                return mac, ip_address, 'agent'
+
+        # libvirt's lease API, on either backend, for networks whose status files are not readable here
+        for mac, ip_address in self.domain.get_lease_addresses(vm_name):
+            if mac in macs or not macs:
+                return mac, ip_address, 'domifaddr'
+        return None, None, None
+
+    def refresh(self, vm_name):
+        try:
+            uuid = self.domain.get_uuid(vm_name)
+            macs = self.domain.get_macs(vm_name)
+        except Exception as e:
+            logger.log_to_file(f'[HarmonyClientIpResolver] [Error] Failed to describe domain {vm_name}: {e}')
+            return None
+        mac, ip_address, source = self.lookup_sources(vm_name, macs)
+        if not ip_address:
+            return None
+
+        with self.lock:
+            entry = self.cache.get(uuid, {})
+            changed = entry.get('ip') != ip_address or entry.get('mac') != mac
+            self.cache[uuid] = {'name': vm_name, 'mac': mac, 'ip': ip_address, 'updated': time.time()}
+            self.verified[vm_name] = ip_address
+        if changed:
+            logger.log_to_file(f'[HarmonyClientIpResolver] [Info] Resolved {vm_name} ({mac}) to {ip_address} from {source}.')
+            self.save_cache()
+        return ip_address
+
+    def resolve(self, vm_name, timeout=500, interval=0.25):
+        with self.lock:
+            ip_address = self.verified.get(vm_name)
+        if ip_address:
+            return ip_address
+
+        uuid, entry = self.get_cached_entry(vm_name)
+        if entry and self.probe(entry['ip']):
+            with self.lock:
+                self.verified[vm_name] = entry['ip']
+            return entry['ip']
+
+        deadline = time.monotonic() + timeout
+        while True:
+            ip_address = self.refresh(vm_name)
+            if ip_address:
+                return ip_address
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(interval)
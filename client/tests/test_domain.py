@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from domain import STATE_PAUSED, STATE_RUNNING, STATE_STOPPED, HarmonyClientDomain, libvirt
+
+TEST_URI = 'test:///default'
+
+# Runs the libvirt backend against libvirt's built-in test driver, which has one running domain named `test`
+@unittest.skipIf(libvirt is None, 'libvirt-python is not installed')
+class HarmonyClientDomainTest(unittest.TestCase):
+    def setUp(self):
+        self.domain = HarmonyClientDomain(TEST_URI, 'libvirt')
+
+    def tearDown(self):
+        if self.domain.conn is not None:
+            self.domain.conn.unregisterCloseCallback()
+            self.domain.conn.close()
+
+    def test_connects_and_tracks_states(self):
+        self.assertEqual(self.domain.backend, 'libvirt')
+        self.assertEqual(self.domain.get_state('test'), STATE_RUNNING)
+        self.assertIn('test', self.domain.get_running_vms())
+
+    def test_lifecycle_events_update_states(self):
+        self.assertIsNone(self.domain.suspend('test'))
+        self.assertTrue(self.domain.wait_for_state('test', lambda state: state == STATE_PAUSED, 5))
+        # Paused is not stopped, the domain still holds its resources
+        self.assertFalse(self.domain.wait_until_stopped('test', 0.5))
+
+        self.assertIsNone(self.domain.resume('test'))
+        self.assertTrue(self.domain.wait_until_running('test', 5))
+
+        self.domain.lookup('test').destroy()
+        self.assertTrue(self.domain.wait_until_stopped('test', 5))
+        self.assertEqual(self.domain.get_state('test'), STATE_STOPPED)
+
+        self.domain.start('test')
+        self.assertTrue(self.domain.wait_until_running('test', 5))
+
+    def test_unreachable_libvirt_falls_back_to_virsh(self):
+        domain = HarmonyClientDomain('qemu+unix:///system?socket=/nonexistent/libvirt-sock', 'libvirt')
+        self.assertEqual(domain.backend, 'virsh')
+        self.assertIsNone(domain.conn)
+
+if __name__ == '__main__':
+    unittest.main()
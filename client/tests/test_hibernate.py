@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from hibernate import HarmonyClientHibernate
+
+# Domain service whose domains stop once they were told to hibernate
+class HarmonyHibernatingDomain():
+    def __init__(self):
+        self.signalled = set()
+        self.waited = []
+        self.lock = threading.Lock()
+
+    def wait_until_stopped(self, vm_name, timeout=500):
+        with self.lock:
+            self.waited.append(vm_name)
+        if vm_name in self.signalled:
+            return True
+        time.sleep(timeout)
+        return False
+
+# Guest listeners that take the hibernate command, except the ones that cannot be reached
+class HarmonyTestHibernate(HarmonyClientHibernate):
+    def __init__(self, unreachable=(), silent=()):
+        super().__init__()
+        self.common.domain = HarmonyHibernatingDomain()
+        self.unreachable = set(unreachable)
+        self.silent = set(silent)
+
+    def send_hibernate(self, vm_name, timeout=500):
+        if vm_name in self.unreachable:
+            return 'no IP address found'
+        if vm_name not in self.silent:
+            self.common.domain.signalled.add(vm_name)
+        return None
+
+class HarmonyClientHibernateTest(unittest.TestCase):
+    def test_every_domain_hibernates(self):
+        hibernate = HarmonyTestHibernate()
+        self.assertEqual(sorted(hibernate.hibernate_vms(['win10-games', 'win10-vr'], timeout=5)), ['win10-games', 'win10-vr'])
+
+    def test_signal_failure_is_not_waited_on(self):
+        hibernate = HarmonyTestHibernate(unreachable=['win10-vr'])
+        start = time.monotonic()
+        with self.assertRaises(SystemExit):
+            hibernate.hibernate_vms(['win10-games', 'win10-vr'], timeout=5)
+        # Reported as soon as the others hibernated, not after the timeout
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(hibernate.common.domain.waited, ['win10-games'])
+
+    def test_domain_that_does_not_stop_times_out(self):
+        hibernate = HarmonyTestHibernate(silent=['win10-vr'])
+        start = time.monotonic()
+        with self.assertRaises(SystemExit):
+            hibernate.hibernate_vms(['win10-games', 'win10-vr'], timeout=1)
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from logger import HarmonyClientLogWriter
+
+# Two writers on one file stand in for app.py and the daemon, each flushes through its own handle
+class HarmonyClientLogWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.log_file = os.path.join(tempfile.mkdtemp(), 'app.log')
+        self.writers = [HarmonyClientLogWriter(self.log_file, max_bytes=1000, backups=3, echo=False) for _ in range(2)]
+
+    def tearDown(self):
+        for writer in self.writers:
+            writer.close()
+
+    def read_all(self):
+        lines = []
+        for path in [self.log_file] + [f'{self.log_file}.{index}' for index in range(1, 4)]:
+            if os.path.exists(path):
+                with open(path) as f:
+                    lines.extend(f.read().splitlines())
+        return lines
+
+    def test_writer_follows_rotation_by_another_writer(self):
+        rotating, other = self.writers
+        other.flush(['other before'])
+        # Rotated past the backups, the file the other writer opened is gone
+        for index in range(4):
+            rotating.flush([f'rotating {index} ' + 'x' * 100] * 10)
+        other.flush(['other after'])
+
+        with open(self.log_file) as f:
+            self.assertIn('other after', f.read().splitlines())
+
+    def test_rotation_checks_the_path(self):
+        rotating, other = self.writers
+        other.flush(['other ' + 'x' * 100] * 9)
+        rotating.flush(['rotating ' + 'x' * 100] * 2)
+        rotating.flush(['rotating after'])
+        # Its old handle is past max_bytes now, but the path is the fresh file and must not be rotated away again
+        other.flush(['other again ' + 'x' * 100])
+
+        self.assertEqual(rotating.stats['rotations'] + other.stats['rotations'], 1)
+        self.assertIn('other again ' + 'x' * 100, self.read_all())
+
+if __name__ == '__main__':
+    unittest.main()
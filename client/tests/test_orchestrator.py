@@ -0,0 +1,62 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from orchestrator import HarmonyLaunchCancelled, HarmonyLaunchOrchestrator, HarmonyLaunchStep
+
+SLOW_STEP = 3
+
+def slow():
+    time.sleep(SLOW_STEP)
+
+def fail():
+    raise RuntimeError('step failed')
+
+# A failure must surface as soon as it happens, not once every blocking step running beside it has returned
+class HarmonyLaunchOrchestratorTest(unittest.TestCase):
+    def run_steps(self, steps, error):
+        start = time.monotonic()
+        with self.assertRaises(error):
+            HarmonyLaunchOrchestrator(steps).run()
+        return time.monotonic() - start
+
+    def test_timeout_does_not_wait_for_other_steps(self):
+        elapsed = self.run_steps([
+            HarmonyLaunchStep('slow', slow),
+            HarmonyLaunchStep('stuck', slow, timeout=0.5),
+        ], asyncio.TimeoutError)
+        self.assertLess(elapsed, SLOW_STEP - 1)
+
+    def test_failure_does_not_wait_for_other_steps(self):
+        elapsed = self.run_steps([
+            HarmonyLaunchStep('slow', slow),
+            HarmonyLaunchStep('fail', fail),
+        ], RuntimeError)
+        self.assertLess(elapsed, SLOW_STEP - 1)
+
+    def test_dependencies_run_in_order(self):
+        order = []
+        orchestrator = HarmonyLaunchOrchestrator([
+            HarmonyLaunchStep('second', lambda: order.append('second'), depends=['first']),
+            HarmonyLaunchStep('first', lambda: order.append('first')),
+        ])
+        orchestrator.run()
+        self.assertEqual(order, ['first', 'second'])
+
+    def test_cancel_skips_remaining_steps(self):
+        order = []
+        cancelled = []
+        orchestrator = HarmonyLaunchOrchestrator([
+            HarmonyLaunchStep('first', lambda: cancelled.append(True)),
+            HarmonyLaunchStep('second', lambda: order.append('second'), depends=['first']),
+        ], cancelled=lambda: bool(cancelled))
+        with self.assertRaises(HarmonyLaunchCancelled):
+            orchestrator.run()
+        self.assertEqual(order, [])
+
+if __name__ == '__main__':
+    unittest.main()
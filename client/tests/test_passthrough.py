@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from domain import HarmonyClientDomain, libvirt
+from passthrough import HarmonyClientPassthrough
+
+TEST_URI = 'test:///default'
+DEVICES = [
+    {'vendor_id': '28de', 'product_id': '2100', 'bus': '001', 'device': '004'},
+    {'vendor_id': '28de', 'product_id': '2101', 'bus': '001', 'device': '005'},
+]
+
+# Attaches and detaches USB hostdevs on the running `test` domain of libvirt's test driver, which goes through
+# update_device's libvirt path with AFFECT_LIVE | AFFECT_CONFIG
+@unittest.skipIf(libvirt is None, 'libvirt-python is not installed')
+class HarmonyClientPassthroughTest(unittest.TestCase):
+    def setUp(self):
+        self.domain = HarmonyClientDomain(TEST_URI, 'libvirt')
+        self.passthrough = HarmonyClientPassthrough('test', self.domain)
+
+    def tearDown(self):
+        self.passthrough.detach(DEVICES)
+        self.domain.conn.unregisterCloseCallback()
+        self.domain.conn.close()
+
+    def get_usb_ids(self):
+        return sorted((hostdev['vendor_id'], hostdev['product_id']) for hostdev in self.domain.get_description('test').usb_hostdevs)
+
+    def test_attach_and_detach_usb_hostdevs(self):
+        self.assertTrue(self.domain.lookup('test').isActive())
+        results = self.passthrough.attach(DEVICES)
+        errors = [result['error'] for result in results if not result['ok']]
+        if errors and all('not supported' in error for error in errors):
+            self.skipTest(f'the test driver of this libvirt cannot attach devices: {errors[0]}')
+        self.assertEqual(errors, [])
+        self.assertEqual(self.get_usb_ids(), [('28de', '2100'), ('28de', '2101')])
+
+        results = self.passthrough.detach(DEVICES[:1])
+        self.assertTrue(all(result['ok'] for result in results), results)
+        self.assertEqual(self.get_usb_ids(), [('28de', '2101')])
+
+        # Detaching what is not attached reports the error instead of raising
+        results = self.passthrough.detach(DEVICES[:1])
+        self.assertFalse(results[0]['ok'])
+        self.assertTrue(results[0]['error'])
+
+if __name__ == '__main__':
+    unittest.main()
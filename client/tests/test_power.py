@@ -0,0 +1,80 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import domain as harmony_domain
+from domain import STATE_RUNNING, STATE_STOPPED, HarmonyClientDomain, libvirt
+from passthrough import HarmonyClientPassthrough
+from power import HarmonyClientPower
+
+TEST_URI = 'test:///default'
+DEVICE = {'vendor_id': '28de', 'product_id': '2100', 'bus': '001', 'device': '004'}
+
+# Domain whose managed save can no longer be restored, as after a USB device of the saved definition was replugged
+class HarmonyBrokenRestoreDomain():
+    def __init__(self):
+        self.saved = True
+        self.calls = []
+
+    def start(self, vm_name):
+        self.calls.append('start')
+        return 'Requested operation is not valid: USB device 001:004 not found' if self.saved else None
+
+    def has_managed_save(self, vm_name):
+        return self.saved
+
+    def managed_save_remove(self, vm_name):
+        self.calls.append('managedsave-remove')
+        self.saved = False
+        return None
+
+def new_power(domain):
+    power = HarmonyClientPower({'domains': ['test']}, os.path.join(tempfile.mkdtemp(), 'power.jsonl'))
+    power.common.domain = domain
+    return power
+
+class HarmonyClientPowerRestoreTest(unittest.TestCase):
+    def test_failed_restore_boots_cold(self):
+        domain = HarmonyBrokenRestoreDomain()
+        self.assertIsNone(new_power(domain).start_domain('test'))
+        self.assertEqual(domain.calls, ['start', 'managedsave-remove', 'start'])
+
+# The managedsave tier on libvirt's test driver, whose running `test` domain gets a USB hostdev first
+@unittest.skipIf(libvirt is None, 'libvirt-python is not installed')
+class HarmonyClientPowerManagedSaveTest(unittest.TestCase):
+    def setUp(self):
+        self.domain = HarmonyClientDomain(TEST_URI, 'libvirt')
+        harmony_domain.harmony_domain = self.domain
+        self.power = new_power(self.domain)
+
+    def tearDown(self):
+        harmony_domain.harmony_domain = None
+        self.domain.conn.unregisterCloseCallback()
+        self.domain.conn.close()
+
+    def test_managedsave_detaches_usb_devices(self):
+        results = HarmonyClientPassthrough('test', self.domain).attach([DEVICE])
+        if not results[0]['ok'] and 'not supported' in results[0]['error']:
+            self.skipTest(results[0]['error'])
+        self.power.mark_idle('test')
+        self.power.enter_tier('test', 'managedsave')
+
+        self.assertTrue(self.domain.wait_until_stopped('test', 5))
+        self.assertTrue(self.domain.has_managed_save('test'))
+        self.assertEqual(self.domain.get_description('test').usb_hostdevs, [])
+
+        self.assertIsNotNone(self.power.resume('test'))
+        self.assertEqual(self.domain.get_state('test'), STATE_RUNNING)
+        self.assertFalse(self.domain.has_managed_save('test'))
+
+    def test_resume_without_save_is_left_to_the_normal_start(self):
+        self.domain.lookup('test').destroy()
+        self.assertTrue(self.domain.wait_until_stopped('test', 5))
+        self.assertEqual(self.domain.get_state('test'), STATE_STOPPED)
+        self.assertIsNone(self.power.resume('test'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from resolver import HarmonyClientIpResolver
+
+MAC = '52:54:00:aa:bb:cc'
+
+# Domain service on a network whose dnsmasq status files are not readable here, only libvirt's APIs know the lease
+class HarmonyLeaseOnlyDomain():
+    backend = 'libvirt'
+
+    def __init__(self, agent=(), leases=()):
+        self.agent = list(agent)
+        self.leases = list(leases)
+
+    def add_listener(self, listener):
+        pass
+
+    def get_agent_addresses(self, vm_name):
+        return self.agent
+
+    def get_lease_addresses(self, vm_name):
+        return self.leases
+
+def new_resolver(domain):
+    return HarmonyClientIpResolver(domain, os.path.join(tempfile.mkdtemp(), 'ip_cache.json'))
+
+class HarmonyClientIpResolverTest(unittest.TestCase):
+    def test_lease_api_is_the_last_source(self):
+        resolver = new_resolver(HarmonyLeaseOnlyDomain(leases=[('52:54:00:00:00:01', '192.168.122.9'), (MAC, '192.168.122.10')]))
+        self.assertEqual(resolver.lookup_sources('win10', [MAC]), (MAC, '192.168.122.10', 'domifaddr'))
+
+    def test_agent_comes_before_the_lease_api(self):
+        resolver = new_resolver(HarmonyLeaseOnlyDomain(agent=[(MAC, '10.0.0.5')], leases=[(MAC, '192.168.122.10')]))
+        self.assertEqual(resolver.lookup_sources('win10', [MAC]), (MAC, '10.0.0.5', 'agent'))
+
+    def test_no_address_from_any_source(self):
+        resolver = new_resolver(HarmonyLeaseOnlyDomain())
+        self.assertEqual(resolver.lookup_sources('win10', [MAC]), (None, None, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from timeline import HarmonyTimeline
+
+class HarmonyTimelineTest(unittest.TestCase):
+    def setUp(self):
+        self.trace_dir = tempfile.mkdtemp()
+
+    def test_outcome_is_saved(self):
+        timeline = HarmonyTimeline('game', self.trace_dir)
+        with timeline.span('launch steps'):
+            pass
+        timeline.set_outcome('error', "TimeoutError()")
+        timeline.save()
+
+        with open(timeline.trace_file) as f:
+            trace = json.load(f)
+        self.assertEqual(trace['otherData'], {'name': 'game', 'outcome': 'error', 'error': 'TimeoutError()'})
+        self.assertIn('outcome', [event['name'] for event in trace['traceEvents']])
+
+    def test_only_the_newest_traces_are_kept(self):
+        for index in range(5):
+            path = os.path.join(self.trace_dir, f'old-{index}.json')
+            with open(path, 'w') as f:
+                f.write('{}')
+            os.utime(path, (index, index))
+        timeline = HarmonyTimeline('game', self.trace_dir, max_traces=3)
+        timeline.save()
+
+        self.assertEqual(sorted(os.listdir(self.trace_dir)), sorted([os.path.basename(timeline.trace_file), 'old-3.json', 'old-4.json']))
+
+if __name__ == '__main__':
+    unittest.main()
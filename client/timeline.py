@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from logger import Logger
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+# Records the phases of a launch as timed spans and writes them in the Chrome trace-event format, which can be
+# opened in chrome://tracing or ui.perfetto.dev. Timestamps are wall clock microseconds so that client and
+# guest traces of the same launch can be lined up. Only the newest max_traces traces of the directory are kept.
+class HarmonyTimeline():
+    def __init__(self, name, trace_dir=None, max_traces=50):
+        self.name = name
+        self.trace_dir = trace_dir or os.path.join(current_path, 'traces')
+        self.max_traces = max_traces
+        self.outcome = None
+        self.trace_file = os.path.join(self.trace_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        self.pid = os.getpid()
+        self.events = []
+        self.tracks = {}
+        self.lock = threading.Lock()
+
+    def now(self):
+        return time.time_ns() // 1000
+
+    def get_track(self, track=None):
+        # Threads get their own track unless the caller names one, e.g. for concurrent asyncio steps
+        key = track or threading.current_thread().name
+        with self.lock:
+            if key not in self.tracks:
+                tid = len(self.tracks) + 1
+                self.tracks[key] = tid
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': key}})
+            return self.tracks[key]
+
+    def add_span(self, name, start, end, category='launch', track=None, args=None):
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start, 'dur': max(0, end - start), 'pid': self.pid, 'tid': self.get_track(track)}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    def instant(self, name, category='launch', track=None, args=None):
+        event = {'name': name, 'cat': category, 'ph': 'i', 's': 't', 'ts': self.now(), 'pid': self.pid, 'tid': self.get_track(track)}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category='launch', track=None, args=None):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, self.now(), category, track, args)
+
+    # How the launch ended, kept in the trace metadata and marked on the summary track
+    def set_outcome(self, outcome, error=None):
+        args = {'outcome': outcome}
+        if error:
+            args['error'] = error
+        with self.lock:
+            self.outcome = args
+        self.instant('outcome', 'summary', track='summary', args=args)
+
+    def save(self):
+        with self.lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms', 'otherData': dict({'name': self.name}, **(self.outcome or {}))}
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            with open(self.trace_file, 'w') as f:
+                json.dump(trace, f)
+            logger.log_to_file(f'[HarmonyTimeline] [Info] Wrote launch trace to {self.trace_file}')
+        except OSError as e:
+            logger.log_to_file(f'[HarmonyTimeline] [Error] Failed to write launch trace: {e}')
+        self.prune()
+
+    def prune(self):
+        if not self.max_traces:
+            return
+        try:
+            traces = [entry for entry in os.scandir(self.trace_dir) if entry.name.endswith('.json') and entry.is_file()]
+        except OSError:
+            return
+        traces.sort(key=get_mtime, reverse=True)
+        for entry in traces[self.max_traces:]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass # Pruned by another process already
+
+# Timeline that is not written anywhere, used when no launch is being recorded
+class HarmonyNullTimeline(HarmonyTimeline):
+    def add_span(self, name, start, end, category='launch', track=None, args=None):
+        pass
+
+    def instant(self, name, category='launch', track=None, args=None):
+        pass
+
+    def save(self):
+        pass
+
+def get_mtime(entry):
+    try:
+        return entry.stat().st_mtime
+    except OSError:
+        return 0
+
+harmony_timeline = HarmonyNullTimeline('none')
+
+def get_harmony_timeline():
+    return harmony_timeline
+
+def set_harmony_timeline(timeline):
+    global harmony_timeline
+    harmony_timeline = timeline
+    return timeline
@@ -1,184 +1,272 @@
 import os
 import pyudev
-import re
-import subprocess
+import queue
 import sys
+import threading
+import time
 
+from domain import STATE_PAUSED, STATE_RUNNING
 from logger import Logger
+from passthrough import HarmonyClientPassthrough
+from timeline import get_harmony_timeline
+from usb_cache import get_harmony_usb_cache
+from usb_index import HarmonyUsbIndex
 
 current_path = os.path.dirname(os.path.realpath(__file__))
 logger = Logger(os.path.join(current_path, 'app.log'), False)
 
+def get_device_key(device):
+    return (device['vendor_id'].lower(), device['product_id'].lower(), int(device['bus']), int(device['device']))
+
+def get_event_address(properties):
+    busnum = properties.get('BUSNUM', '')
+    devnum = properties.get('DEVNUM', '')
+    if busnum.isdigit() and devnum.isdigit():
+        return (int(busnum), int(devnum))
+    return None
+
+# Keeps the USB devices the domain should have (configured names matched against the connected devices) and the
+# ones it actually has, and applies only the difference. A udev event carries the bus and device number of the
+# device that changed, so plugging or unplugging one dongle never touches the other passthrough devices.
 class HarmonyClientUsb:
-    def __init__(self, app_vm, usb_devices):
+    def __init__(self, app_vm, usb_devices, debounce=0.25, app=None):
+        self.app = app
         self.app_vm = app_vm
         self.usb_devices = usb_devices
+        self.debounce = debounce
+        self.monitor_stop = threading.Event()
+        self.index = HarmonyUsbIndex()
+        # Resolved names are remembered per app, without an app every reconciliation matches from scratch
+        self.cache = get_harmony_usb_cache() if app else None
+        self.passthrough = HarmonyClientPassthrough(app_vm)
+        self.reconcile_lock = threading.Lock()
+        # Devices attached to the domain by key, loaded from the domain XML the first time it is needed
+        self.attached = None
+        # Addresses of the attached devices, read by the monitor thread without waiting for a reconciliation
+        self.attached_addresses = None
+        # vendor:product ids that matched a configured name, so that events for them are never filtered out
+        self.known_ids = set()
 
     def remove_hostdev_usb_entries(self):
-        xml_file = f'/tmp/{self.app_vm}.xml'
-        with open(xml_file, 'w') as file:
-            file.write('')
-        subprocess.check_output(f'virsh dumpxml {self.app_vm} > {xml_file}', shell=True, text=True)
-        logger.log_to_file(f'[HarmonyClientUsb] [Info] Dumped XML to {xml_file}')
-        with open(xml_file, 'r+') as file:
-            content = file.read()
-            content = re.sub(r'<hostdev mode=.subsystem. type=.usb. managed=.yes.>.*?</hostdev>', '', content, flags=re.DOTALL)
-            file.seek(0)
-            file.write(content)
-            file.truncate()
-        subprocess.run(['virsh', 'define', xml_file])
+        domain = self.passthrough.domain
+        with self.reconcile_lock:
+            description = domain.get_description(self.app_vm)
+            if domain.get_state(self.app_vm) in (STATE_RUNNING, STATE_PAUSED):
+                # A running domain has to release the devices, the definition alone isn't enough
+                results = self.passthrough.detach(self.get_attached_usb_devices())
+                self.attached = {get_device_key(result['device']): result['device'] for result in results if not result['ok']}
+            elif description.usb_hostdevs:
+                edited = description.edit()
+                removed = edited.remove_usb_hostdevs()
+                error = domain.define_description(self.app_vm, edited)
+                if error:
+                    logger.log_to_file(f'[HarmonyClientUsb] [Error] Failed to remove the USB host devices of {self.app_vm}: {error}')
+                    self.attached = None
+                else:
+                    logger.log_to_file(f'[HarmonyClientUsb] [Info] Removed {removed} USB host devices from {self.app_vm}.')
+                    self.attached = {}
+            else:
+                self.attached = {}
+            self.attached_addresses = frozenset((key[2], key[3]) for key in self.attached) if self.attached is not None else None
 
     def find_device_info(self, device_name):
-        try:
-            # Get a list of all connected USB devices
-            output = subprocess.check_output(['lsusb'], text=True)
-            matching_devices = []
-
-            logger.log_to_file("[HarmonyClientUsb] [Info] All USB devices:")
-            for line in output.splitlines():
-                if device_name.lower() in line.lower():
-                    match = re.search(r'Bus (\d+) Device (\d+): ID (\w+):(\w+)\s*(.*)', line)
-                    if match:
-                        bus, device, vendor_id, product_id, product = match.groups()
-                        matching_devices.append({
-                            'bus': bus,
-                            'device': device,
-                            'vendor_id': vendor_id,
-                            'product_id': product_id,
-                            'product': product.strip()
-                        })
-
-            logger.log_to_file(f"[HarmonyClientUsb] [Info] Matching devices for '{device_name}':")
-            for device in matching_devices:
-                logger.log_to_file(f"[HarmonyClientUsb] [Info] Bus {device['bus']}, Device {device['device']}: ID {device['vendor_id']}:{device['product_id']} ({device['product']})")
-
-            return matching_devices
-        except subprocess.CalledProcessError as e:
-            logger.log_to_file(f"[HarmonyClientUsb] [Error] Error finding USB devices: {str(e)}")
-
-    def update_vm_usb(self, device_name, command):
-        matching_devices = self.find_device_info(device_name)
-        if not matching_devices:
-            logger.log_to_file(f"[HarmonyClientUsb] [Error] Could not find any devices matching '{device_name}'")
-    
+        # Matched against the index built once for the current event, see refresh_devices
+        matching_devices = self.index.match(device_name)
+
+        logger.log_to_file(f"[HarmonyClientUsb] [Info] Matching devices for '{device_name}':")
         for device in matching_devices:
-            # XML template for the USB device
-            xml = f"""
-            <hostdev mode='subsystem' type='usb' managed='yes'>
-              <source>
-                <vendor id='0x{device["vendor_id"]}'/>
-                <product id='0x{device["product_id"]}'/>
-                <address bus='{device["bus"]}' device='{int(device["device"])}'/>
-              </source>
-            </hostdev>
-            """
-            logger.log_to_file(f"[HarmonyClientUsb] [Info] Running virsh {command} {self.app_vm} for USB device: {device['vendor_id']}:{device['product_id']} (Bus {device['bus']}, Device {device['device']})")
-            process = subprocess.run(
-                ['virsh', command, self.app_vm, '/dev/stdin', '--persistent'],
-                input=xml,
-                text=True,
-                capture_output=True
-            )
-            if process.returncode != 0:
-                logger.log_to_file(f"[HarmonyClientUsb] [Error] Error running virsh command: {command}")
-                logger.log_to_file(f"[HarmonyClientUsb] [Error] Error output: {process.stderr}")
+            logger.log_to_file(f"[HarmonyClientUsb] [Info] Bus {device['bus']}, Device {device['device']}: ID {device['vendor_id']}:{device['product_id']} ({device['product']})")
+
+        return matching_devices
+
+    def refresh_devices(self):
+        return self.index.refresh()
+
+    def get_configured_devices(self):
+        return [usb_device for usb_device in self.usb_devices if usb_device.strip()]
+
+    def get_desired_devices(self):
+        desired = {}
+        resolved = {}
+        unresolved = []
+        ports = self.index.list_ports() if self.cache else None
+        for usb_device in self.get_configured_devices():
+            devices = self.cache.resolve(self.app, usb_device, self.index, ports) if self.cache else None
+            if devices is None:
+                unresolved.append(usb_device)
             else:
-                logger.log_to_file(f"[HarmonyClientUsb] [Info] Successfully ran virsh {command} {self.app_vm} for USB device: {device['vendor_id']}:{device['product_id']} (Bus {device['bus']}, Device {device['device']})")
+                resolved[usb_device] = devices
+
+        if unresolved:
+            # Only names whose devices changed need the full index
+            self.refresh_devices()
+            for usb_device in unresolved:
+                resolved[usb_device] = self.find_device_info(usb_device)
+                if self.cache:
+                    self.cache.store(self.app, usb_device, resolved[usb_device], ports)
+            if self.cache:
+                self.cache.save()
+        if self.cache:
+            stats = self.cache.get_stats()
+            logger.log_to_file(f"[HarmonyClientUsb] [Info] Resolved {len(resolved) - len(unresolved)} of {len(resolved)} USB device names of {self.app} from the cache ({stats['hits']} hits, {stats['misses']} misses in total).")
+
+        for usb_device, devices in resolved.items():
+            if not devices:
+                logger.log_to_file(f"[HarmonyClientUsb] [Error] Could not find any devices matching '{usb_device}'")
+            for device in devices:
+                desired[get_device_key(device)] = device
+                self.known_ids.add(f"{device['vendor_id']}:{device['product_id']}")
+        return desired
+
+    # Applies the difference between the desired and the attached devices. With a set of (bus, device number)
+    # addresses only those devices are considered, everything else is left as it is.
+    def reconcile(self, addresses=None):
+        with self.reconcile_lock:
+            desired = self.get_desired_devices()
+            if self.attached is None:
+                self.attached = {get_device_key(device): device for device in self.get_attached_usb_devices()}
+            attached = self.attached
+
+            in_scope = lambda key: addresses is None or (key[2], key[3]) in addresses
+            to_detach = [device for key, device in attached.items() if key not in desired and in_scope(key)]
+            to_attach = [device for key, device in desired.items() if key not in attached and in_scope(key)]
+            logger.log_to_file(f'[HarmonyClientUsb] [Info] Reconciling USB devices of {self.app_vm}: {len(to_attach)} to attach, {len(to_detach)} to detach, {len(attached)} attached.')
+
+            for result in self.passthrough.apply(attach=to_attach, detach=to_detach):
+                if not result['ok']:
+                    continue
+                if result['command'] == 'attach-device':
+                    attached[get_device_key(result['device'])] = result['device']
+                else:
+                    del attached[get_device_key(result['device'])]
+            self.attached_addresses = frozenset((key[2], key[3]) for key in attached)
+            return to_attach, to_detach
+
+    def is_relevant_event(self, action, properties):
+        if properties.get('DEVTYPE') != 'usb_device' or action not in ('add', 'remove'):
+            return False
+        if action == 'remove':
+            attached_addresses = self.attached_addresses
+            address = get_event_address(properties)
+            return attached_addresses is None or address is None or address in attached_addresses
+        if f"{properties.get('ID_VENDOR_ID', '')}:{properties.get('ID_MODEL_ID', '')}".lower() in self.known_ids:
+            return True
+        names = [properties.get(name, '') for name in ('ID_VENDOR_FROM_DATABASE', 'ID_MODEL_FROM_DATABASE', 'ID_VENDOR', 'ID_MODEL')]
+        if not any(names):
+            return True # Nothing to match against, leave it to the index
+        description = '\n'.join([
+            f'{names[0]} {names[1]}',
+            f'{names[2]} {names[3]}'.replace('_', ' '),
+            f"{properties.get('ID_VENDOR_ID', '')}:{properties.get('ID_MODEL_ID', '')}",
+            properties.get('ID_SERIAL_SHORT', ''),
+            os.path.basename(properties.get('DEVPATH', '')),
+        ]).lower()
+        return any(usb_device.lower().strip() in description for usb_device in self.get_configured_devices())
+
+    def handle_usb_events(self, events):
+        addresses = set()
+        for action, properties in events:
+            address = get_event_address(properties)
+            logger.log_to_file(f"[HarmonyClientUsb] [Info] Detected {action} of USB device {properties.get('ID_VENDOR_ID')}:{properties.get('ID_MODEL_ID')} (Bus {properties.get('BUSNUM')}, Device {properties.get('DEVNUM')}).")
+            if address is None:
+                # Events without the device address fall back to a full reconciliation
+                addresses = None
+            elif addresses is not None:
+                addresses.add(address)
+        with get_harmony_timeline().span('usb events', 'usb', args={'events': len(events)}):
+            self.reconcile(addresses)
 
     def monitor_usb_changes(self):
-        if not self.usb_devices or (len(self.usb_devices) == 1 and self.usb_devices[0] == ""):
+        if not self.get_configured_devices():
             return
-        self.usb_devices = [usb_device.lower() for usb_device in self.usb_devices]
 
         context = pyudev.Context()
         monitor = pyudev.Monitor.from_netlink(context)
-        monitor.filter_by('usb')
+        monitor.filter_by('usb', 'usb_device')
+        monitor.start()
 
-        for action, device in monitor:
-            if action == 'add':
-                self.handle_usb_addition()
-            elif action == 'remove':
-                self.handle_usb_removal()
+        events = HarmonyClientUsbEvents(self, self.debounce)
+        events.start()
+        # Polled with a timeout so that the monitor can be stopped once Looking Glass exits
+        try:
+            while not self.monitor_stop.is_set():
+                device = monitor.poll(timeout=1)
+                if device is not None:
+                    events.push(device.action, dict(device.properties))
+        finally:
+            events.stop()
+
+    def stop_monitor(self):
+        self.monitor_stop.set()
 
     def get_attached_usb_devices(self):
-        xml_file = f'/tmp/{self.app_vm}.xml'
-
-        # Dump the current XML configuration of the VM
-        subprocess.check_output(f'virsh dumpxml {self.app_vm} > {xml_file}', shell=True, text=True)
-        logger.log_to_file(f'[HarmonyClientUsb] [Info] Dumped XML to {xml_file}')
-
-        # Read the XML file and find USB host devices
-        with open(xml_file, 'r') as file:
-            content = file.read()
-
-            # Use regex to find all <hostdev> entries for USB devices
-            matches = re.findall(r'<hostdev mode=\'subsystem\' type=\'usb\' managed=\'yes\'>.*?</hostdev>', content, flags=re.DOTALL)
-
-        # Extract vendor, product IDs, and address from matches
-        attached_devices = []
-        for match in matches:
-            vendor_match = re.search(r'<vendor id=\'0x(\w+)\'/>', match)
-            product_match = re.search(r'<product id=\'0x(\w+)\'/>', match)
-            address_match = re.search(r'<address bus=\'(\d+)\' device=\'(\d+)\'/>', match)
-
-            if vendor_match and product_match and address_match:
-                vendor_id = vendor_match.group(1)
-                product_id = product_match.group(1)
-                bus = address_match.group(1)
-                device = address_match.group(2)
-                attached_devices.append({
-                    'id': f'{vendor_id}:{product_id}',
-                    'bus': bus,
-                    'device': device
-                })
-
-        return attached_devices
+        # Served from the parsed description, fetched again only once the domain has changed
+        description = self.passthrough.domain.get_description(self.app_vm)
+        return [dict(hostdev) for hostdev in description.usb_hostdevs if hostdev['bus'] and hostdev['device']]
 
     def handle_usb_addition(self):
-        logger.log_to_file("[HarmonyClientUsb] [Info] Detected addition of USB device.")
-        for usb_device in self.usb_devices:
-            self.update_vm_usb(usb_device, 'attach-device')
-
-    def detach_usb_device(self, device):
-        # Extract vendor and product IDs, and the bus/device numbers from the dictionary
-        vendor_id, product_id = device['id'].split(':')
-        bus = device['bus']
-        device_number = device['device']
-
-        # Construct XML to detach the device
-        xml = f"""
-<hostdev mode='subsystem' type='usb' managed='yes'>
-  <source>
-    <vendor id='0x{vendor_id}'/>
-    <product id='0x{product_id}'/>
-    <address bus='{bus}' device='{device_number}'/>
-  </source>
-</hostdev>
-        """
-
-        logger.log_to_file(f"[HarmonyClientUsb] [Info] Running virsh detach-device for USB device: {vendor_id}:{product_id} (Bus {bus}, Device {device_number})")
-        
-        process = subprocess.run(
-            ['virsh', 'detach-device', self.app_vm, '/dev/stdin', '--persistent'],
-            input=xml,
-            text=True,
-            capture_output=True
-        )
-        if process.returncode != 0:
-            logger.log_to_file(f"[HarmonyClientUsb] [Error] Error detaching device {vendor_id}:{product_id}: {process.stderr}")
-        else:
-            logger.log_to_file(f"[HarmonyClientUsb] [Info] Successfully detached device {vendor_id}:{product_id} (Bus {bus}, Device {device_number}).")
+        logger.log_to_file("[HarmonyClientUsb] [Info] Attaching the configured USB devices.")
+        with get_harmony_timeline().span('handle_usb_addition', 'usb'):
+            self.reconcile()
 
     def handle_usb_removal(self):
-        logger.log_to_file("[HarmonyClientUsb] [Info] Detected removal of USB device.")
+        logger.log_to_file("[HarmonyClientUsb] [Info] Detaching the USB devices that are no longer wanted.")
+        with get_harmony_timeline().span('handle_usb_removal', 'usb'):
+            self.reconcile()
+
+# Debounces the udev events of the USB monitor. A composite device such as a headset announces itself with a burst
+# of events, every burst is collected until no event has arrived for the debounce window and then reconciled once.
+class HarmonyClientUsbEvents():
+    def __init__(self, usb, debounce=0.25):
+        self.usb = usb
+        self.debounce = debounce
+        self.queue = queue.Queue()
+        self.stats = {'seen': 0, 'acted': 0, 'reconciles': 0}
+        self.thread = None
 
-        # List all USB devices currently in use by the VM
-        attached_devices = self.get_attached_usb_devices()
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'usb-events-{self.usb.app_vm}')
+        self.thread.daemon = True
+        self.thread.start()
 
-        # Detach invalid devices
-        for device_name in attached_devices:
-            logger.log_to_file(f"[HarmonyClientUsb] [Info] Detaching USB device: {device_name}")
-            self.detach_usb_device(device_name)
+    def stop(self):
+        self.queue.put(None)
+        if self.thread:
+            self.thread.join()
+        logger.log_to_file(f"[HarmonyClientUsbEvents] [Info] Seen {self.stats['seen']} USB events, acted on {self.stats['acted']} in {self.stats['reconciles']} reconciliations.")
+
+    def push(self, action, properties):
+        self.stats['seen'] += 1
+        if not self.usb.is_relevant_event(action, properties):
+            return
+        self.stats['acted'] += 1
+        self.queue.put((action, properties))
 
-        for usb_device in self.usb_devices:
-            self.update_vm_usb(usb_device, 'attach-device')
\ No newline at end of file
+    def run(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            events = [event]
+            deadline = time.monotonic() + self.debounce
+            stopping = False
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                events.append(event)
+                deadline = time.monotonic() + self.debounce
+            self.stats['reconciles'] += 1
+            try:
+                self.usb.handle_usb_events(events)
+            except Exception as e:
+                logger.log_to_file(f'[HarmonyClientUsbEvents] [Error] Error reconciling USB devices: {e}')
+            if stopping:
+                return
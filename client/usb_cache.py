@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+
+from logger import Logger
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+CACHE_VERSION = 1
+IDENTITY_KEYS = ('vendor_id', 'product_id', 'serial', 'port', 'product')
+
+# Remembers which connected devices every configured usb_devices name resolved to, per app. An entry is only used
+# while the same devices are plugged into the same ports, which sysfs answers without building the whole index.
+class HarmonyUsbCache():
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file or os.path.join(current_path, 'usb_cache.json')
+        self.lock = threading.Lock()
+        self.apps = {}
+        self.stats = {'hits': 0, 'misses': 0}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return
+        if isinstance(cache, dict) and cache.get('version') == CACHE_VERSION and isinstance(cache.get('apps'), dict):
+            self.apps = cache['apps']
+
+    def save(self):
+        with self.lock:
+            cache = {'version': CACHE_VERSION, 'apps': self.apps}
+            try:
+                temp_file = f'{self.cache_file}.tmp'
+                with open(temp_file, 'w') as f:
+                    json.dump(cache, f)
+                os.replace(temp_file, self.cache_file)
+            except OSError as e:
+                logger.log_to_file(f'[HarmonyUsbCache] [Error] Failed to save the USB device cache: {e}')
+
+    # Returns the devices the name resolved to last time, or None when the devices have changed since
+    def resolve(self, app, device_name, index, ports):
+        with self.lock:
+            entry = self.apps.get(app, {}).get(device_name.lower())
+        devices = None
+        if entry and entry.get('ports') == ports:
+            devices = []
+            for identity in entry.get('devices', []):
+                device = index.read_device(identity['port'], ({}, {}))
+                if not device or any(device[key] != identity[key] for key in ('vendor_id', 'product_id', 'serial')):
+                    devices = None
+                    break
+                device['product'] = identity.get('product') or device['product']
+                devices.append(device)
+        with self.lock:
+            self.stats['hits' if devices is not None else 'misses'] += 1
+        return devices
+
+    def store(self, app, device_name, devices, ports):
+        with self.lock:
+            self.apps.setdefault(app, {})[device_name.lower()] = {
+                'ports': ports,
+                'devices': [{key: device.get(key, '') for key in IDENTITY_KEYS} for device in devices],
+            }
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+harmony_usb_cache = None
+harmony_usb_cache_lock = threading.Lock()
+
+def get_harmony_usb_cache():
+    global harmony_usb_cache
+    with harmony_usb_cache_lock:
+        if harmony_usb_cache is None:
+            harmony_usb_cache = HarmonyUsbCache()
+        return harmony_usb_cache
@@ -0,0 +1,147 @@
+import os
+import re
+import threading
+import time
+
+from logger import Logger
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+SYSFS_USB_DEVICES = '/sys/bus/usb/devices'
+USB_IDS_VENDOR = re.compile(r'[0-9a-fA-F]{4}\s')
+USB_IDS_PATHS = ['/usr/share/hwdata/usb.ids', '/usr/share/misc/usb.ids', '/usr/share/usb.ids', '/var/lib/usbutils/usb.ids']
+
+usb_ids = None
+usb_ids_lock = threading.Lock()
+
+# Vendor and product names from the usb.ids database, the same names lsusb prints. Parsed once per process.
+def get_usb_ids():
+    global usb_ids
+    with usb_ids_lock:
+        if usb_ids is None:
+            paths = [os.environ['HARMONY_USB_IDS']] if os.environ.get('HARMONY_USB_IDS') else USB_IDS_PATHS
+            usb_ids = load_usb_ids(paths)
+        return usb_ids
+
+def load_usb_ids(paths):
+    vendors = {}
+    products = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        vendor_id = None
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                if line.startswith('\t\t'):
+                    continue # Interfaces
+                if line.startswith('\t'):
+                    if vendor_id:
+                        product_id, _, name = line.strip().partition(' ')
+                        products[(vendor_id, product_id.lower())] = name.strip()
+                    continue
+                # Device classes and the other lists follow the vendors
+                if not USB_IDS_VENDOR.match(line):
+                    break
+                vendor_id, _, name = line.strip().partition(' ')
+                vendor_id = vendor_id.lower()
+                vendors[vendor_id] = name.strip()
+        logger.log_to_file(f'[HarmonyUsbIndex] [Info] Loaded {len(vendors)} vendors and {len(products)} products from {path}')
+        break
+    return vendors, products
+
+def read_attribute(device_path, name):
+    try:
+        with open(os.path.join(device_path, name), 'r', encoding='utf-8', errors='replace') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+# Every USB device currently connected, read from sysfs in one pass and indexed by vendor:product, serial and
+# port path. Configured names are matched against the lsusb style description, the descriptor strings, the
+# serial, the port path and the vendor:product id, so one enumeration serves every configured device.
+class HarmonyUsbIndex():
+    def __init__(self, sysfs_path=None):
+        self.sysfs_path = sysfs_path or os.environ.get('HARMONY_USB_SYSFS') or SYSFS_USB_DEVICES
+        self.devices = []
+        self.by_id = {}
+        self.by_serial = {}
+        self.by_port = {}
+
+    # Names of the connected devices (their port paths), interfaces like 1-2:1.0 are listed next to them
+    def list_ports(self):
+        try:
+            return sorted(entry for entry in os.listdir(self.sysfs_path) if ':' not in entry)
+        except OSError as e:
+            logger.log_to_file(f'[HarmonyUsbIndex] [Error] Error listing USB devices in {self.sysfs_path}: {e}')
+            return []
+
+    def read_device(self, port, usb_ids=None):
+        device_path = os.path.join(self.sysfs_path, port)
+        vendor_id = read_attribute(device_path, 'idVendor').lower()
+        product_id = read_attribute(device_path, 'idProduct').lower()
+        busnum = read_attribute(device_path, 'busnum')
+        devnum = read_attribute(device_path, 'devnum')
+        if not vendor_id or not product_id or not busnum.isdigit() or not devnum.isdigit():
+            return None
+        vendors, products = usb_ids or get_usb_ids()
+        manufacturer = read_attribute(device_path, 'manufacturer')
+        product = read_attribute(device_path, 'product')
+        vendor_name = vendors.get(vendor_id) or manufacturer
+        product_name = products.get((vendor_id, product_id)) or product
+        return {
+            'bus': f'{int(busnum):03d}',
+            'device': f'{int(devnum):03d}',
+            'vendor_id': vendor_id,
+            'product_id': product_id,
+            'product': f'{vendor_name} {product_name}'.strip(),
+            'manufacturer': manufacturer,
+            'product_string': product,
+            'serial': read_attribute(device_path, 'serial'),
+            'port': port,
+        }
+
+    def refresh(self):
+        start = time.perf_counter()
+        usb_ids = get_usb_ids()
+        devices = []
+        for port in self.list_ports():
+            device = self.read_device(port, usb_ids)
+            if device:
+                devices.append(device)
+
+        self.devices = devices
+        self.by_id = {}
+        self.by_serial = {}
+        self.by_port = {}
+        for device in devices:
+            self.by_id.setdefault(f"{device['vendor_id']}:{device['product_id']}", []).append(device)
+            if device['serial']:
+                self.by_serial.setdefault(device['serial'].lower(), []).append(device)
+            self.by_port[device['port']] = device
+            device['search'] = '\n'.join([
+                f"Bus {device['bus']} Device {device['device']}: ID {device['vendor_id']}:{device['product_id']} {device['product']}",
+                f"{device['manufacturer']} {device['product_string']}",
+                device['serial'],
+                device['port'],
+            ]).lower()
+        logger.log_to_file(f'[HarmonyUsbIndex] [Info] Indexed {len(devices)} USB devices in {(time.perf_counter() - start) * 1000:.1f} ms')
+        return self
+
+    def match(self, device_name):
+        name = device_name.lower().strip()
+        if not name:
+            return []
+        # Exact vendor:product ids, serials and port paths first, then the descriptions like lsusb | grep -i
+        if name in self.by_id:
+            return list(self.by_id[name])
+        if name in self.by_serial:
+            return list(self.by_serial[name])
+        if name in self.by_port:
+            return [self.by_port[name]]
+        return [device for device in self.devices if name in device['search']]
+
+    def match_all(self, device_names):
+        return {device_name: self.match(device_name) for device_name in device_names}
@@ -2,8 +2,6 @@ import argparse
 import ctypes
 import json
 import os
-import psutil
-import requests
 import subprocess
 import sys
 import threading
@@ -11,10 +9,13 @@ import time
 import tkinter as tk
 import win32con
 import win32gui
-import win32process
 
 from common import HarmonyHostCommon
+from http_pool import get_harmony_http
 from logger import Logger
+from processes import get_harmony_process_watcher
+from timeline import HarmonyTimeline, set_harmony_timeline
+from windows import HarmonyHostWindowIndex, get_window_size
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-app', type=str, required=True)
@@ -26,6 +27,7 @@ parser.add_argument('-waitforeac', type=str, default='True')
 parser.add_argument('-createblackwindow', type=str, default='True')
 parser.add_argument('-monitorprocess', type=str, default='True')
 parser.add_argument('-delay', type=str, required=False)
+parser.add_argument('-launch', type=str, required=False)
 args = parser.parse_args()
 
 current_path = os.path.dirname(os.path.realpath(__file__))
@@ -76,52 +78,23 @@ class TkWindow:
 
 class HarmonyHost():
     def __init__(self):
-        self.common = HarmonyHostCommon()
+        self.common = HarmonyHostCommon(harmony_config.get('process-tick'), harmony_config.get('terminate-grace', 3))
+        self.watcher = get_harmony_process_watcher()
+        self.windows = HarmonyHostWindowIndex(processes=self.common.processes, tick=harmony_config.get('process-tick', 0.5))
+        self.http = get_harmony_http()
+
+    # Publishes a launch milestone through the local listener, which streams it to the client
+    def milestone(self, name, **milestone_args):
+        if not args.launch:
+            return False
+        harmony_port = int(harmony_config.get('port', 5000))
+        try:
+            self.http.post(f'http://127.0.0.1:{harmony_port}/milestone', data={'launch': args.launch, 'name': name, 'args': json.dumps(milestone_args)}, retries=3, timeout=2, deadline=10)
+            return True
+        except Exception as e:
+            logger.log_to_file(f"[HarmonyHost] [Error] Failed publishing the {name} milestone: {e}")
+            return False
     
-    def find_hwnd_from_process(self, process):
-        for proc in psutil.process_iter(['pid', 'name']):
-            if proc.info['name'] == process:
-                hwnds = []
-                def callback(hwnd, pid):
-                    if win32process.GetWindowThreadProcessId(hwnd)[1] == pid:
-                        hwnds.append(hwnd)
-                    return True
-                win32gui.EnumWindows(callback, proc.info['pid'])
-                if hwnds:
-                    return hwnds[0]
-        return None
-
-    def is_valid_window(self, hwnd):
-        # Check if the window is visible and has the desired style
-        style = win32gui.GetWindowLong(hwnd, win32con.GWL_STYLE)
-        return win32gui.IsWindowVisible(hwnd) and (style & win32con.WS_DISABLED) == 0
-
-    def find_hwnds_from_process(self, process):
-        hwnds = []
-        for proc in psutil.process_iter(['pid', 'name']):
-            if proc.info['name'] == process:
-                def callback(hwnd, pid):
-                    if win32process.GetWindowThreadProcessId(hwnd)[1] == pid:
-                        hwnd_title = win32gui.GetWindowText(hwnd) 
-                        bad_titles = [ #TODO: Consider alternative way of rejecting invalid hwnd instances rather than manually blacklisting them
-                            "MSCTFIME UI",
-                            "Default IME",
-                            "Battery Watcher",
-                            "WinEventHub"
-                        ]
-                        # Check if the window handle is valid and does not match any bad titles
-                        try:
-                            if (self.is_valid_window(hwnd) and 
-                                not any(bad_title in hwnd_title for bad_title in bad_titles) and 
-                                "$AS" not in hwnd_title and 
-                                "$Hour" not in hwnd_title):
-                                hwnds.append(hwnd)  # Append if all conditions are met
-                        except Exception as e:
-                            logger.log_to_file(f'[HarmonyHost] [Error] Error checking for valid window: {e}')
-                    return True
-                win32gui.EnumWindows(callback, proc.info['pid'])
-        return hwnds
-
     def bring_hwnd_to_foreground(self, hwnd):
         # Check if the window is minimized; restore it if it is
         if win32gui.IsIconic(hwnd):
@@ -154,6 +127,9 @@ class HarmonyHost():
             logger.log_to_file(f'[HarmonyHost] [Error] Failed to bring window to foreground: {e}')
 
     def wait_host_ready(self):
+        timeline = set_harmony_timeline(HarmonyTimeline(f"host-{os.path.splitext(args.mainexe)[0]}"))
+        ready_start = timeline.now()
+
         # Create a black window to cover up the desktop
         if str(args.createblackwindow).lower() == 'true':
             logger.log_to_file(f"[HarmonyHost] [Info] Creating the black window.")
@@ -162,53 +138,56 @@ class HarmonyHost():
             tk_thread.start() 
 
         # Wait for the main application to start
+        phase_start = timeline.now()
         timeout = 100
-        elapsed = 0
-        interval = 1
-        while not self.common.are_processes_running([args.mainexe]):
-            time.sleep(interval)
-            elapsed += interval
-            if elapsed >= timeout:
-                logger.log_to_file(f"[HarmonyHost] [Error] The main application is not running after {timeout} seconds.")
-                sys.exit(1)
-        logger.log_to_file(f"[HarmonyHost] [Info] The main application is running.")
+        if not self.watcher.wait_for_start(args.mainexe, timeout):
+            logger.log_to_file(f"[HarmonyHost] [Error] The main application is not running after {timeout} seconds.")
+            self.milestone('failed', reason=f'{args.mainexe} is not running after {timeout} seconds')
+            sys.exit(1)
+        starts = [event for event in self.watcher.get_events(args.mainexe) if event['event'] == 'started']
+        start_latency = f"{starts[-1]['latency_ms']:.0f} ms" if starts and starts[-1]['latency_ms'] is not None else 'n/a (already running)'
+        logger.log_to_file(f"[HarmonyHost] [Info] The main application is running, detected after {start_latency}.")
+        self.milestone('process found', exe=args.mainexe)
+        timeline.add_span('wait for main process', phase_start, timeline.now(), args={'exe': args.mainexe})
         
         # Wait for the main application window to appear
+        phase_start = timeline.now()
         hwnd_timeout = 100
         hwnd_elapsed = 0
         hwnd_interval = 1
-        while not self.find_hwnd_from_process(args.mainexe):
+        while not self.windows.find_window(args.mainexe):
             time.sleep(hwnd_interval)
             hwnd_elapsed += hwnd_interval
             if hwnd_elapsed >= hwnd_timeout:
                 logger.log_to_file(f"[HarmonyHost] [Error] The main application window is not running after {hwnd_timeout} seconds.")
+                self.milestone('failed', reason=f'No window of {args.mainexe} after {hwnd_timeout} seconds')
                 sys.exit(1)
         logger.log_to_file(f"[HarmonyHost] [Info] The main application window is found.")
+        self.milestone('window found')
+        timeline.add_span('wait for main window', phase_start, timeline.now())
 
         # Optional, wait for the easy anti cheat launcher
         if str(args.waitforeac).lower() == 'true':
+            phase_start = timeline.now()
             eac_timeout = 100
             eac_elapsed = 0
             eac_interval = 1
             eac_launcher = False
             # If the size is 320x240, it must be easy the anti cheat launcher and therefore we need to wait more
-            hwnd = self.find_hwnd_from_process(args.mainexe)
-            rect = win32gui.GetWindowRect(hwnd)
-            width = rect[2] - rect[0]
-            height = rect[3] - rect[1]
-            if width == 320 and height == 240:
+            window = self.windows.find_window(args.mainexe)
+            if window and get_window_size(window) == (320, 240):
                 logger.log_to_file(f"[HarmonyHost] [Info] The Easy Anti Cheat window is found, waiting for main application to start.")
+                self.milestone('eac detected')
                 eac_launcher = True
             while eac_launcher:
-                hwnd = self.find_hwnd_from_process(args.mainexe)
-                rect = win32gui.GetWindowRect(hwnd)
-                width = rect[2] - rect[0]
-                height = rect[3] - rect[1]
+                window = self.windows.find_window(args.mainexe)
+                if window is None:
+                    break
+                width, height = get_window_size(window)
                 if width > 321 and height > 241:
                     break
                 time.sleep(eac_interval)
-                if hwnd is None:
-                    break
+            timeline.add_span('wait for easy anti cheat', phase_start, timeline.now(), args={'launcher': eac_launcher})
 
         # Wait a little for the window to appear
         time.sleep(0.1)
@@ -217,30 +196,36 @@ class HarmonyHost():
             args.delay = 0
         delay = float(args.delay)
         logger.log_to_file(f"[HarmonyHost] [Info] Sending the ready signal after {delay} seconds...")
-        time.sleep(delay)
+        with timeline.span('delay', args={'seconds': delay}):
+            time.sleep(delay)
 
+        phase_start = timeline.now()
         try:
             logger.log_to_file(f"[HarmonyHost] [Info] Bringing the main window to the foreground...")
             if self.common.are_processes_running([args.mainexe]):
-                hwnds = self.find_hwnds_from_process(args.mainexe)
-                if hwnds:
-                    for hwnd in hwnds: # Loop through each window handle
-                        if hwnd:
-                            hwnd_title = win32gui.GetWindowText(hwnd) 
-                            if hwnd_title:
-                                logger.log_to_file(f"[HarmonyHost] [Info] Bringing window to foreground: {args.mainexe} with the title: {hwnd_title}")
-                                self.bring_hwnd_to_foreground(hwnd)
+                for window in self.windows.find_valid_windows(args.mainexe):
+                    if window['title']:
+                        logger.log_to_file(f"[HarmonyHost] [Info] Bringing window to foreground: {args.mainexe} with the title: {window['title']}")
+                        self.bring_hwnd_to_foreground(window['hwnd'])
         except Exception as e:
             logger.log_to_file(f"[HarmonyHost] [Error] Error bringing the main window to the foreground: {e}")
+        timeline.add_span('bring to foreground', phase_start, timeline.now())
+        self.milestone('foregrounded')
 
         host_ip = harmony_config.get('host-ip')
         host_port = harmony_config.get('host-port')
         request_address = 'http://' + host_ip + ':' + str(host_port) + '/ready'
         try:
             logger.log_to_file(f"[HarmonyHost] [Info] Sending the ready signal...")
-            response = requests.get(request_address)
+            with timeline.span('send ready signal'):
+                # Clients that passed a launch id follow the event stream, older ones wait for the /ready callback
+                if not self.milestone('ready'):
+                    response = self.http.get(request_address, retries=5, timeout=5, deadline=30)
+            timeline.add_span('wait host ready', ready_start, timeline.now(), 'summary', track='summary')
+            timeline.save()
         except Exception as e:
             logger.log_to_file(f"[HarmonyHost] [Error] Failed sending the ready signal: {e}")
+            timeline.save()
             time.sleep(1)
             if tk_window:
                 tk_window.stop()
@@ -248,29 +233,29 @@ class HarmonyHost():
                 tk_thread.join()
             sys.exit(1)
 
-        monitor_interval = 0.2
         keepalive_interval = 5
-        last_keepalive_time = time.time()
         harmony_port = int(harmony_config.get('port', 5000))
-        while self.common.are_processes_running([args.mainexe]):
-            time.sleep(monitor_interval)
-            if time.time() - last_keepalive_time >= keepalive_interval:
-                keepalive_address = f'http://127.0.0.1:{harmony_port}/keepalive'
-                try:
-                    keepalive_response = requests.get(keepalive_address)
-                    logger.log_to_file(f"[HarmonyHost] [Info] Keepalive signal sent successfully: {keepalive_response.status_code}")
-                except Exception as e:
-                    logger.log_to_file(f"[HarmonyHost] [Error] Error sending the keepalive signal: {e}")
-        
-                last_keepalive_time = time.time()  # Reset the keepalive timer
+        # Woken by the watcher within a tick of the exit, otherwise every keepalive interval
+        while not self.watcher.wait_for_exit(args.mainexe, keepalive_interval):
+            keepalive_address = f'http://127.0.0.1:{harmony_port}/keepalive'
+            try:
+                keepalive_response = self.http.get(keepalive_address, retries=0, timeout=2, deadline=2)
+                logger.log_to_file(f"[HarmonyHost] [Debug] Keepalive signal sent successfully: {keepalive_response.status_code}")
+            except Exception as e:
+                logger.log_to_file(f"[HarmonyHost] [Error] Error sending the keepalive signal: {e}")
+
+        exits = self.watcher.get_events(args.mainexe)
+        exit_bound = exits[-1]['latency_ms'] if exits and exits[-1]['event'] == 'exited' else None
+        logger.log_to_file(f"[HarmonyHost] [Info] The main application exited, detected within {exit_bound} ms. Process watcher: {self.watcher.get_stats()}")
+        timeline.instant('main process exited', args={'detected_within_ms': exit_bound})
+        timeline.save()
 
         # Monitor the process 
-        time.sleep(5)
         if str(args.monitorprocess).lower() == 'true':
             logger.log_to_file(f"[HarmonyHost] [Info] Sending the termination signal, mainexe running: {str(self.common.are_processes_running([args.mainexe]))}")
             request_address = 'http://' + host_ip + ':' + str(host_port) + '/terminate'
             try:
-                response = requests.get(request_address)
+                response = self.http.get(request_address, retries=2, timeout=5, deadline=15)
                 logger.log_to_file(f"[HarmonyHost] [Info] The termination signal sent successfully.")
                 time.sleep(1)
                 if tk_window:
@@ -304,24 +289,22 @@ class HarmonyHost():
             # Do it twice in case as a workaround for it not launching for some reason with Steam
             for i in range(2):
                 subprocess.Popen(command, shell=True, creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP)
+            self.common.processes.invalidate()
 
         # Kill the processes specified
         if self.common.are_processes_running(args.killexes):
-            for process in args.killexes:
-                self.common.kill_process(process)
+            self.common.terminate_processes(args.killexes, grace=0)
 
         minimise_processes = harmony_config.get('minimise-processes', [])
         for process in minimise_processes:
             if self.common.are_processes_running([process]):
                 logger.log_to_file(f"[HarmonyHost] [Info] Found running process to minimise: {process}")
-                hwnds = self.find_hwnds_from_process(process) # Get all window handles for the process
-                if hwnds:
-                    for hwnd in hwnds: # Loop through each window handle
-                        if hwnd:
-                            hwnd_title = win32gui.GetWindowText(hwnd) 
-                            if hwnd_title:
-                                win32gui.ShowWindow(hwnd, win32con.SW_MINIMIZE) # Send close message to each window
-                                logger.log_to_file(f"[HarmonyHost] [Info] Minimized window: {process} with the title: {hwnd_title}")
+                windows = self.windows.find_valid_windows(process) # All windows of the process from the shared index
+                if windows:
+                    for window in windows:
+                        if window['title']:
+                            win32gui.ShowWindow(window['hwnd'], win32con.SW_MINIMIZE)
+                            logger.log_to_file(f"[HarmonyHost] [Info] Minimized window: {process} with the title: {window['title']}")
                 else:
                     logger.log_to_file(f"[HarmonyHost] [Info] No windows found for process: {process}")
 
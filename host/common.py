@@ -1,15 +1,18 @@
 import ctypes
 import os
-import subprocess
 
 from logger import Logger
+from processes import HarmonyHostTerminator, get_harmony_process_table
+from windows import HarmonyHostWin32Windows, win32gui
 
 current_path = os.path.dirname(os.path.realpath(__file__))
 logger = Logger(os.path.join(current_path, 'app.log'), False)
 
 class HarmonyHostCommon():
-    def __init__(self):
-        pass
+    def __init__(self, process_tick=None, terminate_grace=3):
+        self.processes = get_harmony_process_table(process_tick)
+        close_windows = HarmonyHostWin32Windows().close_windows if win32gui else None
+        self.terminator = HarmonyHostTerminator(self.processes, terminate_grace, close_windows)
 
     @staticmethod
     def is_admin():
@@ -18,23 +21,23 @@ class HarmonyHostCommon():
         except:
             return False
 
+    # Answered from the shared process table, at most one psutil pass per tick whoever is asking
     def are_processes_running(self, processes):
-        for process in processes:
-            logger.log_to_file(f'[HarmonyHostCommon] [Info] Checking if {process} is running...')
-            command = f'tasklist /FI "IMAGENAME eq {process}"'
+        return self.processes.are_any_running(processes)
 
-            result = subprocess.run(command, shell=True, capture_output=True, text=True)
-            # Check if the process name is in the output
-            if process in result.stdout:
-                logger.log_to_file(f'[HarmonyHostCommon] [Info] The {process} is running...')
-                return True
-            if result.returncode != 0:
-                logger.log_to_file(f'[HarmonyHostCommon] [Error] Error checking {process}: {result.stderr.strip()}')
-        return False
-
-    def kill_process(self, process):
+    # Closes every process of the executables in one round, killing whatever is left after the grace period
+    def terminate_processes(self, processes, grace=None, exclude_pids=(), force=()):
         try:
-            subprocess.run(f'taskkill /F /IM {process}', shell=True)
-            logger.log_to_file(f'[HarmonyHostCommon] [Info] Killed process {process}')
+            report = self.terminator.terminate(processes, grace, exclude_pids, force)
         except Exception as e:
-            logger.log_to_file(f'[HarmonyHostCommon] [Error] Failed to kill process {process}: {e}')
\ No newline at end of file
+            logger.log_to_file(f'[HarmonyHostCommon] [Error] Failed to terminate {processes}: {e}')
+            return []
+        for entry in report:
+            if entry['result'] == 'failed':
+                logger.log_to_file(f"[HarmonyHostCommon] [Error] Failed to end {entry['name']} ({entry['pid']}): {entry['error']}")
+            else:
+                logger.log_to_file(f"[HarmonyHostCommon] [Info] {entry['name']} ({entry['pid']}) {entry['result']} after {entry['ms']} ms")
+        return report
+
+    def kill_process(self, process):
+        return self.terminate_processes([process], grace=0)
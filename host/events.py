@@ -0,0 +1,63 @@
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+# Milestones that end a launch, the event stream is closed once they have been delivered
+TERMINAL_MILESTONES = ('ready', 'failed')
+
+# Launch milestones published by app.py and streamed to the client as server-sent events. Every launch keeps its
+# events with increasing ids so that a client that lost the connection resumes from Last-Event-ID without missing
+# or repeating any of them.
+class HarmonyHostEvents():
+    def __init__(self, max_launches=16):
+        self.max_launches = max_launches
+        self.launches = OrderedDict()
+        self.condition = threading.Condition()
+
+    def get_launch(self, launch):
+        # Called with the condition held, the client may subscribe before app.py publishes anything
+        entry = self.launches.get(launch)
+        if entry is None:
+            entry = {'events': [], 'closed': False}
+            self.launches[launch] = entry
+            while len(self.launches) > self.max_launches:
+                self.launches.popitem(last=False)
+        return entry
+
+    def publish(self, launch, name, args=None):
+        with self.condition:
+            entry = self.get_launch(launch)
+            if entry['closed']:
+                return None
+            event = {'id': len(entry['events']) + 1, 'name': name, 'time': time.time_ns() // 1000, 'args': args or {}}
+            entry['events'].append(event)
+            if name in TERMINAL_MILESTONES:
+                entry['closed'] = True
+            self.condition.notify_all()
+            return event
+
+    def wait_events(self, launch, after, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            entry = self.get_launch(launch)
+            while len(entry['events']) <= after and not entry['closed']:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return entry['events'][after:], entry['closed']
+
+    def stream(self, launch, after=0, heartbeat=10):
+        yield 'retry: 1000\n\n'
+        while True:
+            events, closed = self.wait_events(launch, after, heartbeat)
+            for event in events:
+                yield f"id: {event['id']}\nevent: milestone\ndata: {json.dumps(event)}\n\n"
+                after = event['id']
+            if closed and not events:
+                return
+            if not events:
+                # Keeps idle connections from being dropped and lets the client notice a dead guest
+                yield ': keepalive\n\n'
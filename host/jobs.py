@@ -0,0 +1,151 @@
+import json
+import subprocess
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+FINISHED_STATUSES = ('exited', 'failed')
+
+# Commands received by /execute, run on a bounded pool of workers. Every job has an id the client follows with a
+# long poll or an event stream, and submissions carrying the same idempotency key get the job that already exists,
+# so a retried request never runs a command twice. Only the most recent jobs are kept.
+class HarmonyHostJobs():
+    def __init__(self, max_workers=4, max_queued=16, max_jobs=64, max_output=64 * 1024):
+        self.max_queued = max_queued
+        self.max_jobs = max_jobs
+        self.max_output = max_output
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.jobs = OrderedDict()
+        self.keys = {}
+        self.condition = threading.Condition()
+        self.stats = {'submitted': 0, 'duplicates': 0, 'rejected': 0}
+
+    # Returns the job and whether it was created by this call, or None when the queue is full
+    def submit(self, command, key=None, launch=None, delay=0.1):
+        with self.condition:
+            job_id = self.keys.get(key) if key else None
+            if job_id in self.jobs:
+                self.stats['duplicates'] += 1
+                return self.describe(self.jobs[job_id]), False
+            if sum(1 for job in self.jobs.values() if job['status'] == 'queued') >= self.max_queued:
+                self.stats['rejected'] += 1
+                return None, False
+            job = {
+                'id': uuid.uuid4().hex,
+                'key': key,
+                'launch': launch,
+                'command': command,
+                'status': 'queued',
+                'exit_code': None,
+                'error': None,
+                'output': '',
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'version': 1,
+            }
+            self.jobs[job['id']] = job
+            if key:
+                self.keys[key] = job['id']
+            self.prune()
+            self.stats['submitted'] += 1
+        self.executor.submit(self.run, job, delay)
+        return self.describe(job), True
+
+    def prune(self):
+        # Called with the condition held, finished jobs go first
+        while len(self.jobs) > self.max_jobs:
+            finished = [job_id for job_id, job in self.jobs.items() if job['status'] in FINISHED_STATUSES]
+            if not finished:
+                break
+            job = self.jobs.pop(finished[0])
+            if job['key'] and self.keys.get(job['key']) == job['id']:
+                del self.keys[job['key']]
+
+    def update(self, job, **changes):
+        with self.condition:
+            job.update(changes)
+            job['version'] += 1
+            self.condition.notify_all()
+
+    def append_output(self, job, text):
+        with self.condition:
+            output = job['output'] + text
+            # Only the tail is kept, long-running apps may print for hours
+            job['output'] = output[-self.max_output:]
+            job['version'] += 1
+            self.condition.notify_all()
+
+    def run(self, job, delay):
+        time.sleep(delay)
+        self.update(job, status='running', started=time.time())
+        try:
+            process = subprocess.Popen(job['command'], shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        except Exception as e:
+            self.update(job, status='failed', error=str(e), finished=time.time())
+            return
+        reader = threading.Thread(target=self.read_output, args=(job, process.stdout), daemon=True)
+        reader.start()
+        # The command may run for hours (app.py, the game), so the wait moves off the pool and the worker is free
+        # for the next job as soon as the process exists
+        reaper = threading.Thread(target=self.reap, args=(job, process, reader), name=f"job-reaper-{job['id'][:8]}", daemon=True)
+        reaper.start()
+
+    def reap(self, job, process, reader):
+        exit_code = process.wait()
+        # A detached grandchild may hold the pipe open, the job ends with the command regardless
+        reader.join(1)
+        self.update(job, status='exited', exit_code=exit_code, finished=time.time())
+
+    def read_output(self, job, stream):
+        try:
+            for line in iter(stream.readline, b''):
+                self.append_output(job, line.decode(errors='replace'))
+        except (OSError, ValueError):
+            pass
+        finally:
+            stream.close()
+
+    def describe(self, job):
+        return dict(job)
+
+    def get(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return self.describe(job) if job else None
+
+    # Long poll, returns as soon as the job has changed past the given version or finished
+    def wait(self, job_id, version=0, timeout=30):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            job = self.jobs.get(job_id)
+            while job and job['version'] <= version and job['status'] not in FINISHED_STATUSES:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.describe(job) if job else None
+
+    def stream(self, job_id, version=0, heartbeat=10):
+        yield 'retry: 1000\n\n'
+        while True:
+            job = self.wait(job_id, version, heartbeat)
+            if job is None:
+                return
+            if job['version'] > version:
+                yield f"id: {job['version']}\nevent: job\ndata: {json.dumps(job)}\n\n"
+                version = job['version']
+            elif job['status'] in FINISHED_STATUSES:
+                return
+            else:
+                yield ': keepalive\n\n'
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            for job in self.jobs.values():
+                stats[job['status']] = stats.get(job['status'], 0) + 1
+            return stats
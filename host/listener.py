@@ -7,8 +7,11 @@ import threading
 import time
 
 from common import HarmonyHostCommon
-from flask import Flask, request
+from events import HarmonyHostEvents
+from flask import Flask, Response, request, stream_with_context
+from jobs import HarmonyHostJobs
 from logger import Logger
+from processes import get_harmony_process_watcher
 
 current_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -28,34 +31,33 @@ thread_lock = threading.Lock()
 disconnect_watcher_thread = None
 disconnect_thread_lock = threading.Lock()
 
-def run_command_after_delay(command, delay=0.1):
-    time.sleep(delay)
-    try:
-        subprocess.run(command, shell=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command: {e}")
-
-common = HarmonyHostCommon()
+common = HarmonyHostCommon(harmony_config.get('process-tick'), harmony_config.get('terminate-grace', 3))
+events = HarmonyHostEvents()
+jobs = HarmonyHostJobs(harmony_config.get('execute-workers', 4))
 
 def lg_watcher():
     global last_keepalive_time
+    watcher = get_harmony_process_watcher()
     while True:
-        if not common.are_processes_running(['looking-glass-host.exe']):
-            # Check if no keep alive within last 10 seconds
-            if time.time() - last_keepalive_time > 10:
-                lg_path = harmony_config.get('looking-glass-path')
-                if not lg_path:
-                    logger.log_to_file(f"[HarmonyHostListener] [Error] Looking Glass path not found.")
-                    sys.exit(1)
-                lg_path = os.path.expanduser(lg_path)
-
-                cmd = f'start /realTime "" "{lg_path}"'
-                subprocess.Popen(
-                    cmd,
-                    creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP,
-                    close_fds=True,
-                    shell=True
-                )
+        # Sleeps until Looking Glass is gone instead of polling for it
+        watcher.wait_for_exit('looking-glass-host.exe')
+        # Check if no keep alive within last 10 seconds
+        if time.time() - last_keepalive_time > 10:
+            lg_path = harmony_config.get('looking-glass-path')
+            if not lg_path:
+                logger.log_to_file(f"[HarmonyHostListener] [Error] Looking Glass path not found.")
+                sys.exit(1)
+            lg_path = os.path.expanduser(lg_path)
+
+            cmd = f'start /realTime "" "{lg_path}"'
+            subprocess.Popen(
+                cmd,
+                creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP,
+                close_fds=True,
+                shell=True
+            )
+            if watcher.wait_for_start('looking-glass-host.exe', 10):
+                continue
         time.sleep(1)
 
 def keepalive_watcher():
@@ -78,18 +80,20 @@ def keepalive_watcher():
             subprocess.run(["shutdown", "/h"])  # Hibernate the PC
             break  # Exit the loop after hibernation
             
-        logger.log_to_file("Keepalive watcher alive.")
+        logger.debug("Keepalive watcher alive.")
         time.sleep(1)  # Check every second
 
+# Ends the host app and every exe of the apps in one round, from a single process snapshot
+def stop_app_processes(exes):
+    report = common.terminate_processes(shlex.split(exes or ''), force=['pythonw.exe'])
+    logger.log_to_file(f"Stopped {len(report)} processes.")
+    return report
+
 def disconnect_watcher(exes, timeout):
     print(f"Disconnecting in {timeout} seconds.")
     time.sleep(timeout)
     print("Timeout received, disconnecting.")
-    common.kill_process('pythonw.exe')
-    exe_list = shlex.split(exes)
-    for exe in exe_list:
-        print(f"Killing process: {exe}")
-        common.kill_process(exe)
+    stop_app_processes(exes)
 
 # Check if watcher thread is alive
 def is_thread_alive(thread):
@@ -103,30 +107,53 @@ class HarmonyHostListener(Flask):
         @self.route('/execute', methods=['POST'])
         def execute_command():
             command = request.form.get('command')
+            launch = request.form.get('launch')
+            # Retried submissions of the same launch share its job
+            key = request.form.get('key') or launch
             logger.log_to_file(f"Received command: {command}")
-            if command:
-                # Inform the client that the command is about to run
-                response = f"Command '{command}' will be executed."
-
-                # Run the command in a separate thread, after a short delay
-                threading.Thread(target=run_command_after_delay, args=(command,)).start()
-
-                logger.log_to_file('Sending response: ', response)
-                return response + ' Will be executed'
-            logger.log_to_file('Sending response: No command provided.')
-            return 'No command provided.'
+            if not command:
+                logger.log_to_file('Sending response: No command provided.')
+                return 'No command provided.', 400
+            job, created = jobs.submit(command, key, launch)
+            if job is None:
+                logger.log_to_file('Sending response: Too many queued commands.')
+                return 'Too many queued commands.', 503
+            if created and launch:
+                events.publish(launch, 'received')
+            logger.log_to_file(f"Sending response: job {job['id']} {'created' if created else 'already exists'}")
+            return json.dumps({'job': job['id'], 'status': job['status'], 'version': job['version'], 'duplicate': not created})
+
+        # Job status, with wait the request is held until the job changes past version or finishes
+        @self.route('/jobs/<job_id>', methods=['GET'])
+        def get_job(job_id):
+            try:
+                version = int(request.args.get('version') or 0)
+                wait = min(float(request.args.get('wait') or 0), 60)
+            except ValueError:
+                return 'Invalid version or wait.', 400
+            job = jobs.wait(job_id, version, wait) if wait > 0 else jobs.get(job_id)
+            if job is None:
+                return 'Unknown job.', 404
+            return json.dumps(job)
+
+        # Server-sent event stream of a job's changes, resumed with the Last-Event-ID header after a reconnect
+        @self.route('/jobs/<job_id>/events', methods=['GET'])
+        def job_events(job_id):
+            if jobs.get(job_id) is None:
+                return 'Unknown job.', 404
+            try:
+                version = int(request.headers.get('Last-Event-ID') or request.args.get('version') or 0)
+            except ValueError:
+                version = 0
+            return Response(stream_with_context(jobs.stream(job_id, version)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
         @self.route('/cancel', methods=['POST'])
         def cancel_command():
             exes = request.form.get('exes')
             logger.log_to_file("Cancelling the command with exes: ", exes)
-            # Cancel the command by killing the process
-            common.kill_process('pythonw.exe')
-            exe_list = shlex.split(exes)
-            for exe in exe_list:
-                print(f"Killing process: {exe}")
-                common.kill_process(exe)
-            return 'Cancelled'
+            # Cancel the command by ending the host app and the app's processes
+            report = stop_app_processes(exes)
+            return json.dumps({'status': 'Cancelled', 'processes': report})
 
         @self.route('/disconnected', methods=['POST'])
         def disconnected():
@@ -150,13 +177,36 @@ class HarmonyHostListener(Flask):
         def stop_command():
             exes = request.form.get('exes')
             logger.log_to_file("Stopping the command with exes: ", exes)
-            # Stop the command by killing the process
-            common.kill_process('pythonw.exe')
-            exe_list = shlex.split(exes)
-            for exe in exe_list:
-                logger.log_to_file(f"Killing process: {exe}")
-                common.kill_process(exe)
-            return 'Stopped'
+            # Stop the command by ending the host app and the processes of every app on the domain
+            report = stop_app_processes(exes)
+            return json.dumps({'status': 'Stopped', 'processes': report})
+
+        @self.route('/milestone', methods=['POST'])
+        def milestone():
+            launch = request.form.get('launch')
+            name = request.form.get('name')
+            if not launch or not name:
+                return 'Missing launch or name.', 400
+            try:
+                milestone_args = json.loads(request.form.get('args') or '{}')
+            except ValueError:
+                milestone_args = {}
+            logger.log_to_file(f"Milestone {name} for launch {launch}: {milestone_args}")
+            event = events.publish(launch, name, milestone_args)
+            return json.dumps(event)
+
+        # Server-sent event stream of a launch's milestones, resumed with the Last-Event-ID header after a reconnect
+        @self.route('/events', methods=['GET'])
+        def launch_events():
+            launch = request.args.get('launch')
+            if not launch:
+                return 'Missing launch.', 400
+            try:
+                after = int(request.headers.get('Last-Event-ID') or request.args.get('after') or 0)
+            except ValueError:
+                after = 0
+            logger.log_to_file(f"Streaming events for launch {launch} after {after}")
+            return Response(stream_with_context(events.stream(launch, after)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
         @self.route('/keepalive', methods=['GET'])
         def keep_alive():
@@ -1,6 +1,166 @@
+import atexit
 import ctypes
 import os
+import queue
+import re
 import sys
+import threading
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_TAG = re.compile(r'\[(Debug|Info|Warning|Error)\]')
+
+# Writes the messages of every Logger sharing a log file from one background thread. Messages are queued without
+# blocking, written and flushed in batches, and the file is rotated once it grows past max_bytes. When the queue
+# is full the message is dropped and counted, and the count is written once there is room again.
+class HarmonyHostLogWriter():
+    def __init__(self, log_file, max_queue=10000, max_batch=500, max_bytes=5 * 1024 * 1024, backups=3, echo=True):
+        self.log_file = log_file
+        self.max_batch = max_batch
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.echo = echo
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.file = None
+        self.stats = {'written': 0, 'dropped': 0, 'rotations': 0}
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name=f'log-writer-{os.path.basename(log_file)}')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, line):
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                self.stats['dropped'] += 1
+
+    def truncate(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+            with open(self.log_file, 'w') as f:
+                f.write('')
+
+    # app.py and the daemon (the listener and app.py on the guest) write the same file, each through its own
+    # handle. Once another process has rotated the file away, this handle would keep writing into the renamed copy,
+    # so the path is checked before every batch and opened again when it is no longer the same file.
+    def open_file(self):
+        if self.file is not None and not self.is_current():
+            self.file.close()
+            self.file = None
+        if self.file is None:
+            self.file = open(self.log_file, 'a')
+        return self.file
+
+    def is_current(self):
+        try:
+            path_stat = os.stat(self.log_file)
+        except FileNotFoundError:
+            return False
+        file_stat = os.fstat(self.file.fileno())
+        return (path_stat.st_dev, path_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino)
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        try:
+            for index in range(self.backups - 1, 0, -1):
+                if os.path.exists(f'{self.log_file}.{index}'):
+                    os.replace(f'{self.log_file}.{index}', f'{self.log_file}.{index + 1}')
+            os.replace(self.log_file, f'{self.log_file}.1')
+            self.stats['rotations'] += 1
+        except OSError:
+            pass # Another process has the file open on Windows, try again after the next batch
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None is queued by close() after the last message
+            closing = None in batch
+            self.flush([line for line in batch if line is not None])
+            if closing:
+                return
+
+    def flush(self, batch):
+        with self.lock:
+            if self.dropped:
+                batch.append(f'[Logger] [Warning] Dropped {self.dropped} messages, the log queue was full.')
+                self.dropped = 0
+            if not batch:
+                return
+            try:
+                f = self.open_file()
+                f.write('\n'.join(batch) + '\n')
+                f.flush()
+                self.stats['written'] += len(batch)
+                # The size of the path rather than the handle, another process may have just rotated it
+                if self.max_bytes and os.stat(self.log_file).st_size >= self.max_bytes:
+                    self.rotate()
+            except OSError:
+                # The next batch opens the file again, this handle is not reused
+                if self.file:
+                    try:
+                        self.file.close()
+                    except OSError:
+                        pass
+                self.file = None
+        if self.echo and sys.stdout:
+            try:
+                sys.stdout.write('\n'.join(batch) + '\n')
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                pass
+
+    def close(self, timeout=2):
+        # Waits for whatever is still queued to be written, called at exit
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+                self.thread.join(timeout)
+            except queue.Full:
+                pass
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+log_writers = {}
+log_writers_lock = threading.Lock()
+
+def get_log_writer(log_file):
+    log_file = os.path.abspath(log_file)
+    with log_writers_lock:
+        writer = log_writers.get(log_file)
+        if writer is None:
+            writer = HarmonyHostLogWriter(log_file)
+            log_writers[log_file] = writer
+        return writer
+
+@atexit.register
+def close_log_writers():
+    with log_writers_lock:
+        writers = list(log_writers.values())
+    for writer in writers:
+        writer.close()
 
 def is_admin():
     try:
@@ -9,6 +169,9 @@ def is_admin():
         return False
 
 class Logger:
+    # Messages below this level are discarded before they are queued, HARMONY_LOG_LEVEL=debug shows everything
+    level = LEVELS.get(os.environ.get('HARMONY_LOG_LEVEL', 'info').lower(), INFO)
+
     def __init__(self, log_file, clear=True):
         self.log_file = log_file
 
@@ -18,14 +181,33 @@ class Logger:
                 ctypes.windll.shell32.ShellExecuteW(None, "runas", sys.executable, " ".join(sys.argv), None, 1)
                 sys.exit()
 
+        self.writer = get_log_writer(log_file)
         if clear:
-            with open(self.log_file, 'w') as f:
-                f.write('')
-                
+            self.writer.truncate()
+
+    def get_level(self, message):
+        match = LEVEL_TAG.search(message, 0, 64)
+        return LEVELS[match.group(1).lower()] if match else INFO
+
     def log_to_file(self, message, exception=None):
+        if self.get_level(message) < Logger.level:
+            return
         if exception:
-            print(message, exception)
-        else:
-            print(message)
-        with open(self.log_file, 'a') as f:
-            f.write(f"{message}\n")
\ No newline at end of file
+            message = f'{message} {exception}'
+        self.writer.write(message)
+
+    def log(self, level, message):
+        if level >= Logger.level:
+            self.writer.write(message)
+
+    def debug(self, message):
+        self.log(DEBUG, message)
+
+    def info(self, message):
+        self.log(INFO, message)
+
+    def warning(self, message):
+        self.log(WARNING, message)
+
+    def error(self, message):
+        self.log(ERROR, message)
@@ -0,0 +1,285 @@
+import collections
+import os
+import psutil
+import threading
+import time
+
+# Name -> pids index of every running process, taken in one psutil pass and shared by every caller. A snapshot is
+# reused until it is older than the tick, so pollers asking several times a second cost one pass per tick. Process
+# names are compared case-insensitively like Windows does. Nothing here is Windows-only, so it runs on Linux too.
+class HarmonyHostProcessTable():
+    def __init__(self, tick=0.5):
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.index = {}
+        self.names = {}
+        self.taken_at = None
+        self.stats = {'snapshots': 0, 'queries': 0, 'snapshot_ms': 0.0}
+
+    def refresh(self):
+        start = time.perf_counter()
+        index = {}
+        names = {}
+        for process in psutil.process_iter(['pid', 'name']):
+            name = process.info['name']
+            if name:
+                index.setdefault(name.lower(), set()).add(process.info['pid'])
+                names[process.info['pid']] = name
+        elapsed = (time.perf_counter() - start) * 1000
+        with self.lock:
+            self.index = index
+            self.names = names
+            self.taken_at = time.monotonic()
+            self.stats['snapshots'] += 1
+            self.stats['snapshot_ms'] += elapsed
+        return index
+
+    # Forces the next query to take a new snapshot, after killing or starting something
+    def invalidate(self):
+        with self.lock:
+            self.taken_at = None
+
+    def get_index(self, max_age=None):
+        max_age = self.tick if max_age is None else max_age
+        with self.lock:
+            self.stats['queries'] += 1
+            if self.taken_at is not None and time.monotonic() - self.taken_at < max_age:
+                return self.index
+        # Two callers may refresh at once right after the tick, which is harmless
+        return self.refresh()
+
+    def get_pids(self, name, max_age=None):
+        return set(self.get_index(max_age).get(name.lower(), ()))
+
+    def is_running(self, name, max_age=None):
+        return name.lower() in self.get_index(max_age)
+
+    def are_any_running(self, names, max_age=None):
+        index = self.get_index(max_age)
+        return any(name and name.lower() in index for name in names)
+
+    def get_name(self, pid):
+        with self.lock:
+            return self.names.get(pid)
+
+    def get_names(self):
+        with self.lock:
+            return dict(self.names)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['snapshot_ms_avg'] = stats['snapshot_ms'] / stats['snapshots'] if stats['snapshots'] else 0
+        return stats
+
+harmony_process_table = None
+harmony_process_table_lock = threading.Lock()
+
+# Process-wide table, the tick of the first caller wins
+def get_harmony_process_table(tick=None):
+    global harmony_process_table
+    with harmony_process_table_lock:
+        if harmony_process_table is None:
+            harmony_process_table = HarmonyHostProcessTable(tick if tick is not None else 0.5)
+        return harmony_process_table
+
+# Diffs consecutive snapshots of the shared table into started and exited events, so callers wait on an executable
+# instead of polling for it. Each tick costs one psutil pass, which also keeps the table fresh for everyone else.
+# A start is detected within one tick of the process creation time; an exit can only be bounded by the tick.
+class HarmonyHostProcessWatcher():
+    def __init__(self, table=None, tick=None, max_events=256):
+        self.table = table or get_harmony_process_table()
+        self.tick = tick if tick is not None else self.table.tick
+        self.changed = threading.Condition()
+        self.names = {}
+        self.counts = {}
+        self.events = collections.deque(maxlen=max_events)
+        self.taken_at = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stats = {'ticks': 0, 'cpu_ms': 0.0, 'cpu_ms_max': 0.0, 'started': 0, 'exited': 0, 'start_latency_ms': 0.0, 'start_latency_ms_max': 0.0}
+
+    def start(self):
+        with self.changed:
+            if self.thread is not None:
+                return
+            # The first snapshot is the baseline, nothing that was already running counts as started
+            self.update(emit=False)
+            self.thread = threading.Thread(target=self.run, name='process-watcher', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.tick):
+            self.update()
+
+    def update(self, emit=True):
+        cpu_start = time.thread_time()
+        self.table.refresh()
+        names = self.table.get_names()
+        now = time.time()
+        started = []
+        exited = []
+        if emit:
+            for pid, name in names.items():
+                if self.names.get(pid) != name:
+                    started.append((pid, name))
+            for pid, name in self.names.items():
+                if names.get(pid) != name:
+                    exited.append((pid, name))
+        counts = {}
+        for name in names.values():
+            counts[name.lower()] = counts.get(name.lower(), 0) + 1
+
+        events = []
+        for pid, name in started:
+            try:
+                created = psutil.Process(pid).create_time()
+            except psutil.Error:
+                created = None # Already gone again
+            # A process older than the previous snapshot exec'd under a new name, only the tick bounds that one
+            latency = max(now - max(created, self.taken_at or 0), 0) * 1000 if created else None
+            events.append({'event': 'started', 'name': name, 'pid': pid, 'time': now, 'created': created, 'latency_ms': latency})
+        for pid, name in exited:
+            # Exited at some point since the previous snapshot
+            bound = (now - self.taken_at) * 1000 if self.taken_at else None
+            events.append({'event': 'exited', 'name': name, 'pid': pid, 'time': now, 'latency_ms': bound})
+
+        cpu = (time.thread_time() - cpu_start) * 1000
+        with self.changed:
+            self.names = names
+            self.counts = counts
+            self.taken_at = now
+            self.events.extend(events)
+            self.stats['ticks'] += 1
+            self.stats['cpu_ms'] += cpu
+            self.stats['cpu_ms_max'] = max(self.stats['cpu_ms_max'], cpu)
+            for event in events:
+                self.stats[event['event']] += 1
+                if event['event'] == 'started' and event['latency_ms'] is not None:
+                    self.stats['start_latency_ms'] += event['latency_ms']
+                    self.stats['start_latency_ms_max'] = max(self.stats['start_latency_ms_max'], event['latency_ms'])
+            self.changed.notify_all()
+        return events
+
+    def is_running(self, name):
+        with self.changed:
+            return self.counts.get(name.lower(), 0) > 0
+
+    # Blocks until a process of the executable runs, or the timeout (seconds, None waits forever) passes
+    def wait_for_start(self, name, timeout=None):
+        self.start()
+        with self.changed:
+            return self.changed.wait_for(lambda: self.counts.get(name.lower(), 0) > 0, timeout)
+
+    # Blocks until no process of the executable is left, or the timeout passes
+    def wait_for_exit(self, name, timeout=None):
+        self.start()
+        with self.changed:
+            return self.changed.wait_for(lambda: self.counts.get(name.lower(), 0) == 0, timeout)
+
+    def get_events(self, name=None):
+        with self.changed:
+            return [dict(event) for event in self.events if name is None or event['name'].lower() == name.lower()]
+
+    def get_stats(self):
+        with self.changed:
+            stats = dict(self.stats)
+        stats['cpu_ms_avg'] = stats['cpu_ms'] / stats['ticks'] if stats['ticks'] else 0
+        stats['start_latency_ms_avg'] = stats['start_latency_ms'] / stats['started'] if stats['started'] else 0
+        stats['tick'] = self.tick
+        return stats
+
+harmony_process_watcher = None
+
+def get_harmony_process_watcher(tick=None):
+    global harmony_process_watcher
+    table = get_harmony_process_table(tick)
+    with harmony_process_table_lock:
+        if harmony_process_watcher is None:
+            harmony_process_watcher = HarmonyHostProcessWatcher(table)
+        return harmony_process_watcher
+
+# Ends every process of a set of executables in one round: all targets come from one snapshot, all are asked to
+# stop at once, then waited on together for the grace period before the survivors are killed. close_windows(pids)
+# is the polite ask on Windows, where psutil's terminate is already TerminateProcess; processes it returns no window
+# for, and every process elsewhere, get terminate() instead.
+class HarmonyHostTerminator():
+    def __init__(self, table=None, grace=3, close_windows=None):
+        self.table = table or get_harmony_process_table()
+        self.grace = grace
+        self.close_windows = close_windows
+
+    def resolve(self, index, names, exclude_pids=()):
+        targets = []
+        for name in {name.lower() for name in names if name}:
+            for pid in sorted(index.get(name, ())):
+                if pid != os.getpid() and pid not in exclude_pids:
+                    targets.append(pid)
+        return targets
+
+    # Processes of the force executables are killed straight away in the same round, without a grace period
+    def terminate(self, names, grace=None, exclude_pids=(), force=()):
+        grace = self.grace if grace is None else grace
+        start = time.monotonic()
+        index = self.table.refresh()
+        forced = set(self.resolve(index, force, exclude_pids))
+        processes = {}
+        report = {}
+        for pid in sorted(forced) + self.resolve(index, names, exclude_pids):
+            if pid in report:
+                continue
+            try:
+                process = psutil.Process(pid)
+                report[pid] = {'pid': pid, 'name': process.name(), 'result': None, 'error': None, 'ms': None}
+                processes[pid] = process
+            except psutil.NoSuchProcess:
+                pass
+            except psutil.Error as e:
+                report[pid] = {'pid': pid, 'name': self.table.get_name(pid), 'result': 'failed', 'error': str(e), 'ms': None}
+        if grace <= 0:
+            forced = set(processes)
+        forced &= set(processes)
+        polite = set(processes) - forced
+
+        def on_exit(process):
+            report[process.pid]['ms'] = round((time.monotonic() - start) * 1000, 1)
+
+        for pid in forced:
+            self.signal(processes[pid], report[pid], 'kill')
+        asked = set()
+        if polite and self.close_windows:
+            try:
+                asked = self.close_windows(polite)
+            except Exception:
+                asked = set() # Everything falls back to terminate
+        for pid in polite - asked:
+            self.signal(processes[pid], report[pid], 'terminate')
+        gone, alive = psutil.wait_procs(list(processes.values()), timeout=grace if polite else 1, callback=on_exit)
+        for process in gone:
+            report[process.pid]['result'] = 'killed' if process.pid in forced else 'terminated'
+
+        # Whatever ignored the ask is killed, all of them at once again
+        for process in alive:
+            if process.pid not in forced:
+                self.signal(process, report[process.pid], 'kill')
+        if alive:
+            gone, alive = psutil.wait_procs(alive, timeout=1, callback=on_exit)
+            for process in gone:
+                report[process.pid]['result'] = 'killed'
+            for process in alive:
+                report[process.pid]['result'] = 'failed'
+                report[process.pid]['error'] = report[process.pid]['error'] or 'still running after kill'
+
+        self.table.invalidate()
+        return list(report.values())
+
+    def signal(self, process, entry, method):
+        try:
+            getattr(process, method)()
+        except psutil.NoSuchProcess:
+            pass # Exited on its own, wait_procs reports it
+        except psutil.Error as e:
+            entry['error'] = str(e)
@@ -0,0 +1,131 @@
+import ctypes
+import os
+import psutil
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from processes import HarmonyHostProcessTable, HarmonyHostProcessWatcher, HarmonyHostTerminator
+
+SLEEP = 'import time; time.sleep(60)'
+IGNORE_TERM = 'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); print("ready", flush=True); time.sleep(60)'
+# A launcher that starts the game under the same executable, like a launcher stub does
+LAUNCHER = 'import subprocess, sys, time; child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"]); print(child.pid, flush=True); time.sleep(60)'
+PR_SET_CHILD_SUBREAPER = 36
+
+# Real child processes under executable names of their own: symlinks to the interpreter, which Linux reports as the
+# process name, so lookups by name never match anything else running on the machine
+@unittest.skipUnless(sys.platform.startswith('linux'), 'process names come from symlinks on Linux')
+class HarmonyHostProcessTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Orphaned grandchildren are adopted and reaped by this process instead of an init that may never reap them
+        ctypes.CDLL(None).prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0)
+
+    def setUp(self):
+        self.bin_dir = tempfile.mkdtemp()
+        self.processes = []
+        self.table = HarmonyHostProcessTable(tick=0.1)
+
+    def tearDown(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+        shutil.rmtree(self.bin_dir)
+
+    def new_executable(self):
+        name = f'hp{uuid.uuid4().hex[:8]}'
+        os.symlink(sys.executable, os.path.join(self.bin_dir, name))
+        return name
+
+    def spawn(self, name, code=SLEEP):
+        process = subprocess.Popen([os.path.join(self.bin_dir, name), '-c', code], stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        self.processes.append(process)
+        return process
+
+    def test_table_finds_processes_by_name(self):
+        name = self.new_executable()
+        processes = [self.spawn(name), self.spawn(name)]
+
+        self.assertEqual(self.table.get_pids(name, max_age=0), {process.pid for process in processes})
+        # Names compare like Windows does
+        self.assertTrue(self.table.is_running(name.upper()))
+        self.assertTrue(self.table.are_any_running(['', 'not-running.exe', name]))
+        self.assertEqual(self.table.get_name(processes[0].pid), name)
+
+        for process in processes:
+            process.kill()
+            process.wait()
+        # The snapshot is reused within the tick, invalidate forces a new one
+        self.table.invalidate()
+        self.assertFalse(self.table.is_running(name))
+
+    def test_watcher_reports_start_and_exit(self):
+        name = self.new_executable()
+        watcher = HarmonyHostProcessWatcher(self.table, tick=0.1)
+        watcher.start()
+        try:
+            process = self.spawn(name)
+            self.assertTrue(watcher.wait_for_start(name, 5))
+            process.terminate()
+            process.wait()
+            self.assertTrue(watcher.wait_for_exit(name, 5))
+        finally:
+            watcher.stop()
+
+        events = watcher.get_events(name)
+        self.assertEqual([event['event'] for event in events], ['started', 'exited'])
+        self.assertEqual({event['pid'] for event in events}, {process.pid})
+        self.assertGreaterEqual(watcher.get_stats()['exited'], 1)
+
+    def test_terminator_ends_every_process_of_the_executables(self):
+        polite = self.new_executable()
+        stubborn = self.new_executable()
+        forced = self.new_executable()
+        polite_processes = [self.spawn(polite), self.spawn(polite)]
+        stubborn_process = self.spawn(stubborn, IGNORE_TERM)
+        # The SIGTERM handler is in place once it prints
+        stubborn_process.stdout.readline()
+        forced_process = self.spawn(forced)
+
+        report = HarmonyHostTerminator(self.table, grace=1).terminate([polite, stubborn], force=[forced])
+        results = {entry['pid']: entry['result'] for entry in report}
+
+        for process in polite_processes:
+            self.assertEqual(results[process.pid], 'terminated')
+        self.assertEqual(results[stubborn_process.pid], 'killed')
+        self.assertEqual(results[forced_process.pid], 'killed')
+        for process in self.processes:
+            self.assertIsNotNone(process.poll())
+        self.assertFalse(self.table.are_any_running([polite, stubborn, forced]))
+
+    def test_terminator_ends_a_process_tree(self):
+        name = self.new_executable()
+        launcher = self.spawn(name, LAUNCHER)
+        child_pid = int(launcher.stdout.readline())
+
+        report = HarmonyHostTerminator(self.table, grace=1).terminate([name])
+
+        self.assertEqual({entry['pid']: entry['result'] for entry in report}, {launcher.pid: 'terminated', child_pid: 'terminated'})
+        self.assertIsNotNone(launcher.poll())
+        self.assertFalse(psutil.pid_exists(child_pid))
+
+    def test_terminator_spares_excluded_pids(self):
+        name = self.new_executable()
+        kept = self.spawn(name)
+        ended = self.spawn(name)
+
+        report = HarmonyHostTerminator(self.table, grace=1).terminate([name], exclude_pids={kept.pid})
+
+        self.assertEqual([entry['pid'] for entry in report], [ended.pid])
+        self.assertIsNone(kept.poll())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from windows import WS_DISABLED, HarmonyHostFakeWindows, HarmonyHostWindowIndex, get_window_size, win32gui
+
+# Process table with fixed pids per executable, lower-cased like the real one
+class HarmonyHostFakeProcesses():
+    def __init__(self, pids):
+        self.pids = {name.lower(): set(values) for name, values in pids.items()}
+
+    def get_pids(self, name, max_age=None):
+        return set(self.pids.get(name.lower(), ()))
+
+def new_window(hwnd, pid, title='Game', rect=(0, 0, 1920, 1080), style=0, visible=True):
+    return {'hwnd': hwnd, 'pid': pid, 'title': title, 'rect': rect, 'style': style, 'visible': visible}
+
+WINDOWS = [
+    new_window(1, 200, 'Default IME'),
+    new_window(2, 100, 'Launcher', rect=(100, 100, 900, 700)),
+    new_window(3, 200, 'Game'),
+    new_window(4, 200, 'Hidden', visible=False),
+    new_window(5, 200, 'Disabled', style=WS_DISABLED),
+    new_window(6, 300, 'Other app'),
+]
+
+class HarmonyHostWindowIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = HarmonyHostFakeWindows(WINDOWS)
+        self.processes = HarmonyHostFakeProcesses({'Game.exe': [200, 100], 'Other.exe': [300]})
+        self.index = HarmonyHostWindowIndex(self.backend, self.processes, tick=60)
+
+    def test_windows_are_found_through_the_pids_of_the_executable(self):
+        # Per process in pid order, then in enumeration (Z) order
+        self.assertEqual([window['hwnd'] for window in self.index.find_windows('game.exe')], [2, 1, 3, 4, 5])
+        self.assertEqual(self.index.find_window('Game.exe')['hwnd'], 2)
+        self.assertEqual([window['hwnd'] for window in self.index.get_windows(300)], [6])
+        self.assertIsNone(self.index.find_window('Missing.exe'))
+
+    def test_valid_windows_skip_hidden_disabled_and_helper_windows(self):
+        self.assertEqual([window['title'] for window in self.index.find_valid_windows('Game.exe')], ['Launcher', 'Game'])
+        self.assertEqual(get_window_size(self.index.find_window('Game.exe')), (800, 600))
+
+    def test_one_enumeration_per_tick(self):
+        for _ in range(5):
+            self.index.find_windows('Game.exe')
+            self.index.find_valid_windows('Other.exe')
+        self.assertEqual(self.backend.enumerations, 1)
+
+        # A window that appears is only seen once the index is refreshed
+        self.backend.windows.append(new_window(7, 300, 'Second window'))
+        self.assertEqual(len(self.index.find_windows('Other.exe')), 1)
+        self.index.invalidate()
+        self.assertEqual(len(self.index.find_windows('Other.exe')), 2)
+        self.assertEqual(len(self.index.find_windows('Other.exe', max_age=0)), 2)
+        self.assertEqual(self.backend.enumerations, 3)
+        self.assertEqual(self.index.get_stats()['enumerations'], 3)
+
+    def test_close_windows_asks_visible_windows_only(self):
+        self.assertEqual(self.backend.close_windows({200, 300}), {200, 300})
+        self.assertEqual(self.backend.close_windows({400}), set())
+        self.assertEqual(self.backend.closed, [200, 300])
+
+    @unittest.skipIf(win32gui is not None, 'win32gui is installed')
+    def test_no_silent_fake_desktop_without_win32gui(self):
+        with self.assertRaises(RuntimeError):
+            HarmonyHostWindowIndex(processes=self.processes)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from logger import Logger
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+logger = Logger(os.path.join(current_path, 'app.log'), False)
+
+# Records the phases of a launch as timed spans and writes them in the Chrome trace-event format, which can be
+# opened in chrome://tracing or ui.perfetto.dev. Timestamps are wall clock microseconds so that client and
+# guest traces of the same launch can be lined up.
+class HarmonyTimeline():
+    def __init__(self, name, trace_dir=None):
+        self.name = name
+        self.trace_dir = trace_dir or os.path.join(current_path, 'traces')
+        self.trace_file = os.path.join(self.trace_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        self.pid = os.getpid()
+        self.events = []
+        self.tracks = {}
+        self.lock = threading.Lock()
+
+    def now(self):
+        return time.time_ns() // 1000
+
+    def get_track(self, track=None):
+        # Threads get their own track unless the caller names one, e.g. for concurrent asyncio steps
+        key = track or threading.current_thread().name
+        with self.lock:
+            if key not in self.tracks:
+                tid = len(self.tracks) + 1
+                self.tracks[key] = tid
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': key}})
+            return self.tracks[key]
+
+    def add_span(self, name, start, end, category='launch', track=None, args=None):
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start, 'dur': max(0, end - start), 'pid': self.pid, 'tid': self.get_track(track)}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    def instant(self, name, category='launch', track=None, args=None):
+        event = {'name': name, 'cat': category, 'ph': 'i', 's': 't', 'ts': self.now(), 'pid': self.pid, 'tid': self.get_track(track)}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category='launch', track=None, args=None):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, self.now(), category, track, args)
+
+    def save(self):
+        with self.lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms', 'otherData': {'name': self.name}}
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            with open(self.trace_file, 'w') as f:
+                json.dump(trace, f)
+            logger.log_to_file(f'[HarmonyTimeline] [Info] Wrote launch trace to {self.trace_file}')
+        except OSError as e:
+            logger.log_to_file(f'[HarmonyTimeline] [Error] Failed to write launch trace: {e}')
+
+# Timeline that is not written anywhere, used when no launch is being recorded
+class HarmonyNullTimeline(HarmonyTimeline):
+    def add_span(self, name, start, end, category='launch', track=None, args=None):
+        pass
+
+    def instant(self, name, category='launch', track=None, args=None):
+        pass
+
+    def save(self):
+        pass
+
+harmony_timeline = HarmonyNullTimeline('none')
+
+def get_harmony_timeline():
+    return harmony_timeline
+
+def set_harmony_timeline(timeline):
+    global harmony_timeline
+    harmony_timeline = timeline
+    return timeline
@@ -0,0 +1,144 @@
+import threading
+import time
+
+from processes import get_harmony_process_table
+
+try:
+    import win32gui
+    import win32process
+except ImportError:
+    win32gui = None
+    win32process = None
+
+GWL_STYLE = -16
+WM_CLOSE = 0x0010
+WS_DISABLED = 0x08000000
+
+#TODO: Consider alternative way of rejecting invalid hwnd instances rather than manually blacklisting them
+BAD_TITLES = ['MSCTFIME UI', 'Default IME', 'Battery Watcher', 'WinEventHub', '$AS', '$Hour']
+
+# Top-level windows of the desktop from a single EnumWindows pass, with everything the host reads about them
+class HarmonyHostWin32Windows():
+    def enum_windows(self):
+        windows = []
+        def callback(hwnd, _):
+            try:
+                windows.append({
+                    'hwnd': hwnd,
+                    'pid': win32process.GetWindowThreadProcessId(hwnd)[1],
+                    'title': win32gui.GetWindowText(hwnd),
+                    'rect': win32gui.GetWindowRect(hwnd),
+                    'style': win32gui.GetWindowLong(hwnd, GWL_STYLE),
+                    'visible': bool(win32gui.IsWindowVisible(hwnd)),
+                })
+            except Exception:
+                pass # The window was destroyed while enumerating
+            return True
+        win32gui.EnumWindows(callback, None)
+        return windows
+
+    # Asks every visible window of the processes to close, the polite way to end a Windows program. Returns the
+    # pids that had a window to ask.
+    def close_windows(self, pids):
+        closed = set()
+        for window in self.enum_windows():
+            if window['pid'] in pids and window['visible']:
+                try:
+                    win32gui.PostMessage(window['hwnd'], WM_CLOSE, 0, 0)
+                    closed.add(window['pid'])
+                except Exception:
+                    pass
+        return closed
+
+# Stand-in for the desktop, a list of window dicts shaped like enum_windows() returns, for tests that pass it in
+class HarmonyHostFakeWindows():
+    def __init__(self, windows=None):
+        self.windows = list(windows or [])
+        self.enumerations = 0
+        self.closed = []
+
+    def enum_windows(self):
+        self.enumerations += 1
+        return [dict(window) for window in self.windows]
+
+    def close_windows(self, pids):
+        closed = {window['pid'] for window in self.windows if window['pid'] in pids and window['visible']}
+        self.closed.extend(sorted(closed))
+        return closed
+
+def is_valid_window(window):
+    # Visible, enabled and not one of the helper windows games and overlays leave around
+    return (window['visible'] and (window['style'] & WS_DISABLED) == 0
+        and not any(bad_title in window['title'] for bad_title in BAD_TITLES))
+
+def get_window_size(window):
+    left, top, right, bottom = window['rect']
+    return right - left, bottom - top
+
+# pid -> windows index built from one enumeration per tick and shared by every phase of a launch. Executables are
+# mapped to pids through the shared process table, so a lookup costs no Win32 or psutil call within the tick.
+class HarmonyHostWindowIndex():
+    def __init__(self, backend=None, processes=None, tick=0.5):
+        if backend is None:
+            # An empty fake desktop would make every window wait time out without saying why
+            if win32gui is None:
+                raise RuntimeError('pywin32 is not installed, the window index needs win32gui or an explicit backend')
+            backend = HarmonyHostWin32Windows()
+        self.backend = backend
+        self.processes = processes or get_harmony_process_table()
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.index = {}
+        self.taken_at = None
+        self.stats = {'enumerations': 0, 'queries': 0, 'enumeration_ms': 0.0}
+
+    def refresh(self):
+        start = time.perf_counter()
+        index = {}
+        for window in self.backend.enum_windows():
+            index.setdefault(window['pid'], []).append(window)
+        elapsed = (time.perf_counter() - start) * 1000
+        with self.lock:
+            self.index = index
+            self.taken_at = time.monotonic()
+            self.stats['enumerations'] += 1
+            self.stats['enumeration_ms'] += elapsed
+        return index
+
+    def invalidate(self):
+        with self.lock:
+            self.taken_at = None
+
+    def get_index(self, max_age=None):
+        max_age = self.tick if max_age is None else max_age
+        with self.lock:
+            self.stats['queries'] += 1
+            if self.taken_at is not None and time.monotonic() - self.taken_at < max_age:
+                return self.index
+        return self.refresh()
+
+    def get_windows(self, pid, max_age=None):
+        return list(self.get_index(max_age).get(pid, []))
+
+    # Every window of the processes running the executable, in enumeration (Z) order per process
+    def find_windows(self, process, max_age=None):
+        index = self.get_index(max_age)
+        windows = []
+        for pid in sorted(self.processes.get_pids(process, max_age)):
+            windows.extend(index.get(pid, []))
+        return windows
+
+    # First window of the executable whatever its state, as the main window and EAC checks have always used
+    def find_window(self, process, max_age=None):
+        windows = self.find_windows(process, max_age)
+        return windows[0] if windows else None
+
+    # Windows worth foregrounding or minimising
+    def find_valid_windows(self, process, max_age=None):
+        return [window for window in self.find_windows(process, max_age) if is_valid_window(window)]
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['enumeration_ms_avg'] = stats['enumeration_ms'] / stats['enumerations'] if stats['enumerations'] else 0
+        return stats